@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+measure the cost of the system checks of a generated project with a lot of CompositeForeignKey.
+
+    python benchmarks/check_startup.py --fields 500
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import argparse
+import os
+import sys
+from collections import OrderedDict
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "testsettings")
+
+import django  # noqa: E402
+from django.apps import apps  # noqa: E402
+from django.core import checks  # noqa: E402
+from django.db import models  # noqa: E402
+from django.db.models.deletion import CASCADE  # noqa: E402
+
+from compositefk.fields import CompositeForeignKey, RawFieldValue  # noqa: E402
+
+
+FIELDS_PER_MODEL = 5
+
+
+def generate_project(nb_fields):
+    """
+    create the models of a fake project in the testapp application: each local model has
+    FIELDS_PER_MODEL CompositeForeignKey to a remote model with a 3 parts key
+    """
+    local_models = []
+    for i in range(0, nb_fields, FIELDS_PER_MODEL):
+        remote = type(str("BenchRemote%d" % i), (models.Model,), {
+            "__module__": __name__,
+            "Meta": type(str("Meta"), (object,), {"app_label": "testapp"}),
+            "company": models.IntegerField(),
+            "tiers_id": models.IntegerField(),
+            "type_tiers": models.CharField(max_length=1),
+        })
+        attrs = OrderedDict([
+            ("__module__", __name__),
+            ("Meta", type(str("Meta"), (object,), {"app_label": "testapp"})),
+            ("company", models.IntegerField()),
+        ])
+        for j in range(min(FIELDS_PER_MODEL, nb_fields - i)):
+            attrs["tiers_%d" % j] = models.IntegerField()
+            attrs["composite_%d" % j] = CompositeForeignKey(
+                remote, on_delete=CASCADE, null=True, related_name="+", to_fields=OrderedDict([
+                    ("company", "company"),
+                    ("tiers_id", "tiers_%d" % j),
+                    ("type_tiers", RawFieldValue("C")),
+                ]),
+                null_if_equal=[("company", -1)],
+            )
+        local_models.append(type(str("BenchLocal%d" % i), (models.Model,), attrs))
+    return local_models
+
+
+def run_field_checks(local_models):
+    errors = []
+    for model in local_models:
+        for field in model._meta.local_fields:
+            if isinstance(field, CompositeForeignKey):
+                errors.extend(field.check())
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--fields", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    django.setup()
+    start = default_timer()
+    local_models = generate_project(args.fields)
+    print("generate %d composite fields: %.1fms" % (args.fields, (default_timer() - start) * 1000))
+
+    for i in range(args.repeat):
+        start = default_timer()
+        errors = run_field_checks(local_models)
+        print("field checks run %d: %.1fms (%d errors)" % (i + 1, (default_timer() - start) * 1000, len(errors)))
+
+    start = default_timer()
+    errors = checks.run_checks(app_configs=[apps.get_app_config("testapp")])
+    print("system checks of testapp: %.1fms (%d errors)" % ((default_timer() - start) * 1000, len(errors)))
+
+
+if __name__ == "__main__":
+    main()
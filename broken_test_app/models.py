@@ -50,3 +50,16 @@ class BadIdeaModel(models.Model):
         "tiers_id": "n",
         "company": "address",  # recursive dependency
     })
+
+
+class BadMirrorModel(models.Model):
+    company = models.IntegerField()
+    customer_id = models.IntegerField()
+    address = CompositeForeignKey(Address, on_delete=CASCADE, null=True, to_fields={
+        "tiers_id": "customer_id",
+        "company": "company",
+        "type_tiers": RawFieldValue("C")
+    }, mirror_fields={
+        "city": "not_an_address_field",  # neither exists
+        "customer_id": "tiers_id",  # a part of the key
+    })
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import json
+import logging
+
+from django import forms
+from django.conf.urls import url
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, JsonResponse
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.text import capfirst
+from django.utils.translation import ugettext_lazy as _
+
+from compositefk.compat import delete_cached_value_by_field
+from compositefk.fields import CompositeForeignKey
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+def split_composite_lookups(model, lookups):
+    """
+    split the given lookups in two lists : those which can be fetched with select_related, and
+    those which must be prefetched.
+    a composite relation with null_if_equal can't be joined, since the join would ignore the
+    special values (a customer with company=-1 would still get an address), so it is prefetched,
+    as the reverse many relations. lookups which does not go through a CompositeForeignKey are ignored.
+    :param model: the model from which the lookups start
+    :param list[str] lookups: the lookups (ie: "customer__address")
+    :return: the select_related lookups and the prefetch_related lookups
+    :rtype: tuple[list[str], list[str]]
+    """
+    select, prefetch = [], []
+    for lookup in lookups:
+        current = model
+        composite, joinable = False, True
+        for part in lookup.split("__"):
+            try:
+                field = current._meta.get_field(part)
+            except FieldDoesNotExist:
+                break
+            if not field.is_relation:
+                break
+            # the CompositeForeignKey itself, or the one behind a reverse relation
+            composite_field = field if isinstance(field, CompositeForeignKey) else getattr(field, "field", None)
+            if isinstance(composite_field, CompositeForeignKey):
+                composite = True
+                if composite_field is field and field.null_if_equal:
+                    joinable = False
+            if field.many_to_many or field.one_to_many:
+                joinable = False
+            current = field.related_model
+        else:
+            if composite:
+                (select if joinable else prefetch).append(lookup)
+    return select, prefetch
+
+
+class CompositeForeignKeyRawIdWidget(forms.MultiWidget):
+    """
+    raw-id like widget for a CompositeForeignKey : one input for each local part of the key,
+    the remote table is never loaded to build choices.
+    """
+
+    def decompress(self, value):
+        if value is None:
+            return [None] * len(self.widgets)
+        return list(value)
+
+
+class CompositeForeignKeyFormField(forms.MultiValueField):
+    """
+    form field which edit the local parts of a CompositeForeignKey.
+    the cleaned value is the tuple of the local values, checked against the remote model with one query.
+    """
+    default_error_messages = {
+        'invalid_choice': _('Select a valid choice. That choice is not one of the available choices.'),
+    }
+
+    def __init__(self, model_field, **kwargs):
+        self.model_field = model_field
+        fields = [f.formfield() for f in model_field.local_related_fields]
+        kwargs.setdefault("widget", CompositeForeignKeyRawIdWidget([f.widget for f in fields]))
+        kwargs.setdefault("required", not model_field.blank)
+        kwargs.setdefault("label", capfirst(model_field.verbose_name))
+        super(CompositeForeignKeyFormField, self).__init__(fields, require_all_fields=False, **kwargs)
+
+    def compress(self, data_list):
+        if not data_list or all(v in self.empty_values for v in data_list):
+            return None
+        return tuple(data_list)
+
+    def is_null_key(self, value):
+        """
+        return True if the given local values point to nothing (see null_if_equal)
+        """
+        if None in value:
+            return True
+        local_values = dict(zip((f.attname for f in self.model_field.local_related_fields), value))
+        return any(
+            field_name in local_values and local_values[field_name] == exception_value
+            for field_name, exception_value in self.model_field.null_if_equal
+        )
+
+    def validate(self, value):
+        super(CompositeForeignKeyFormField, self).validate(value)
+        if value is None or self.is_null_key(value):
+            return
+        lookup = self.model_field.get_extra_descriptor_filter(None)
+        lookup.update(
+            (f.name, v) for f, v in zip(self.model_field.foreign_related_fields, value)
+        )
+        if not self.model_field.related_model._default_manager.filter(**lookup).exists():
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
+class CompositeForeignKeyModelFormMixin(object):
+    """
+    ModelForm mixin that handle the CompositeForeignKeyFormField, which can't be saved by the default
+    construct_instance since the CompositeForeignKey has no column.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CompositeForeignKeyModelFormMixin, self).__init__(*args, **kwargs)
+        for name, field in self._composite_fields():
+            if name not in self.initial:
+                self.initial[name] = tuple(
+                    getattr(self.instance, f.attname) for f in field.model_field.local_related_fields
+                )
+
+    def _composite_fields(self):
+        return [
+            (name, field) for name, field in self.fields.items()
+            if isinstance(field, CompositeForeignKeyFormField)
+        ]
+
+    def _post_clean(self):
+        composite_values = {}
+        for name, field in self._composite_fields():
+            if name in self.cleaned_data:
+                composite_values[name] = (field.model_field, self.cleaned_data.pop(name))
+        for model_field, value in composite_values.values():
+            if value is None:
+                # let the descriptor apply the nullable_fields
+                setattr(self.instance, model_field.name, None)
+            else:
+                for local_field, local_value in zip(model_field.local_related_fields, value):
+                    setattr(self.instance, local_field.attname, local_value)
+                delete_cached_value_by_field(self.instance, model_field)
+        super(CompositeForeignKeyModelFormMixin, self)._post_clean()
+        self.cleaned_data.update((name, value) for name, (_field, value) in composite_values.items())
+
+
+class CompositeChangeList(ChangeList):
+    def apply_select_related(self, qs):
+        qs = super(CompositeChangeList, self).apply_select_related(qs)
+        return self.model_admin.apply_composite_related(qs, self.list_display)
+
+
+class CompositeForeignKeyAdminMixin(object):
+    """
+    ModelAdmin mixin which avoid one query per row and per CompositeForeignKey on the changelist,
+    and which allow to edit the CompositeForeignKey via their local parts.
+
+    - the CompositeForeignKey of list_display and the lookups of list_composite_related are fetched
+      with select_related, or with prefetch_related if they use null_if_equal.
+    - the CompositeForeignKey named in composite_raw_id_fields are edited via a raw-id like
+      widget, with one input per local part, instead of the local fields.
+    - a json view at <changelist>/composite-autocomplete/<field_name>/?term=...&page=... search
+      the remote model using the search_fields of its ModelAdmin, one limited query per page.
+    """
+    list_composite_related = ()
+    composite_raw_id_fields = ()
+    composite_autocomplete_page_size = 20
+
+    def get_changelist(self, request, **kwargs):
+        return CompositeChangeList
+
+    def apply_composite_related(self, queryset, list_display):
+        select, prefetch = split_composite_lookups(
+            self.model,
+            [name for name in list_display if isinstance(name, six.string_types)] + list(self.list_composite_related),
+        )
+        if queryset.query.select_related is True:
+            # a select_related() without args already follow the not null relations,
+            # adding some lookups would disable it
+            prefetch.extend(select)
+        elif select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+    def _get_composite_raw_id_fields(self):
+        return [self.model._meta.get_field(name) for name in self.composite_raw_id_fields]
+
+    def get_exclude(self, request, obj=None):
+        exclude = super(CompositeForeignKeyAdminMixin, self).get_exclude(request, obj)
+        local_fields = [
+            f.name for field in self._get_composite_raw_id_fields() for f in field.local_related_fields
+        ]
+        if not local_fields:
+            return exclude
+        return list(exclude or ()) + local_fields
+
+    def get_form(self, request, obj=None, **kwargs):
+        composite_fields = self._get_composite_raw_id_fields()
+        if composite_fields:
+            readonly_fields = self.get_readonly_fields(request, obj)
+            form = kwargs.get("form", self.form)
+            attrs = dict(
+                (field.name, CompositeForeignKeyFormField(field))
+                for field in composite_fields
+                if field.name not in readonly_fields
+            )
+            kwargs["form"] = type(form.__name__, (CompositeForeignKeyModelFormMixin, form), attrs)
+        return super(CompositeForeignKeyAdminMixin, self).get_form(request, obj, **kwargs)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(
+                r'^composite-autocomplete/(?P<field_name>\w+)/$',
+                self.admin_site.admin_view(self.composite_autocomplete_view),
+                name='%s_%s_composite_autocomplete' % info
+            ),
+        ] + super(CompositeForeignKeyAdminMixin, self).get_urls()
+
+    def composite_autocomplete_view(self, request, field_name):
+        """
+        search the remote model of the given CompositeForeignKey.
+        each result give the key to put in the local parts, the pagination don't count the table.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            field = self.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            raise Http404
+        remote_admin = self.admin_site._registry.get(getattr(field, "related_model", None))
+        if not isinstance(field, CompositeForeignKey) or remote_admin is None or not remote_admin.search_fields:
+            raise Http404
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+        page_size = self.composite_autocomplete_page_size
+
+        queryset = remote_admin.get_queryset(request).filter(**field.get_extra_descriptor_filter(None))
+        queryset, use_distinct = remote_admin.get_search_results(request, queryset, request.GET.get("term", ""))
+        if use_distinct:
+            queryset = queryset.distinct()
+        queryset = queryset.order_by(*(f.name for f in field.foreign_related_fields))
+        start = (page - 1) * page_size
+        # one more row tell if there is a next page, without a count on the remote table
+        objects = list(queryset[start:start + page_size + 1])
+
+        results = []
+        for obj in objects[:page_size]:
+            key = field.get_foreign_related_value(obj)
+            results.append({
+                "id": json.dumps(key, cls=DjangoJSONEncoder),
+                "key": key,
+                "text": force_text(obj),
+            })
+        return JsonResponse({"results": results, "pagination": {"more": len(objects) > page_size}})
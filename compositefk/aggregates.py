@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+aggregates over the reverse side of a CompositeForeignKey, computed by a correlated subquery keyed on the
+composite columns instead of a join : the rows of the parent are never duplicated, whatever the other joins
+and annotations of the query.
+
+    Customer.objects.annotate(n=CompositeCount("contacts")).filter(address__city="tear")
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.core.exceptions import FieldError
+from django.db.models import Avg, Count, IntegerField, Max, Min, Q, Sum
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import Case, Expression, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from compositefk.fields import CompositeForeignKey
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class CompositeAggregate(Expression):
+    """
+    aggregate the related objects of the reverse relation of a CompositeForeignKey.
+    the lookup start by the name of the reverse relation, followed by the expression to aggregate on the related
+    model (ie: "contacts__phonenumbers__type_number").
+    the related objects whose values are in the null_if_equal of the field are ignored, and so are the parents
+    which don't match the RawFieldValue/FunctionBasedFieldValue of the field : they get the empty_value.
+    """
+    aggregate = None
+    name = None
+    # the value of a parent without related objects (None as in sql)
+    empty_value = None
+    default_target = None
+
+    def __init__(self, lookup, filter=None, output_field=None):
+        super(CompositeAggregate, self).__init__()
+        self.lookup = lookup
+        self.filter = filter
+        # the output field of the subquery, the one of the aggregate on the related model if None
+        self.result_field = output_field
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.lookup)
+
+    @property
+    def default_alias(self):
+        return '%s__%s' % (self.lookup, self.name.lower())
+
+    def get_relation(self, model):
+        """
+        :return: the CompositeForeignKey of the reverse relation named by the lookup, and the target of
+            the aggregate on its model
+        :rtype: tuple[CompositeForeignKey, str]
+        """
+        parts = self.lookup.split(LOOKUP_SEP)
+        rel = model._meta.get_field(parts[0])
+        field = getattr(rel, "field", None)
+        if rel.concrete or not isinstance(field, CompositeForeignKey):
+            raise FieldError(
+                "%s is not the reverse relation of a CompositeForeignKey on %s" % (parts[0], model._meta.label)
+            )
+        target = LOOKUP_SEP.join(parts[1:]) or self.default_target
+        if target is None:
+            raise FieldError("%s need a field to aggregate after %s" % (self.name, parts[0]))
+        return field, target
+
+    def get_subquery(self, model):
+        field, target = self.get_relation(model)
+        children = field.model._default_manager.filter(**{
+            local.attname: OuterRef(remote.attname) for local, remote in field.related_fields
+        })
+        for field_name, exception_value in field.null_if_equal:
+            children = children.exclude(**{field_name: exception_value})
+        if self.filter is not None:
+            children = children.filter(self.filter)
+        children = children.order_by().values(*[local.attname for local in field.local_related_fields])
+        children = children.annotate(_composite_aggregate=self.aggregate(target)).values("_composite_aggregate")
+        output_field = self.result_field
+        if output_field is None:
+            output_field = children.query.annotations["_composite_aggregate"].output_field
+
+        expression = Subquery(children, output_field=output_field)
+        if self.empty_value is not None:
+            expression = Coalesce(expression, Value(self.empty_value), output_field=output_field)
+        remote_fields = field.resolved_fields.remote
+        conditions = {
+            remote_fields[remote].attname: part.value
+            for remote, part in field._raw_fields.items()
+            if not part.is_local_field
+        }
+        if conditions:
+            expression = Case(
+                When(Q(**conditions), then=expression),
+                default=Value(self.empty_value),
+                output_field=output_field,
+            )
+        return expression
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        return self.get_subquery(query.model).resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+
+class CompositeCount(CompositeAggregate):
+    aggregate = Count
+    name = "Count"
+    empty_value = 0
+    default_target = "pk"
+
+    def __init__(self, lookup, filter=None):
+        super(CompositeCount, self).__init__(lookup, filter=filter, output_field=IntegerField())
+
+
+class CompositeSum(CompositeAggregate):
+    aggregate = Sum
+    name = "Sum"
+
+
+class CompositeAvg(CompositeAggregate):
+    aggregate = Avg
+    name = "Avg"
+
+
+class CompositeMax(CompositeAggregate):
+    aggregate = Max
+    name = "Max"
+
+
+class CompositeMin(CompositeAggregate):
+    aggregate = Min
+    name = "Min"
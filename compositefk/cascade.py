@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+the emulation of ON UPDATE CASCADE for a CompositeForeignKey(on_update=CASCADE) : there is no constraint in the
+database for a composite relation, so when the key of a related object change, its dependents are updated with it.
+
+- when a related object is saved with a key which differ from the one it was loaded with, its key is read from the
+  database before (pre_save), and the dependents of the old key get the new one after (post_save). django send
+  pre_save and post_save outside of the transaction of the save : when the save run in autocommit, pre_save open
+  an atomic block for it (only when a key change is detected), which post_save close once the dependents are
+  updated. if the save fail between them, the block is left open, its transaction marked for rollback : it is
+  rolled back by the next save of the instance, or when the connection is closed (at the end of a request) ;
+- when a CompositeQuerySet.update() change the keys of the related objects, they are read before and after it,
+  and the dependents of each relation are updated by one UPDATE per chunk of 1000 changed keys, which give each old
+  key its new one with a CASE, in the transaction of the update.
+
+the dependents are updated through a CompositeQuerySet, so their own dependents and their mirrored columns follow.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import sys
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Q, Value
+from django.db.models.expressions import Case, When
+from django.db.models.signals import post_init, post_save, pre_save
+
+from compositefk.mirroring import get_raw_conditions
+from compositefk.query import CompositeQuerySet, filter_by_keys
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# the value of on_update which update the dependents
+CASCADE = "cascade"
+# the keys of the related object before its save, by field
+OLD_KEYS_ATTR = "_compositefk_old_keys"
+# the values of the key attnames the related object was loaded (or last saved) with, by attname
+LOADED_KEYS_ATTR = "_compositefk_loaded_keys"
+# the atomic block opened by pre_save for the save of the related object, with the connection it was opened on
+ATOMIC_ATTR = "_compositefk_atomic"
+
+# the CompositeForeignKey(on_update=CASCADE), by related model
+_remote_fields = defaultdict(list)
+
+
+def register(field, related_model):
+    """
+    update the dependents of the related objects of the field when their key change
+    """
+    if field in _remote_fields[related_model]:
+        return
+    _remote_fields[related_model].append(field)
+    post_init.connect(snapshot_keys, sender=related_model, dispatch_uid="compositefk.cascade.post_init")
+    pre_save.connect(remember_keys, sender=related_model, dispatch_uid="compositefk.cascade.pre_save")
+    post_save.connect(update_dependents, sender=related_model, dispatch_uid="compositefk.cascade.post_save")
+
+
+def get_cascading_fields(model):
+    """
+    :rtype: list[CompositeForeignKey]
+    """
+    return list(_remote_fields.get(model, []))
+
+
+def get_key_attnames(field):
+    """
+    :return: the attnames of the related model read to know the key of a related object : the ones of the key,
+        followed by the ones of the RawFieldValue
+    """
+    attnames = [f.attname for f in field.foreign_related_fields]
+    return attnames + sorted(set(get_raw_conditions(field)) - set(attnames))
+
+
+def get_key(field, values):
+    """
+    :param dict values: the values of the key attnames (see get_key_attnames) of a related object
+    :return: the key of the related object, None if it can't have dependents (a None in its key, or a RawFieldValue
+        which don't match)
+    :rtype: tuple
+    """
+    if any(values[attname] != value for attname, value in get_raw_conditions(field).items()):
+        return None
+    key = tuple(values[f.attname] for f in field.foreign_related_fields)
+    return None if None in key else key
+
+
+def get_update_fields(model, updated):
+    """
+    :param set updated: the names and attnames given to a QuerySet.update() of model
+    :return: the cascading fields whose key may be changed by the update
+    :rtype: list[CompositeForeignKey]
+    """
+    impacted = []
+    for field in get_cascading_fields(model):
+        names = set(get_key_attnames(field))
+        names.update(model._meta.get_field(attname).name for attname in list(names))
+        if names & updated:
+            impacted.append(field)
+    return impacted
+
+
+def read_keys(fields, queryset):
+    """
+    :return: the keys of the related objects of the queryset for each field, by pk
+    :rtype: dict[object, dict[CompositeForeignKey, tuple]]
+    """
+    attnames = sorted(set(attname for field in fields for attname in get_key_attnames(field)))
+    keys = {}
+    for row in queryset.order_by().values_list("pk", *attnames):
+        values = dict(zip(attnames, row[1:]))
+        keys[row[0]] = {field: get_key(field, values) for field in fields}
+    return keys
+
+
+def propagate_update(fields, old_keys, model, using=DEFAULT_DB_ALIAS, chunk_size=1000):
+    """
+    update the dependents of the related objects changed by a QuerySet.update()
+    :param old_keys: the keys of the updated objects before the update (see read_keys)
+    """
+    pks = list(old_keys)
+    manager = model._base_manager.db_manager(using)
+    new_keys = {}
+    for start in range(0, len(pks), chunk_size):
+        new_keys.update(read_keys(fields, manager.filter(pk__in=pks[start:start + chunk_size])))
+    for field in fields:
+        propagate(field, [
+            (keys[field], new_keys[pk][field]) for pk, keys in old_keys.items() if pk in new_keys
+        ], using, chunk_size)
+
+
+def propagate(field, changes, using=DEFAULT_DB_ALIAS, chunk_size=1000):
+    """
+    give the new keys to the dependents of the old ones, with one UPDATE per chunk of chunk_size keys
+    :param changes: the couples (old key, new key) of the related objects whose key changed
+    :return: the number of updated rows
+    """
+    changes = [(old, new) for old, new in changes if old is not None and new is not None and old != new]
+    local_fields = field.local_related_fields
+    rows = 0
+    for start in range(0, len(changes), chunk_size):
+        chunk = changes[start:start + chunk_size]
+        values = {}
+        for i, local_field in enumerate(local_fields):
+            if all(old[i] == new[i] for old, new in chunk):
+                continue
+            if len(chunk) == 1:
+                values[local_field.attname] = chunk[0][1][i]
+                continue
+            values[local_field.attname] = Case(*[
+                When(Q(**{f.attname: value for f, value in zip(local_fields, old)}), then=Value(
+                    new[i], output_field=local_field,
+                ))
+                for old, new in chunk if old[i] != new[i]
+            ], default=F(local_field.attname), output_field=local_field)
+        dependents = filter_by_keys(CompositeQuerySet(model=field.model, using=using), local_fields, [
+            old for old, new in chunk
+        ])
+        for field_name, exception_value in field.null_if_equal:
+            dependents = dependents.exclude(**{field_name: exception_value})
+        rows += dependents.update(**values)
+    return rows
+
+
+def get_key_values(model, instance):
+    """
+    :return: the values of the key attnames of all the cascading fields of model, without loading the deferred ones
+    :rtype: dict
+    """
+    attnames = set(attname for field in get_cascading_fields(model) for attname in get_key_attnames(field))
+    return {attname: instance.__dict__[attname] for attname in attnames if attname in instance.__dict__}
+
+
+def snapshot_keys(sender, instance, **kwargs):
+    instance.__dict__[LOADED_KEYS_ATTR] = get_key_values(sender, instance)
+
+
+def is_key_changed(field, instance):
+    """
+    :return: False if the key attnames of the field still have the values the instance was loaded with (then the
+        database is not read before the save), True if they changed or are unknown (deferred)
+    """
+    loaded = instance.__dict__.get(LOADED_KEYS_ATTR, {})
+    return any(
+        attname not in loaded or attname not in instance.__dict__ or instance.__dict__[attname] != loaded[attname]
+        for attname in get_key_attnames(field)
+    )
+
+
+def open_atomic(instance, using):
+    """
+    open an atomic block for the save of instance, if it run in autocommit : the key read before the save, the save
+    and the update of the dependents must see the same row, and be rolled back together
+    """
+    connection = transaction.get_connection(using)
+    if connection.in_atomic_block:
+        return
+    atomic = transaction.atomic(using=using, savepoint=False)
+    atomic.__enter__()
+    instance.__dict__[ATOMIC_ATTR] = (atomic, connection.connection)
+
+
+def close_atomic(instance, exc_info=(None, None, None)):
+    """
+    close the atomic block opened by open_atomic, and roll it back if exc_info is given
+    """
+    atomic, _ = instance.__dict__.pop(ATOMIC_ATTR, (None, None))
+    if atomic is not None:
+        atomic.__exit__(*exc_info)
+
+
+def rollback_failed_save(instance, using):
+    """
+    roll back the atomic block left open by a save of instance which failed after pre_save
+    """
+    atomic, raw_connection = instance.__dict__.pop(ATOMIC_ATTR, (None, None))
+    connection = transaction.get_connection(using)
+    # still the outermost block of the same database connection (not closed since)
+    if atomic is None or connection.connection is not raw_connection or not connection.in_atomic_block:
+        return
+    if connection.savepoint_ids:
+        return
+    transaction.set_rollback(True, using=using)
+    atomic.__exit__(None, None, None)
+
+
+def remember_keys(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, update_fields=None, **kwargs):
+    rollback_failed_save(instance, using)
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    fields = get_cascading_fields(sender)
+    if update_fields is not None:
+        fields = get_update_fields(sender, set(update_fields))
+    fields = [field for field in fields if is_key_changed(field, instance)]
+    if not fields:
+        return
+    open_atomic(instance, using)
+    try:
+        keys = read_keys(fields, sender._base_manager.using(using).filter(pk=instance.pk))
+    except Exception:
+        close_atomic(instance, sys.exc_info())
+        raise
+    if instance.pk in keys:
+        instance.__dict__[OLD_KEYS_ATTR] = keys[instance.pk]
+
+
+def update_dependents(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, update_fields=None, **kwargs):
+    old_keys = instance.__dict__.pop(OLD_KEYS_ATTR, None)
+    if raw:
+        return
+    try:
+        for field, old_key in (old_keys or {}).items():
+            new_key = get_key(field, {attname: getattr(instance, attname) for attname in get_key_attnames(field)})
+            propagate(field, [(old_key, new_key)], using)
+    except Exception:
+        close_atomic(instance, sys.exc_info())
+        raise
+    close_atomic(instance)
+    # the saved values are the ones of the row now (once the save can't be rolled back by the propagation)
+    saved = get_key_values(sender, instance)
+    if update_fields is not None:
+        saved = {
+            attname: value for attname, value in saved.items()
+            if attname in update_fields or sender._meta.get_field(attname).name in update_fields
+        }
+    instance.__dict__.setdefault(LOADED_KEYS_ATTR, {}).update(saved)
@@ -20,3 +20,34 @@ def set_cached_value_by_field(instance, field, value):
         setattr(instance, field.get_cache_name(), value)
     else:
         field.set_cached_value(instance, value)
+
+
+def delete_cached_value_by_field(instance, field):
+    if django.VERSION < (2, 0):
+        if hasattr(instance, field.get_cache_name()):
+            delattr(instance, field.get_cache_name())
+    elif field.is_cached(instance):
+        field.delete_cached_value(instance)
+
+
+def get_prefetch_result(queryset, rel_obj_attr, instance_attr, single, cache_name):
+    # the tuple expected from get_prefetch_queryset by prefetch_one_level
+    if django.VERSION < (2, 0):
+        return queryset, rel_obj_attr, instance_attr, single, cache_name
+    else:
+        return queryset, rel_obj_attr, instance_attr, single, cache_name, False
+
+
+def get_reverse_many_cache_name(field):
+    if django.VERSION < (2, 1):
+        return field.related_query_name()
+    else:
+        return field.remote_field.get_cache_name()
+
+
+def get_results_iter(compiler, iterable):
+    # the rows of the query of a values() iterable
+    if django.VERSION < (2, 0):
+        return compiler.results_iter(chunked_fetch=iterable.chunked_fetch)
+    else:
+        return compiler.results_iter(chunked_fetch=iterable.chunked_fetch, chunk_size=iterable.chunk_size)
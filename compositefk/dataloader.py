@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+batch the loads of the related objects of the CompositeForeignKey made by asyncio coroutines (ie: the resolvers
+of a GraphQL query), as a DataLoader : the keys requested during one iteration of the event loop are deduplicated
+and loaded with one query per field, so N awaits cost one query instead of N.
+
+    loader = CompositeLoader()  # one per request, nothing is kept between them
+
+    async def resolve_customer(contact, info):
+        return await loader.load(contact, "customer")
+
+the related objects are cached on the instances, as their descriptor would have. python 3 only.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import asyncio
+import logging
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.db import connections
+
+from compositefk import routing, stats
+from compositefk.compat import get_cached_value, set_cached_value_by_descriptor, set_cached_value_by_field
+from compositefk.query import filter_by_keys
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+def fetch(field, queryset, close=False):
+    """
+    :return: the related objects of the queryset by key, and the duration of the query
+    :param bool close: close the connections of the thread after the query (run in an executor)
+    """
+    start = default_timer()
+    try:
+        return {field.get_foreign_related_value(rel_obj): rel_obj for rel_obj in queryset}, default_timer() - start
+    finally:
+        if close:
+            for conn in connections.all():
+                conn.close()
+
+
+class CompositeLoader(object):
+    """
+    load the related objects of the CompositeForeignKey by batches : a load() is answered once the coroutines
+    ready in the same iteration of the event loop have run, with one query per batch of max_batch_size keys of
+    the same field, database and values of the RawFieldValue.
+    the queries block the loop, unless an executor is given : they are then run in its threads, each with its
+    own connection (but in the loop if the database is in a transaction, which the threads wouldn't see).
+    """
+
+    def __init__(self, loop=None, executor=None, max_batch_size=1000):
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        # the loads waiting for the dispatch, by batch (see get_batch_key) and by key
+        self._batches = OrderedDict()
+        self._dispatch_scheduled = False
+
+    def _future(self):
+        return asyncio.Future(loop=self.loop)
+
+    def get_batch_key(self, descriptor, instance):
+        """
+        the loads which can share a query : the RawFieldValue are evaluated at the load, since a
+        FunctionBasedFieldValue may give another value in another context (ie: the active language)
+        """
+        using = descriptor.get_queryset(instance=instance).db
+        extra = tuple(sorted(descriptor.field.get_extra_descriptor_filter(instance).items()))
+        return descriptor.field, using, extra
+
+    def load(self, instance, name):
+        """
+        :param name: the name of a CompositeForeignKey of the instance
+        :return: a future of its related object, or of RelatedObjectDoesNotExist as the descriptor would raise
+        :rtype: asyncio.Future
+        """
+        descriptor = getattr(type(instance), name)
+        future = self._future()
+        if descriptor.is_cached(instance):
+            self.set_result(descriptor, instance, future, get_cached_value(instance, descriptor))
+            return future
+        key = descriptor.field.get_local_related_value(instance)
+        if None in key:
+            self.set_result(descriptor, instance, future, None)
+            return future
+        batch = self._batches.setdefault(self.get_batch_key(descriptor, instance), OrderedDict())
+        batch.setdefault(key, []).append((descriptor, instance, future))
+        if not self._dispatch_scheduled:
+            # after the coroutines already ready, which may ask for other keys
+            self._dispatch_scheduled = True
+            self.loop.call_soon(self.dispatch)
+        return future
+
+    def load_many(self, instances, name):
+        """
+        :return: a future of the list of the related objects of the instances
+        """
+        futures = [self.load(instance, name) for instance in instances]
+        if futures:
+            return asyncio.gather(*futures)
+        future = self._future()
+        future.set_result([])
+        return future
+
+    def dispatch(self):
+        self._dispatch_scheduled = False
+        batches, self._batches = self._batches, OrderedDict()
+        for batch_key, waiting in batches.items():
+            keys = list(waiting)
+            for start in range(0, len(keys), self.max_batch_size):
+                chunk = keys[start:start + self.max_batch_size]
+                self.load_batch(batch_key, OrderedDict((key, waiting[key]) for key in chunk))
+
+    def load_batch(self, batch_key, waiting):
+        """
+        load the related objects of the waiting loads, by key, with one query
+        """
+        field, using, extra = batch_key
+        descriptor, instance, future = next(iter(waiting.values()))[0]
+        queryset = filter_by_keys(
+            descriptor.get_queryset(instance=instance).using(using).filter(**dict(extra)),
+            field.foreign_related_fields,
+            waiting,
+        )
+        if self.executor is None or connections[using].in_atomic_block:
+            try:
+                result = fetch(field, queryset)
+            except Exception as e:
+                self.set_exception(waiting, e)
+            else:
+                self.set_results(field, waiting, *result)
+            return
+
+        def done(query):
+            if query.exception() is not None:
+                self.set_exception(waiting, query.exception())
+            else:
+                self.set_results(field, waiting, *query.result())
+
+        self.loop.run_in_executor(self.executor, fetch, field, queryset, True).add_done_callback(done)
+
+    def set_results(self, field, waiting, rel_objs, duration):
+        if stats.enabled:
+            instances = sum(len(loads) for loads in waiting.values())
+            stats.record_fetch(field, "prefetch", len(rel_objs), duration, batch_size=instances)
+        for key, loads in waiting.items():
+            rel_obj = rel_objs.get(key)
+            for descriptor, instance, future in loads:
+                self.set_result(descriptor, instance, future, routing.attach(rel_obj, instance))
+
+    def set_exception(self, waiting, exception):
+        for loads in waiting.values():
+            for descriptor, instance, future in loads:
+                if not future.done():
+                    future.set_exception(exception)
+
+    def set_result(self, descriptor, instance, future, rel_obj):
+        """
+        cache the related object on the instance and give it to the future, as the descriptor would have
+        """
+        set_cached_value_by_descriptor(instance, descriptor, rel_obj)
+        if rel_obj is not None and not descriptor.field.remote_field.multiple:
+            set_cached_value_by_field(rel_obj, descriptor.field.remote_field, instance)
+        if future.done():
+            # cancelled by its coroutine
+            return
+        if rel_obj is None and not descriptor.field.null:
+            future.set_exception(descriptor.RelatedObjectDoesNotExist(
+                "%s has no %s." % (type(instance).__name__, descriptor.field.name)
+            ))
+        else:
+            future.set_result(rel_obj)
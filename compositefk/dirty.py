@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+the columns changed on the instances of the models having a CompositeForeignKey, so a save write only them instead
+of the whole row:
+
+    contact.customer = other
+    contact.surname = "renamed"
+    save_changed(contact)  # UPDATE ... SET company_code = ..., surname = ... (only the ones which changed)
+
+    bulk_update_changed(contacts)  # one UPDATE per batch, with the columns changed in this batch
+
+the values of the columns are kept when the instance is loaded or saved, so a column set back to its previous value
+is not changed anymore. an assignment of a relation also record the original values of its local columns, even the
+deferred ones.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.apps import apps
+from django.db import router
+from django.db.models import F, Value
+from django.db.models.expressions import Case, When
+from django.db.models.signals import class_prepared, post_init, post_save
+
+from compositefk.query import CompositeQuerySet
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# the values of the concrete columns when the instance was loaded or saved, by attname
+LOADED_ATTR = "_compositefk_loaded"
+# the original values of the attnames assigned by a relation, by attname
+CHANGED_ATTR = "_compositefk_changed"
+# the original value of a column deferred, or not set yet by the constructor : it is always changed
+UNKNOWN = object()
+
+
+def register(model):
+    """
+    track the changes of the instances of model
+    """
+    if model._meta.abstract or model._meta.apps is not apps:
+        # the models rendered by the migrations don't save anything
+        return
+    post_init.connect(snapshot_values, sender=model, dispatch_uid="compositefk.dirty.snapshot_values")
+    post_save.connect(clear_changes, sender=model, dispatch_uid="compositefk.dirty.clear_changes")
+
+
+def register_inherited(sender, **kwargs):
+    """
+    the proxies and the children of a model having a CompositeForeignKey send their own signals
+    """
+    from compositefk.fields import CompositeForeignKey  # fields import the descriptors, which import this module
+
+    if any(isinstance(field, CompositeForeignKey) for field in sender._meta.fields):
+        register(sender)
+
+
+def snapshot_values(sender, instance, **kwargs):
+    d = instance.__dict__
+    d[LOADED_ATTR] = {
+        field.attname: d[field.attname] for field in sender._meta.concrete_fields
+        if not field.primary_key and field.attname in d
+    }
+
+
+def get_local_values(field, instance):
+    """
+    :return: the values of the local columns of the field, without loading the deferred ones
+    """
+    return [instance.__dict__.get(f.attname, UNKNOWN) for f in field.local_related_fields]
+
+
+def record_changes(field, instance, previous_values):
+    """
+    remember the original values of the local columns of the field, before their assignment by its descriptor
+    """
+    originals = instance.__dict__.setdefault(CHANGED_ATTR, {})
+    for f, value in zip(field.local_related_fields, previous_values):
+        originals.setdefault(f.attname, value)
+
+
+def get_changed_fields(instance):
+    """
+    :return: the attnames of the columns whose value changed since the instance was loaded or saved
+    :rtype: list[str]
+    """
+    d = instance.__dict__
+    originals = dict(d.get(LOADED_ATTR, {}))
+    originals.update(d.get(CHANGED_ATTR, {}))
+    # a column deferred, and not assigned, is not changed
+    return sorted(attname for attname, value in originals.items() if d.get(attname, value) != value)
+
+
+def get_update_fields(instance):
+    """
+    :return: the update_fields which save the changes of the instance : the changed columns and the mirrored
+        columns of the relations they belong to
+    :rtype: list[str]
+    """
+    from compositefk.fields import CompositeForeignKey  # fields import the descriptors, which import this module
+
+    changed = get_changed_fields(instance)
+    update_fields = set(changed)
+    for field in instance._meta.get_fields():
+        if isinstance(field, CompositeForeignKey) and field.mirror_fields and any(
+            f.attname in changed for f in field.local_related_fields
+        ):
+            update_fields.update(field.mirror_fields)
+    return sorted(update_fields)
+
+
+def save_changed(instance, update_fields=(), **kwargs):
+    """
+    save the changed columns of the instance (see get_update_fields), and the given update_fields.
+    a new instance is saved whole.
+    """
+    if instance._state.adding or instance.pk is None:
+        instance.save(**kwargs)
+    else:
+        instance.save(update_fields=set(get_update_fields(instance)) | set(update_fields), **kwargs)
+
+
+def clear_changes(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None:
+        instance.__dict__.pop(CHANGED_ATTR, None)
+        snapshot_values(sender, instance)
+    else:
+        # the changes of the columns not saved are still to save
+        forget_changes(instance, [sender._meta.get_field(name).attname for name in update_fields])
+
+
+def forget_changes(instance, attnames):
+    """
+    forget the changes of the given attnames, written in the database by other means than a save
+    """
+    d = instance.__dict__
+    originals = d.get(CHANGED_ATTR, {})
+    loaded = d.get(LOADED_ATTR)
+    for attname in attnames:
+        originals.pop(attname, None)
+        if loaded is not None and attname in d:
+            loaded[attname] = d[attname]
+
+
+def bulk_update_changed(objs, batch_size=1000, using=None):
+    """
+    save the changed columns of the instances (all of the same model) with one UPDATE per batch of batch_size
+    instances, which set the columns changed by at least one of them : a CASE on the primary key give the value of
+    each instance, the others keep theirs. the mirrored columns are refreshed as by CompositeQuerySet.update().
+    no signal is sent.
+    :return: the number of updated rows
+    """
+    objs = [obj for obj in objs if get_changed_fields(obj)]
+    if not objs:
+        return 0
+    model = type(objs[0])
+    using = using or router.db_for_write(model, instance=objs[0])
+    rows = 0
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        changes = [(obj, get_changed_fields(obj)) for obj in batch]
+        attnames = sorted(set(attname for obj, changed in changes for attname in changed))
+        values = {}
+        for attname in attnames:
+            field = model._meta.get_field(attname)
+            values[attname] = Case(*[
+                When(pk=obj.pk, then=Value(getattr(obj, attname), output_field=field))
+                for obj, changed in changes if attname in changed
+            ], default=F(attname), output_field=field)
+        queryset = CompositeQuerySet(model=model, using=using)
+        rows += queryset.filter(pk__in=[obj.pk for obj in batch]).update(**values)
+        for obj in batch:
+            clear_changes(model, obj)
+    return rows
+
+
+class_prepared.connect(register_inherited, dispatch_uid="compositefk.dirty.register_inherited")
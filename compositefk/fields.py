@@ -7,14 +7,21 @@ import logging
 from collections import OrderedDict
 from functools import wraps
 
+from django.apps import apps
 from django.core import checks
 from django.core.exceptions import FieldDoesNotExist
 from django.db.models.fields.related import ForeignObject
-from django.db.models.fields.related_descriptors import ReverseOneToOneDescriptor
 from django.db.models.sql.where import WhereNode, AND
 from django.utils.translation import ugettext_lazy as _
 
-from compositefk.related_descriptors import CompositeForwardManyToOneDescriptor
+from compositefk import cascade, dirty, mirroring, routing
+from compositefk.indexes import get_field_index
+from compositefk.lookups import CompositeRelatedIn, ExcludedValue
+from compositefk.related_descriptors import (
+    CompositeForwardManyToOneDescriptor,
+    CompositeReverseManyToOneDescriptor,
+    CompositeReverseOneToOneDescriptor,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -23,6 +30,12 @@ __author__ = 'darius.bernard'
 
 class CompositeForeignKey(ForeignObject):
     requires_unique_target = False
+    related_accessor_class = CompositeReverseManyToOneDescriptor
+
+    # the error of compositefk.validation, the same as ForeignKey
+    default_error_messages = {
+        'invalid': _('%(model)s instance with %(field)s %(value)r does not exist.'),
+    }
 
     def __init__(self, to, **kwargs):
         """
@@ -34,6 +47,19 @@ class CompositeForeignKey(ForeignObject):
         if not isinstance(nullable_fields, dict):
             nullable_fields = {v: None for v in nullable_fields}
         self.nullable_fields = nullable_fields
+        # local field name => remote field name : the local columns which hold a copy of the remote ones
+        self.mirror_fields = dict(kwargs.pop("mirror_fields", {}))
+        # the concurrent lazy loads of the same related object by several threads share one query
+        self.thread_safe = kwargs.pop("thread_safe", False)
+        # the first lazy load load the relation of all the instances of the same evaluation (see
+        # compositefk.siblings)
+        self.auto_prefetch = kwargs.pop("auto_prefetch", False)
+        # the related object is a CompositeKeyProxy until an attribute out of the key is read
+        self.key_proxy = kwargs.pop("key_proxy", False)
+        # index the local columns, without the rows in null_if_equal (see compositefk.indexes)
+        self.partial_index = kwargs.pop("partial_index", False)
+        # cascade.CASCADE : the dependents follow the changes of the key of their related object
+        self.on_update = kwargs.pop("on_update", None)
 
         # a list of tuple : (fieldnaem, value) . if fielname = value, then the field react as if fieldnaem_id = None
         self._raw_fields = self.compute_to_fields(to_fields)
@@ -65,87 +91,126 @@ class CompositeForeignKey(ForeignObject):
 
         return wrapper
 
+    @property
+    def resolved_fields(self):
+        """
+        the model fields used by this CompositeForeignKey, resolved only once the app registry is ready
+        and shared by the checks and the joins.
+        :rtype: ResolvedFields
+        """
+        resolved = self.__dict__.get("_resolved_fields")
+        if resolved is None:
+            resolved = ResolvedFields(self)
+            if self.model._meta.apps.ready:
+                self._resolved_fields = resolved
+        return resolved
+
     def check(self, **kwargs):
         errors = super(CompositeForeignKey, self).check(**kwargs)
+        resolved = self.resolved_fields
         errors.extend(self._check_null_with_nullifequal())
-        errors.extend(self._check_nullifequal_fields_exists())
-        errors.extend(self._check_to_fields_local_valide())
-        errors.extend(self._check_to_fields_remote_valide())
-        errors.extend(self._check_recursion_field_dependecy())
-        errors.extend(self._check_bad_order_fields())
+        errors.extend(self._check_nullifequal_fields_exists(resolved))
+        errors.extend(self._check_to_fields_local_valide(resolved))
+        errors.extend(self._check_to_fields_remote_valide(resolved))
+        errors.extend(self._check_recursion_field_dependecy(resolved))
+        errors.extend(self._check_bad_order_fields(resolved))
+        errors.extend(self._check_mirror_fields())
+        errors.extend(self._check_on_update())
         return errors
 
-    def _check_bad_order_fields(self):
-        res = []
-        try:
-            dependents = list(self.local_related_fields)
-        except FieldDoesNotExist:
-            return []  # the errors shall be raised befor by _check_recursion_field_dependecy
+    def _check_on_update(self):
+        if self.on_update not in (None, cascade.CASCADE):
+            return [
+                checks.Error(
+                    "on_update of %s must be None or %r" % (self.name, cascade.CASCADE),
+                    hint=None,
+                    obj=self,
+                    id='compositefk.E009',
+                )
+            ]
+        return []
 
-        for field in self.model._meta.get_fields():
-            try:
-                dependents.remove(field)
-            except ValueError:
-                pass
-            if field == self:
-                if dependents:
-                    # we met the current fields, but all dependent fields is not
-                    # passed befor : we will have a problem in the init of some objects
-                    # where the rest of dependents fields will override the
-                    # values set by the current one (see Model.__init__)
+    def _check_mirror_fields(self):
+        res = []
+        for local_name, remote_name in self.mirror_fields.items():
+            for model, name in ((self.model, local_name), (self.related_model, remote_name)):
+                if ResolvedFields._get_field(model, name) is None:
                     res.append(
                         checks.Error(
-                            "the field %s depend on the fields %s which is defined after. define them befor %s" %
-                            (self.name, ",".join(f.name for f in dependents), self.name),
+                            "the mirrored field %s does not exists on the model %s" % (name, model),
                             hint=None,
                             obj=self,
-                            id='compositefk.E006',
-                        ))
-                break
+                            id='compositefk.E007',
+                        )
+                    )
+        local_keys = set(part.value for part in self._raw_fields.values() if part.is_local_field)
+        for local_name in sorted(local_keys & set(self.mirror_fields)):
+            res.append(
+                checks.Error(
+                    "the field %s is a part of the key of %s and can't be mirrored" % (local_name, self.name),
+                    hint=None,
+                    obj=self,
+                    id='compositefk.E008',
+                )
+            )
         return res
 
-    def _check_recursion_field_dependecy(self):
+    def _check_bad_order_fields(self, resolved):
+        dependents = [resolved.local[part.value] for part in self._raw_fields.values() if part.is_local_field]
+        if None in dependents:
+            return []  # the errors shall be raised befor by _check_to_fields_local_valide
+
+        # the fields are initialized in the order of their creation (see Model.__init__)
+        dependents = [field for field in dependents if field.creation_counter > self.creation_counter]
+        if dependents:
+            # all dependent fields is not defined befor the current one:
+            # we will have a problem in the init of some objects
+            # where the rest of dependents fields will override the
+            # values set by the current one (see Model.__init__)
+            return [
+                checks.Error(
+                    "the field %s depend on the fields %s which is defined after. define them befor %s" %
+                    (self.name, ",".join(f.name for f in dependents), self.name),
+                    hint=None,
+                    obj=self,
+                    id='compositefk.E006',
+                )
+            ]
+        return []
+
+    def _check_recursion_field_dependecy(self, resolved):
         res = []
         for local_field in self._raw_fields.values():
-            try:
-                f = self.model._meta.get_field(local_field.value)
-                if isinstance(f, CompositeForeignKey):
-                    res.append(
-                        checks.Error(
-                            "the field %s depend on the field %s which is another CompositeForeignKey" %
-                            (self.name, local_field),
-                            hint=None,
-                            obj=self,
-                            id='compositefk.E005',
-                        )
+            if local_field.is_local_field and isinstance(resolved.local[local_field.value], CompositeForeignKey):
+                res.append(
+                    checks.Error(
+                        "the field %s depend on the field %s which is another CompositeForeignKey" %
+                        (self.name, local_field),
+                        hint=None,
+                        obj=self,
+                        id='compositefk.E005',
                     )
-            except FieldDoesNotExist:
-                pass  # _check_to_fields_local_valide already raise errors for this
+                )
         return res
 
-    def _check_to_fields_local_valide(self):
+    def _check_to_fields_local_valide(self, resolved):
         res = []
         for local_field in self._raw_fields.values():
-            if isinstance(local_field, LocalFieldValue):
-                try:
-                    self.model._meta.get_field(local_field.value)
-                except FieldDoesNotExist:
-                    res.append(
-                        checks.Error(
-                            "the field %s does not exists on the model %s" % (local_field, self.model),
-                            hint=None,
-                            obj=self,
-                            id='compositefk.E003',
-                        )
+            if isinstance(local_field, LocalFieldValue) and resolved.local[local_field.value] is None:
+                res.append(
+                    checks.Error(
+                        "the field %s does not exists on the model %s" % (local_field, self.model),
+                        hint=None,
+                        obj=self,
+                        id='compositefk.E003',
                     )
+                )
         return res
 
-    def _check_to_fields_remote_valide(self):
+    def _check_to_fields_remote_valide(self, resolved):
         res = []
-        for remote_field in self._raw_fields.keys():
-            try:
-                self.related_model._meta.get_field(remote_field)
-            except FieldDoesNotExist:
+        for remote_field, field in resolved.remote.items():
+            if field is None:
                 res.append(
                     checks.Error(
                         "the field %s does not exists on the model %s" % (remote_field, self.model),
@@ -169,12 +234,10 @@ class CompositeForeignKey(ForeignObject):
             ]
         return []
 
-    def _check_nullifequal_fields_exists(self):
+    def _check_nullifequal_fields_exists(self, resolved):
         res = []
         for field_name, value in self.null_if_equal:
-            try:
-                self.model._meta.get_field(field_name)
-            except FieldDoesNotExist:
+            if resolved.local[field_name] is None:
                 res.append(
                     checks.Error(
                         "the field %s does not exists on the model %s" % (field_name, self.model),
@@ -192,6 +255,18 @@ class CompositeForeignKey(ForeignObject):
             kwargs["on_delete"] = kwargs["on_delete"]._original_fn
         kwargs["to_fields"] = self._raw_fields
         kwargs["null_if_equal"] = self.null_if_equal
+        if self.mirror_fields:
+            kwargs["mirror_fields"] = self.mirror_fields
+        if self.thread_safe:
+            kwargs["thread_safe"] = True
+        if self.auto_prefetch:
+            kwargs["auto_prefetch"] = True
+        if self.key_proxy:
+            kwargs["key_proxy"] = True
+        if self.partial_index:
+            kwargs["partial_index"] = True
+        if self.on_update is not None:
+            kwargs["on_update"] = self.on_update
         return name, path, args, kwargs
 
     def get_extra_descriptor_filter(self, instance):
@@ -200,12 +275,28 @@ class CompositeForeignKey(ForeignObject):
             if isinstance(v, RawFieldValue)
         }
 
+    def get_null_exclusion(self, alias):
+        """
+        the condition on the local table (with the given alias) which exclude the rows whose values are in
+        null_if_equal : the predicate of the partial index, given to the joins and the lookups so the database
+        can use it.
+        :rtype: WhereNode
+        """
+        constraint = WhereNode(connector=AND)
+        for field_name, exception_value in self.null_if_equal:
+            field = self.model._meta.get_field(field_name)
+            constraint.add(ExcludedValue(field.get_col(alias), exception_value), AND)
+        return constraint
+
     def get_extra_restriction(self, where_class, alias, related_alias):
         constraint = WhereNode(connector=AND)
+        remote_fields = self.resolved_fields.remote
         for remote, local in self._raw_fields.items():
-            lookup = local.get_lookup(self, self.related_model._meta.get_field(remote), alias)
+            lookup = local.get_lookup(self, remote_fields[remote], alias)
             if lookup:
                 constraint.add(lookup, AND)
+        if self.partial_index and self.null_if_equal and related_alias is not None:
+            constraint.add(self.get_null_exclusion(related_alias), AND)
         if constraint.children:
             return constraint
         else:
@@ -237,6 +328,27 @@ class CompositeForeignKey(ForeignObject):
     def contribute_to_class(self, cls, name, **kwargs):
         super(ForeignObject, self).contribute_to_class(cls, name, **kwargs)
         setattr(cls, self.name, CompositeForwardManyToOneDescriptor(self))
+        # the field may be added to a model already prepared
+        dirty.register(cls)
+        if self.partial_index:
+            index = get_field_index(self)
+            # the models rendered by the migrations already have it in their Meta.indexes
+            if not any(index.is_same(other) for other in cls._meta.indexes):
+                # named by the model once its fields are added. the migrations read the indexes
+                # declared in the Meta only
+                cls._meta.indexes = list(cls._meta.indexes) + [index]
+                cls._meta.original_attrs["indexes"] = cls._meta.indexes
+
+    def contribute_to_related_class(self, cls, related):
+        super(CompositeForeignKey, self).contribute_to_related_class(cls, related)
+        # the relation read both models : the forward one the related model, the reverse one the model of the field
+        routing.register(cls)
+        routing.register(self.model)
+        # the models rendered by the migrations don't save anything
+        if self.mirror_fields and self.model._meta.apps is apps:
+            mirroring.register(self, cls)
+        if self.on_update == cascade.CASCADE and self.model._meta.apps is apps:
+            cascade.register(self, cls)
 
     def get_instance_value_for_fields(self, instance, fields):
         # we override this method to provide the feathur of converting
@@ -245,17 +357,40 @@ class CompositeForeignKey(ForeignObject):
         # ie, if company is '   ' and it mean that the current field
         # point to nothing (as if it was None) => we transform this
         # '   ' into a true None to let django das as if it was None
-        res = super(CompositeForeignKey, self).get_instance_value_for_fields(instance, fields)
-        if self.null_if_equal:
+        res = CompositeKey(super(CompositeForeignKey, self).get_instance_value_for_fields(instance, fields))
+        # the special values only exists on the local side (the remote values are
+        # asked by the prefetch to match the related objects)
+        if self.null_if_equal and tuple(fields) == tuple(self.local_related_fields):
             for field_name, exception_value in self.null_if_equal:
                 val = getattr(instance, field_name)
                 if val == exception_value:
                     # we have field_name that is equal to the bad value
                     # currently, it is enouth since the django implementation check at first
                     # if there is a None in the result
-                    return (None,)
+                    return CompositeKey((None,))
         return res
 
+    def get_remote_key(self, instance, intern=False):
+        """
+        evaluate the full key of the related object for the given instance, in the order of to_fields :
+        the local values and the raw values (a FunctionBasedFieldValue is called).
+        :param bool intern: return the shared CompositeKey for this key (see CompositeKey.intern)
+        :return: the key, or None if the instance point to nothing
+        :rtype: CompositeKey
+        """
+        local_values = self.get_local_related_value(instance)
+        if None in local_values:
+            return None
+        local_values = iter(local_values)
+        values = tuple(
+            next(local_values) if part.is_local_field else part.value
+            for part in self._raw_fields.values()
+        )
+        return CompositeKey.intern(values) if intern else CompositeKey(values)
+
+
+CompositeForeignKey.register_lookup(CompositeRelatedIn)
+
 
 class CompositeOneToOneField(CompositeForeignKey):
     # Field flags
@@ -264,7 +399,7 @@ class CompositeOneToOneField(CompositeForeignKey):
     one_to_many = False
     one_to_one = True
 
-    related_accessor_class = ReverseOneToOneDescriptor
+    related_accessor_class = CompositeReverseOneToOneDescriptor
 
     description = _("One-to-one relationship")
 
@@ -280,11 +415,93 @@ class CompositeOneToOneField(CompositeForeignKey):
         return name, path, args, kwargs
 
 
+class ResolvedFields(object):
+    """
+    the fields of both models used by a CompositeForeignKey, resolved in one pass.
+    local map the local names (to_fields values and null_if_equal) to their field, remote map the
+    to_fields keys to the field of the related model. a missing field is None.
+    """
+
+    def __init__(self, composite_field):
+        local_names = [part.value for part in composite_field._raw_fields.values() if part.is_local_field]
+        local_names.extend(field_name for field_name, _value in composite_field.null_if_equal)
+        self.local = OrderedDict(
+            (name, self._get_field(composite_field.model, name)) for name in local_names
+        )
+        self.remote = OrderedDict(
+            (name, self._get_field(composite_field.related_model, name)) for name in composite_field._raw_fields
+        )
+
+    @staticmethod
+    def _get_field(model, name):
+        try:
+            return model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+
+class CompositeKey(tuple):
+    """
+    an evaluated composite key: the values of the parts of a CompositeForeignKey.
+    it is a plain tuple (same hash and equality), without any per instance overhead.
+    the repeated keys can be interned to share one object between many instances.
+    """
+    __slots__ = ()
+
+    max_interned = 100000
+    _interned = {}
+
+    def __new__(cls, values=()):
+        return super(CompositeKey, cls).__new__(cls, values)
+
+    def __repr__(self):
+        return "%s%s" % (self.__class__.__name__, tuple.__repr__(self))
+
+    @classmethod
+    def intern(cls, values):
+        """
+        return the shared CompositeKey equal to the given values
+        """
+        key = values if type(values) is cls else cls(values)
+        try:
+            return cls._interned[key]
+        except KeyError:
+            if len(cls._interned) >= cls.max_interned:
+                cls._interned.clear()
+            return cls._interned.setdefault(key, key)
+
+    @classmethod
+    def clear_interned(cls):
+        cls._interned.clear()
+
+
 class CompositePart(object):
+    """
+    immutable description of one part of a CompositeForeignKey
+    """
+    __slots__ = ("_value",)
     is_local_field = True
 
     def __init__(self, value):
-        self.value = value
+        object.__setattr__(self, "_value", value)
+
+    def __setattr__(self, name, value):
+        if name == "_value":
+            raise AttributeError("the value of %s is read-only" % self.__class__.__name__)
+        super(CompositePart, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if name == "_value":
+            raise AttributeError("the value of %s is read-only" % self.__class__.__name__)
+        super(CompositePart, self).__delattr__(name)
+
+    def __reduce__(self):
+        # copy and pickle would set _value back with setattr : they build a new part from its arguments
+        return self.__class__, self.deconstruct()[1]
+
+    @property
+    def value(self):
+        return self._value
 
     def deconstruct(self):
         module_name = self.__module__
@@ -298,10 +515,19 @@ class CompositePart(object):
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.value)
 
+    def _identity(self):
+        return self._value
+
     def __eq__(self, other):
         if self.__class__ != other.__class__:
             return False
-        return self.value == other.value
+        return self._identity() == other._identity()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__, self._identity()))
 
     def get_lookup(self, main_field, for_remote, alias):
         """
@@ -316,6 +542,7 @@ class RawFieldValue(CompositePart):
     """
     represent a raw value for  a field.
     """
+    __slots__ = ()
     is_local_field = False
 
     def get_lookup(self, main_field, for_remote, alias):
@@ -330,6 +557,8 @@ class RawFieldValue(CompositePart):
 
 
 class FunctionBasedFieldValue(RawFieldValue):
+    __slots__ = ("_func",)
+
     def __init__(self, func):
         self._func = func
 
@@ -342,22 +571,17 @@ class FunctionBasedFieldValue(RawFieldValue):
             {}
         )
 
-    def __eq__(self, other):
-        if self.__class__ != other.__class__:
-            return False
-        return self._func == other._func
+    def _identity(self):
+        return self._func
 
     @property
     def value(self):
         return self._func()
 
-    @value.setter
-    def value(self):
-        pass
-
 
 class LocalFieldValue(CompositePart):
     """
     implicitly used, represent the value of a local field
     """
+    __slots__ = ()
     is_local_field = True
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+the partial index of the local columns of a CompositeForeignKey(partial_index=True) : the rows whose values are
+in null_if_equal point to nothing, they are left out of the index so the joins don't scan them.
+
+the index is added to the Meta.indexes of the model by the field, and so created by the migrations.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.apps import apps
+from django.core import checks
+from django.db import connections, router
+from django.db.models import Index
+from django.utils import six
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# the backends which support CREATE INDEX ... WHERE ...
+PARTIAL_INDEX_VENDORS = ("postgresql", "sqlite")
+
+
+def get_exclude_sql(column, value, quote_value):
+    """
+    :return: the condition of the index which exclude value from the column. a DDL statement has no parameter : the
+        value is written in the sql
+    """
+    if value is None:
+        return "%s IS NOT NULL" % column
+    return "%s <> %s" % (column, quote_value(value))
+
+
+class CompositePartialIndex(Index):
+    """
+    an index which exclude the rows having one of the given values (a list of (field name, value), as
+    null_if_equal). on a backend without partial index, it is a normal index.
+    """
+    # the name is made of 27 chars + the suffix
+    suffix = "pix"
+
+    def __init__(self, **kwargs):
+        self.exclude = [tuple(exclude) for exclude in kwargs.pop("exclude", ())]
+        super(CompositePartialIndex, self).__init__(**kwargs)
+
+    def deconstruct(self):
+        path, args, kwargs = super(CompositePartialIndex, self).deconstruct()
+        kwargs["exclude"] = self.exclude
+        return path, args, kwargs
+
+    def get_condition_sql(self, model, schema_editor):
+        if schema_editor.connection.vendor not in PARTIAL_INDEX_VENDORS:
+            return ""
+        return " AND ".join(
+            get_exclude_sql(
+                schema_editor.quote_name(model._meta.get_field(field_name).column), value, schema_editor.quote_value,
+            )
+            for field_name, value in self.exclude
+        )
+
+    def create_sql(self, model, schema_editor, using=''):
+        sql = super(CompositePartialIndex, self).create_sql(model, schema_editor, using=using)
+        condition = self.get_condition_sql(model, schema_editor)
+        if not condition:
+            return sql
+        if isinstance(sql, six.string_types):  # django < 2.0
+            return "%s WHERE %s" % (sql, condition)
+        # a Statement, whose parts are renamed with the table and columns
+        sql.template += " WHERE %(condition)s"
+        sql.parts["condition"] = condition
+        return sql
+
+    def is_same(self, other):
+        """
+        :return: True if other index the same rows, whatever their names
+        """
+        return isinstance(other, CompositePartialIndex) and (other.fields, other.exclude) == (
+            self.fields, self.exclude
+        )
+
+
+def get_field_index(field):
+    """
+    :return: the partial index of the local columns of the field (unnamed)
+    :rtype: CompositePartialIndex
+    """
+    fields = [part.value for part in field._raw_fields.values() if part.is_local_field]
+    return CompositePartialIndex(fields=fields, exclude=field.null_if_equal)
+
+
+@checks.register(checks.Tags.database)
+def check_partial_indexes(app_configs=None, **kwargs):
+    """
+    warn about the partial indexes of the CompositeForeignKey missing in the databases (ie: the migration adding
+    them is not applied)
+    """
+    from compositefk.fields import CompositeForeignKey  # fields import this module
+
+    if app_configs is None:
+        models = apps.get_models()
+    else:
+        models = [model for app_config in app_configs for model in app_config.get_models()]
+    errors = []
+    for model in models:
+        expected = [
+            get_field_index(field) for field in model._meta.local_fields
+            if isinstance(field, CompositeForeignKey) and field.partial_index
+        ]
+        indexes = [index for index in model._meta.indexes if any(e.is_same(index) for e in expected)]
+        if not indexes:
+            continue
+        for alias in connections:
+            if not router.allow_migrate_model(alias, model):
+                continue
+            connection = connections[alias]
+            with connection.cursor() as cursor:
+                if model._meta.db_table not in connection.introspection.table_names(cursor):
+                    # the migration creating the table will create the index
+                    continue
+                constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            for index in indexes:
+                if index.name not in constraints:
+                    errors.append(checks.Warning(
+                        "the partial index %s of %s is missing in the database %s" % (
+                            index.name, model._meta.label, alias,
+                        ),
+                        hint="make and apply the migration which add it",
+                        obj=model,
+                        id="compositefk.W001",
+                    ))
+    return errors
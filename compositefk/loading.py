@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bulk loading of deserialized objects : one bulk_create per model, in the order of their relations.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+from collections import OrderedDict
+
+from django.db import DEFAULT_DB_ALIAS
+
+from compositefk.fields import CompositeForeignKey
+from compositefk.query import filter_by_keys
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+def sort_models(models):
+    """
+    sort the models so each one come after the models it point to, via a ForeignKey or a CompositeForeignKey.
+    the models of a cycle are kept in their given order.
+    :param list models: the models to sort
+    :rtype: list
+    """
+    models = list(models)
+    dependencies = {
+        model: set(
+            field.related_model for field in model._meta.fields
+            if field.is_relation and field.related_model in models and field.related_model is not model
+        )
+        for model in models
+    }
+    ordered = []
+    while models:
+        ready = [model for model in models if not (dependencies[model] - set(ordered))]
+        if not ready:
+            # a cycle : let the database check the constraints at the end of the transaction
+            ready = models[:1]
+        ordered.extend(ready)
+        models = [model for model in models if model not in ready]
+    return ordered
+
+
+def find_missing_keys(field, keys, using=DEFAULT_DB_ALIAS, batch_size=1000):
+    """
+    search the given keys of the local values of the CompositeForeignKey which point to nothing in the database,
+    with one query per batch of batch_size distinct keys. the keys with a None are ignored.
+    :rtype: set[tuple]
+    """
+    keys = [key for key in set(keys) if None not in key]
+    queryset = field.related_model._base_manager.db_manager(using).filter(
+        **field.get_extra_descriptor_filter(None)
+    )
+    attnames = [f.attname for f in field.foreign_related_fields]
+    found = set()
+    for start in range(0, len(keys), batch_size):
+        found.update(
+            filter_by_keys(queryset, field.foreign_related_fields, keys[start:start + batch_size])
+            .values_list(*attnames)
+        )
+    return set(keys) - found
+
+
+def find_missing_references(model, instances, using=DEFAULT_DB_ALIAS, batch_size=1000):
+    """
+    search the keys of the CompositeForeignKey of the instances which point to nothing in the database,
+    with one query per field and per batch of batch_size distinct keys.
+    :return: the missing keys of each field which has some
+    :rtype: dict[CompositeForeignKey, set[tuple]]
+    """
+    missing = {}
+    for field in model._meta.fields:
+        if not isinstance(field, CompositeForeignKey):
+            continue
+        keys = [field.get_local_related_value(instance) for instance in instances]
+        field_missing = find_missing_keys(field, keys, using=using, batch_size=batch_size)
+        if field_missing:
+            missing[field] = field_missing
+    return missing
+
+
+def load_model_objects(model, objects, using=DEFAULT_DB_ALIAS, batch_size=1000):
+    """
+    save the deserialized objects of one model : the new rows are inserted with bulk_create, without signals.
+    the existing rows (by pk), the objects with many to many values but no pk, and the models with parents
+    can't be bulk inserted and are saved one by one, as loaddata does.
+    """
+    manager = model._base_manager.db_manager(using)
+    pks = [obj.object.pk for obj in objects if obj.object.pk is not None]
+    existing = set()
+    for start in range(0, len(pks), batch_size):
+        existing.update(manager.filter(pk__in=pks[start:start + batch_size]).values_list("pk", flat=True))
+
+    inserted, saved = [], []
+    for obj in objects:
+        pk = obj.object.pk
+        if model._meta.parents or pk in existing or (pk is None and obj.m2m_data):
+            saved.append(obj)
+        else:
+            inserted.append(obj)
+    manager.bulk_create([obj.object for obj in inserted], batch_size=batch_size)
+    for obj in inserted:
+        obj.object._state.adding = False
+        obj.object._state.db = using
+        for accessor_name, object_list in (obj.m2m_data or {}).items():
+            getattr(obj.object, accessor_name).set(object_list)
+    for obj in saved:
+        obj.save(using=using)
+
+
+def bulk_load(objects, using=DEFAULT_DB_ALIAS, batch_size=1000):
+    """
+    save the given deserialized objects grouped by model, the models being saved in the order of their
+    relations (see sort_models).
+    :param objects: the DeserializedObject given by django.core.serializers.deserialize
+    :return: the number of objects saved for each model
+    :rtype: dict
+    """
+    grouped = OrderedDict()
+    for obj in objects:
+        grouped.setdefault(type(obj.object), []).append(obj)
+    for model in sort_models(grouped):
+        load_model_objects(model, grouped[model], using=using, batch_size=batch_size)
+    return OrderedDict((model, len(model_objects)) for model, model_objects in grouped.items())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+the lookups of the CompositeForeignKey
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.core.exceptions import EmptyResultSet
+from django.db.models.fields.reverse_related import ForeignObjectRel
+from django.db.models.fields.related_lookups import MultiColSource, RelatedIn, get_normalized_value
+from django.db.models.lookups import Lookup
+from django.db.models.sql.where import AND, WhereNode
+
+from compositefk.query import get_keys_condition
+from compositefk.related_descriptors import get_reverse_instance_attr
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class CompositeRelatedIn(RelatedIn):
+    """
+    the __in of a CompositeForeignKey on related objects, as done by the deletion collector for each relation
+    pointing to the deleted objects.
+    the join on the related table is trimmed by django, and its condition on the RawFieldValue with it : the
+    related objects which can't match them (ie: the address of a customer for Supplier.address) are removed
+    before the query, and the query isn't run at all if none is left.
+    the keys left are matched once each, by a balanced tree of OR (see get_keys_condition) : the flat one of
+    django is too deep for sqlite with a batch of the size given by the collector.
+    """
+
+    def get_prep_lookup(self):
+        field = self.lhs.output_field
+        # the reverse relation (Address.objects.filter(customer__in=...)) has no RawFieldValue to check
+        is_forward = not isinstance(field, ForeignObjectRel)
+        if is_forward and self.rhs_is_direct_value() and field.get_extra_descriptor_filter(None):
+            instance_attr = get_reverse_instance_attr(field)
+            self.rhs = [
+                value for value in self.rhs
+                if not isinstance(value, field.related_model) or instance_attr(value) is not None
+            ]
+        return super(CompositeRelatedIn, self).get_prep_lookup()
+
+    def as_sql(self, compiler, connection):
+        if not isinstance(self.lhs, MultiColSource) or not self.rhs_is_direct_value():
+            return super(CompositeRelatedIn, self).as_sql(compiler, connection)
+        # django give an empty condition (match all) for an empty list of keys on several columns
+        keys = set(get_normalized_value(value, self.lhs) for value in self.rhs)
+        keys = [key for key in keys if None not in key]
+        if not keys:
+            raise EmptyResultSet
+        condition = get_keys_condition(self.lhs.targets, keys, self.lhs.alias)
+        field = self.lhs.output_field
+        if not isinstance(field, ForeignObjectRel) and field.partial_index and field.null_if_equal:
+            # the predicate of the partial index
+            condition = WhereNode([condition, field.get_null_exclusion(self.lhs.alias)], connector=AND)
+        return compiler.compile(condition)
+
+
+class ExcludedValue(Lookup):
+    """
+    the column is not the value (nor null if it is None), with the operators of the condition of the partial index
+    of a CompositeForeignKey (see indexes.get_exclude_sql). the value stay a parameter of the query. not registered :
+    built by CompositeForeignKey.get_null_exclusion.
+    """
+    lookup_name = "compositefk_excluded"
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, params = self.process_lhs(compiler, connection)
+        if self.rhs is None:
+            return "%s IS NOT NULL" % lhs_sql, params
+        return "%s <> %%s" % lhs_sql, params + [self.rhs]
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import os
+import warnings
+
+from django.core import serializers
+from django.core.management.base import CommandError
+from django.core.management.commands import loaddata
+from django.db import DatabaseError, IntegrityError, router
+
+from compositefk.loading import bulk_load, find_missing_references
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class Command(loaddata.Command):
+    help = (
+        "Installs the named fixture(s) in the database like loaddata, but insert each model with bulk_create "
+        "(without signals), the models being loaded in the order of their relations."
+    )
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--check-references', action='store_true',
+            help="warn about the CompositeForeignKey pointing to nothing once loaded",
+        )
+
+    def handle(self, *fixture_labels, **options):
+        self.batch_size = options["batch_size"]
+        self.check_references = options["check_references"]
+        return super(Command, self).handle(*fixture_labels, **options)
+
+    def load_label(self, fixture_label):
+        """
+        Loads fixtures files for a given label.
+        """
+        for fixture_file, fixture_dir, fixture_name in self.find_fixtures(fixture_label):
+            _, ser_fmt, cmp_fmt = self.parse_name(os.path.basename(fixture_file))
+            open_method, mode = self.compression_formats[cmp_fmt]
+            fixture = open_method(fixture_file, mode)
+            try:
+                self.fixture_count += 1
+                if self.verbosity >= 2:
+                    self.stdout.write("Installing %s fixture '%s' (bulk)." % (ser_fmt, fixture_name))
+
+                objects_in_fixture = 0
+                loaded = []
+                for obj in serializers.deserialize(ser_fmt, fixture, using=self.using, ignorenonexistent=self.ignore):
+                    objects_in_fixture += 1
+                    model = type(obj.object)
+                    if model._meta.app_config in self.excluded_apps or model in self.excluded_models:
+                        continue
+                    if router.allow_migrate_model(self.using, model):
+                        self.models.add(model)
+                        loaded.append(obj)
+                try:
+                    bulk_load(loaded, using=self.using, batch_size=self.batch_size)
+                except (DatabaseError, IntegrityError) as e:
+                    e.args = ("Could not load %s: %s" % (fixture_name, e),)
+                    raise
+                if self.check_references:
+                    self.warn_missing_references(loaded)
+                self.loaded_object_count += len(loaded)
+                self.fixture_object_count += objects_in_fixture
+            except Exception as e:
+                if not isinstance(e, CommandError):
+                    e.args = ("Problem installing fixture '%s': %s" % (fixture_file, e),)
+                raise
+            finally:
+                fixture.close()
+
+            # Warn if the fixture we loaded contains 0 objects.
+            if objects_in_fixture == 0:
+                warnings.warn(
+                    "No fixture data found for '%s'. (File format may be "
+                    "invalid.)" % fixture_name,
+                    RuntimeWarning
+                )
+
+    def warn_missing_references(self, loaded):
+        instances = {}
+        for obj in loaded:
+            instances.setdefault(type(obj.object), []).append(obj.object)
+        for model, model_instances in instances.items():
+            missing = find_missing_references(model, model_instances, using=self.using, batch_size=self.batch_size)
+            for field, keys in missing.items():
+                self.stderr.write("%s.%s: %d key(s) point to nothing: %s" % (
+                    model._meta.label, field.name, len(keys), ", ".join(repr(tuple(k)) for k in sorted(keys)),
+                ))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from compositefk import mirroring
+from compositefk.stats import get_label
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class Command(BaseCommand):
+    help = (
+        "copy again the mirrored columns of the CompositeForeignKey (see mirror_fields) from their related "
+        "objects, by chunks of rows"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*',
+            help="app_label.Model or app_label.Model.field to resync, all the mirrored fields if empty",
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        for field in self.get_fields(options["labels"]):
+            updated = mirroring.resync(field, using=options["database"], chunk_size=options["chunk_size"])
+            self.stdout.write("%s: %d row(s) updated" % (get_label(field), updated))
+
+    def get_fields(self, labels):
+        if not labels:
+            return mirroring.get_mirrored_fields()
+        fields = []
+        for label in labels:
+            parts = label.split(".")
+            if len(parts) not in (2, 3):
+                raise CommandError("%s is not app_label.Model or app_label.Model.field" % label)
+            try:
+                model = apps.get_model(parts[0], parts[1])
+            except LookupError as e:
+                raise CommandError(str(e))
+            model_fields = mirroring.get_mirrored_fields(model)
+            if len(parts) == 3:
+                model_fields = [f for f in model_fields if f.name == parts[2]]
+            if not model_fields:
+                raise CommandError("%s has no mirrored CompositeForeignKey" % label)
+            fields.extend(model_fields)
+        return fields
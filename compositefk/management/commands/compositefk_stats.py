@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from compositefk import stats
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class Command(BaseCommand):
+    help = (
+        "replay a workload with the statistics of the CompositeForeignKey enabled, "
+        "and print the fields ranked by cost"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('workload', help="dotted path to a callable which replay the workload")
+        parser.add_argument('--order-by', default="duration", choices=stats.FieldStats.ordering_keys)
+        parser.add_argument('--repeat', type=int, default=1)
+        parser.add_argument('--limit', type=int, default=None)
+
+    def handle(self, workload, **options):
+        try:
+            workload = import_string(workload)
+        except ImportError as e:
+            raise CommandError("can't import the workload: %s" % e)
+
+        with stats.recording():
+            for _ in range(options["repeat"]):
+                workload()
+        field_stats = stats.get_stats(order_by=options["order_by"])[:options["limit"]]
+        self.stdout.write(self.get_report(field_stats))
+
+    def get_report(self, field_stats):
+        if not field_stats:
+            return "no composite relation used"
+        headers = ("field", "queries", "rows", "time (ms)", "hits", "misses", "batches", "mean batch")
+        rows = [
+            (
+                s.label, s.queries, s.rows, "%.2f" % (s.duration * 1000), s.cache_hits, s.cache_misses,
+                s.prefetch_batches, "%.1f" % s.mean_prefetch_batch,
+            )
+            for s in field_stats
+        ]
+        widths = [max(len(str(row[i])) for row in [headers] + rows) for i in range(len(headers))]
+        return "\n".join(
+            "  ".join(
+                str(value).ljust(width) if i == 0 else str(value).rjust(width)
+                for i, (value, width) in enumerate(zip(row, widths))
+            )
+            for row in [headers] + rows
+        )
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+the mirrored columns of a CompositeForeignKey (see its mirror_fields) : local columns which hold a copy of some
+columns of the related object, so a listing can read them without join.
+
+they are kept up to date :
+- when the local object is saved (pre_save) with another key than the one it was loaded with, from the related
+  object (cached or fetched). on a model with MirrorFieldsMixin, a save whose update_fields contain a part of the
+  key save the mirrored columns too ;
+- when a related object is saved or deleted (post_save/post_delete), with one UPDATE of all its dependents ;
+- when a CompositeQuerySet.update() change the related objects or the keys of the local objects, with one UPDATE
+  per chunk of rows, which copy the columns via a correlated subquery ;
+- by resync(), or the command compositefk_resync_mirrors, which refresh a whole table by chunks.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.db.models.expressions import Case, OuterRef, Subquery, Value, When
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+
+from compositefk.compat import delete_cached_value_by_field, get_cached_value
+from compositefk.query import filter_by_keys
+from compositefk.related_descriptors import get_reverse_instance_attr
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# the mirrored CompositeForeignKey, by related model and by local model
+_remote_fields = defaultdict(list)
+_local_fields = defaultdict(list)
+# the result of the checks of the mirrored fields, by field
+_valid_fields = {}
+# the local keys the instance was loaded (or last saved) with, by name of mirrored field
+LOADED_KEYS_ATTR = "_compositefk_mirrored_keys"
+
+
+def register(field, related_model):
+    """
+    keep the mirrored columns of the field up to date
+    :param related_model: the related model of the field, which may not be resolved yet by the field
+    """
+    if field in _local_fields[field.model]:
+        return
+    _local_fields[field.model].append(field)
+    _remote_fields[related_model].append(field)
+    post_init.connect(snapshot_keys, sender=field.model, dispatch_uid="compositefk.mirroring.post_init")
+    pre_save.connect(update_local_instance, sender=field.model, dispatch_uid="compositefk.mirroring.pre_save")
+    post_save.connect(remember_saved_keys, sender=field.model, dispatch_uid="compositefk.mirroring.local_post_save")
+    post_save.connect(update_dependents, sender=related_model, dispatch_uid="compositefk.mirroring.post_save")
+    post_delete.connect(clear_dependents, sender=related_model, dispatch_uid="compositefk.mirroring.post_delete")
+
+
+class MirrorFieldsMixin(object):
+    """
+    a mixin of the models having mirrored columns : a save whose update_fields contain a part of the key of a
+    mirrored relation save its mirrored columns too (see get_saved_fields). the signals get update_fields as a
+    frozenset, so they can't add them.
+    """
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is not None:
+            update_fields = get_saved_fields(type(self), update_fields)
+        super(MirrorFieldsMixin, self).save(
+            force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields,
+        )
+
+
+def get_saved_fields(model, update_fields):
+    """
+    :return: the update_fields of a save of model, with the mirrored columns of the fields whose key they contain
+    :rtype: frozenset
+    """
+    saved = set(update_fields)
+    for field in _get_fields(_local_fields, model):
+        if any(name in update_fields for f in field.local_related_fields for name in (f.name, f.attname)):
+            saved.update(field.mirror_fields)
+    return frozenset(saved)
+
+
+def _get_fields(registry, model):
+    """
+    :return: the fields registered for model whose mirror_fields pass the checks (a model installed after the
+        checks, as in the tests, may not)
+    """
+    fields = []
+    for field in registry.get(model, []):
+        if field not in _valid_fields:
+            _valid_fields[field] = not field._check_mirror_fields()
+        if _valid_fields[field]:
+            fields.append(field)
+    return fields
+
+
+def get_mirrored_fields(model=None):
+    """
+    :return: the mirrored CompositeForeignKey of the model, or of all the models
+    :rtype: list[CompositeForeignKey]
+    """
+    if model is not None:
+        return _get_fields(_local_fields, model)
+    return [field for local_model in list(_local_fields) for field in _get_fields(_local_fields, local_model)]
+
+
+def get_null_condition(field):
+    """
+    the condition on the local model matching the rows which point to nothing because of null_if_equal
+    """
+    condition = Q()
+    for field_name, exception_value in field.null_if_equal:
+        condition |= Q(**{field_name: exception_value})
+    return condition
+
+
+def get_raw_conditions(field):
+    remote_fields = field.resolved_fields.remote
+    return {
+        remote_fields[remote].attname: part.value
+        for remote, part in field._raw_fields.items()
+        if not part.is_local_field
+    }
+
+
+def get_mirror_expressions(field):
+    """
+    :return: the expressions which copy the mirrored columns of the related object in an UPDATE of the local model,
+        by local attname
+    :rtype: dict
+    """
+    remote = field.related_model._base_manager.filter(**{
+        remote_field.attname: OuterRef(local_field.attname) for local_field, remote_field in field.related_fields
+    }).filter(**get_raw_conditions(field)).order_by()
+    expressions = {}
+    for local_name, remote_name in field.mirror_fields.items():
+        local_field = field.model._meta.get_field(local_name)
+        expression = Subquery(remote.values(remote_name)[:1], output_field=local_field)
+        if field.null_if_equal:
+            expression = Case(
+                When(get_null_condition(field), then=Value(None)),
+                default=expression,
+                output_field=local_field,
+            )
+        expressions[local_field.attname] = expression
+    return expressions
+
+
+def refresh(field, queryset):
+    """
+    copy the mirrored columns of the related objects into the rows of the queryset, with one UPDATE
+    :return: the number of updated rows
+    """
+    return queryset.order_by().update(**get_mirror_expressions(field))
+
+
+def get_remote_keys(field, pks, using=DEFAULT_DB_ALIAS, chunk_size=1000):
+    """
+    :return: the keys of the related objects of field having the given pks
+    :rtype: set[tuple]
+    """
+    attnames = [f.attname for f in field.foreign_related_fields]
+    manager = field.related_model._base_manager.db_manager(using)
+    keys = set()
+    for start in range(0, len(pks), chunk_size):
+        keys.update(manager.filter(pk__in=pks[start:start + chunk_size]).values_list(*attnames))
+    return keys
+
+
+def refresh_by_pks(field, model, pks, using=DEFAULT_DB_ALIAS, chunk_size=1000, old_keys=()):
+    """
+    refresh the mirrored columns of field for the rows of model having the given pks : the local rows if model
+    is the local model of the field, else the dependents of these related objects (and the ones of old_keys, the
+    keys they had before an update).
+    :return: the number of updated rows
+    """
+    manager = field.model._base_manager.db_manager(using)
+    if model is field.model:
+        return sum(
+            refresh(field, manager.filter(pk__in=pks[start:start + chunk_size]))
+            for start in range(0, len(pks), chunk_size)
+        )
+    keys = list(get_remote_keys(field, pks, using, chunk_size) | set(old_keys))
+    return sum(
+        refresh(field, filter_by_keys(manager.all(), field.local_related_fields, keys[start:start + chunk_size]))
+        for start in range(0, len(keys), chunk_size)
+    )
+
+
+def resync(field, using=DEFAULT_DB_ALIAS, chunk_size=1000):
+    """
+    refresh the mirrored columns of all the rows of the local model, by chunks of chunk_size rows
+    :return: the number of updated rows
+    """
+    manager = field.model._base_manager.db_manager(using)
+    updated = 0
+    last_pk = None
+    while True:
+        queryset = manager.order_by("pk")
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        pks = list(queryset.values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return updated
+        updated += refresh(field, manager.filter(pk__in=pks))
+        last_pk = pks[-1]
+
+
+def get_update_fields(model, updated):
+    """
+    :param set updated: the names and attnames given to a QuerySet.update() of model
+    :return: the mirrored fields impacted by the update : those whose related model is model and whose key or
+        mirrored columns are updated, and those of model whose key is updated
+    :rtype: list[CompositeForeignKey]
+    """
+    impacted = []
+    for field in _get_fields(_remote_fields, model):
+        names = set(field.mirror_fields.values())
+        names.update(
+            name for f in field.resolved_fields.remote.values() if f is not None for name in (f.name, f.attname)
+        )
+        if names & updated:
+            impacted.append(field)
+    for field in _get_fields(_local_fields, model):
+        names = set(name for f in field.local_related_fields for name in (f.name, f.attname))
+        if names & updated:
+            impacted.append(field)
+    return impacted
+
+
+def get_loaded_key(field, instance):
+    """
+    :return: the local key of the field, None if a part of it is deferred
+    """
+    key = tuple(instance.__dict__.get(f.attname, LOADED_KEYS_ATTR) for f in field.local_related_fields)
+    return None if LOADED_KEYS_ATTR in key else key
+
+
+def snapshot_keys(sender, instance, **kwargs):
+    instance.__dict__[LOADED_KEYS_ATTR] = {
+        field.name: get_loaded_key(field, instance) for field in _get_fields(_local_fields, sender)
+    }
+
+
+def remember_saved_keys(sender, instance, raw=False, update_fields=None, **kwargs):
+    saved = instance.__dict__.setdefault(LOADED_KEYS_ATTR, {})
+    for field in _get_fields(_local_fields, sender):
+        if update_fields is None or set(field.mirror_fields) <= set(update_fields):
+            saved[field.name] = get_loaded_key(field, instance)
+
+
+def is_mirror_known(field, instance):
+    """
+    :return: True if the mirrored columns of the instance are the ones of the related object of its key : it was
+        loaded (or saved) with this key and the mirrored columns
+    """
+    if instance._state.adding or any(name not in instance.__dict__ for name in field.mirror_fields):
+        return False
+    key = get_loaded_key(field, instance)
+    return key is not None and instance.__dict__.get(LOADED_KEYS_ATTR, {}).get(field.name) == key
+
+
+def update_local_instance(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    for field in _get_fields(_local_fields, sender):
+        if update_fields is not None and not set(update_fields) & set(field.mirror_fields):
+            continue
+        if is_mirror_known(field, instance):
+            continue
+        rel_obj = get_cached_value(instance, getattr(sender, field.name), None)
+        if rel_obj is not None and field.get_foreign_related_value(rel_obj) != field.get_local_related_value(instance):
+            # the key changed since the related object was cached
+            delete_cached_value_by_field(instance, field)
+        try:
+            rel_obj = getattr(sender, field.name).get_related(instance)
+        except field.related_model.DoesNotExist:
+            rel_obj = None
+        for local_name, remote_name in field.mirror_fields.items():
+            setattr(instance, local_name, None if rel_obj is None else getattr(rel_obj, remote_name))
+
+
+def _get_dependents(field, instance, using):
+    key = get_reverse_instance_attr(field)(instance)
+    if key is None or None in key:
+        return None
+    dependents = field.model._base_manager.using(using).filter(**{
+        f.attname: value for f, value in zip(field.local_related_fields, key)
+    })
+    if field.null_if_equal:
+        dependents = dependents.exclude(get_null_condition(field))
+    return dependents
+
+
+def update_dependents(sender, instance, raw=False, using=DEFAULT_DB_ALIAS, **kwargs):
+    if raw:
+        return
+    for field in _get_fields(_remote_fields, sender):
+        dependents = _get_dependents(field, instance, using)
+        if dependents is not None:
+            dependents.update(**{
+                local_name: getattr(instance, remote_name) for local_name, remote_name in field.mirror_fields.items()
+            })
+
+
+def clear_dependents(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    for field in _get_fields(_remote_fields, sender):
+        local_names = [name for name in field.mirror_fields if field.model._meta.get_field(name).null]
+        dependents = _get_dependents(field, instance, using)
+        if dependents is not None and local_names:
+            dependents.update(**{name: None for name in local_names})
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+keyset pagination over a composite key : each page is filtered on the key of the last row of the previous one
+instead of skipping its offset, so the page N cost the same as the first one (a range scan of the index of the
+key).
+
+    paginator = KeysetPaginator(Address.objects.all(), Customer._meta.get_field("address"), per_page=100)
+    page = paginator.page(request.GET.get("cursor"))
+    ... page.next_cursor ...
+
+    for address in paginator.iterator():  # the batch jobs
+        ...
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import base64
+import json
+import logging
+
+from django.core.paginator import InvalidPage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.sql.where import AND, OR, WhereNode
+from django.utils.encoding import force_bytes, force_text
+
+from compositefk.fields import CompositeForeignKey
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# the backends which compare the row values (a, b, c) > (%s, %s, %s) with the index of (a, b, c)
+ROW_VALUE_VENDORS = ("postgresql", "mysql")
+
+
+def get_key_fields(model, keys):
+    """
+    :param keys: the names of the fields of the key, or a CompositeForeignKey pointing to model : its to_fields,
+        in their order
+    :return: the fields of the key, followed by the primary key if they are not unique together
+    :rtype: list[Field]
+    """
+    if isinstance(keys, CompositeForeignKey):
+        keys = list(keys._raw_fields)
+    fields = [model._meta.pk if name == "pk" else model._meta.get_field(name) for name in keys]
+    names = set(f.name for f in fields)
+    unique_together = model._meta.unique_together
+    if not any(f.unique for f in fields) and not any(names.issuperset(together) for together in unique_together):
+        fields.append(model._meta.pk)
+    return fields
+
+
+class KeysetCondition(object):
+    """
+    the condition matching the rows after (or before, if descending) the given key in the order of the columns,
+    and the key itself if inclusive.
+    a row value comparison on the backends which support it with the index (see ROW_VALUE_VENDORS), else the
+    expanded form a >= %s AND (a > %s OR (a = %s AND (b > %s OR (b = %s AND c > %s)))), whose first term
+    is a range of the index.
+    """
+    contains_aggregate = False
+    contains_over_clause = False
+
+    def __init__(self, cols, values, descending=False, inclusive=False):
+        self.cols = cols
+        self.values = values
+        self.descending = descending
+        self.inclusive = inclusive
+
+    def relabeled_clone(self, change_map):
+        return type(self)(
+            [col.relabeled_clone(change_map) for col in self.cols], self.values, self.descending, self.inclusive
+        )
+
+    def get_expanded_condition(self):
+        strict = "lt" if self.descending else "gt"
+        condition = None
+        for col, value in reversed(list(zip(self.cols, self.values))):
+            # the comparison of the last column decide if the key itself match
+            is_last = condition is None
+            lookup = col.output_field.get_lookup(strict + ("e" if is_last and self.inclusive else ""))(col, value)
+            if condition is not None:
+                lookup = WhereNode([
+                    lookup,
+                    WhereNode([col.output_field.get_lookup("exact")(col, value), condition], connector=AND),
+                ], connector=OR)
+            condition = lookup
+        if len(self.cols) > 1:
+            col = self.cols[0]
+            first = col.output_field.get_lookup("lte" if self.descending else "gte")(col, self.values[0])
+            condition = WhereNode([first, condition], connector=AND)
+        return condition
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor not in ROW_VALUE_VENDORS:
+            return compiler.compile(self.get_expanded_condition())
+        lhs = [compiler.compile(col)[0] for col in self.cols]
+        params = [col.output_field.get_db_prep_value(value, connection) for col, value in zip(self.cols, self.values)]
+        operator = ("<" if self.descending else ">") + ("=" if self.inclusive else "")
+        return "(%s) %s (%s)" % (", ".join(lhs), operator, ", ".join(["%s"] * len(lhs))), params
+
+
+def encode_cursor(values):
+    return force_text(base64.urlsafe_b64encode(force_bytes(json.dumps(list(values), cls=DjangoJSONEncoder))))
+
+
+def decode_cursor(cursor, fields):
+    """
+    :return: the values of the fields in the cursor
+    :raise InvalidPage: if the cursor is not one of these fields
+    """
+    try:
+        values = json.loads(force_text(base64.urlsafe_b64decode(force_bytes(cursor))))
+        if not isinstance(values, list) or len(values) != len(fields):
+            raise ValueError("wrong number of values")
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except Exception as e:
+        raise InvalidPage("invalid cursor %r: %s" % (cursor, e))
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        # the cursor of the next page, None on the last one
+        self.next_cursor = next_cursor
+
+    def __repr__(self):
+        return "<KeysetPage of %d objects>" % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+class KeysetPaginator(object):
+    """
+    paginate the queryset (of model instances) in the order of the key, which replace its ordering.
+    the columns of the key must not be null. the primary key is added to them if they are not unique together.
+    """
+
+    def __init__(self, queryset, keys, per_page, descending=False):
+        self.queryset = queryset
+        self.fields = get_key_fields(queryset.model, keys)
+        self.per_page = int(per_page)
+        self.descending = descending
+
+    def get_key(self, obj):
+        return [getattr(obj, field.attname) for field in self.fields]
+
+    def get_queryset(self, after=None):
+        queryset = self.queryset.order_by(*[("-" if self.descending else "") + f.name for f in self.fields])
+        if after is not None:
+            alias = queryset.query.get_initial_alias()
+            cols = [field.get_col(alias) for field in self.fields]
+            queryset.query.where.add(KeysetCondition(cols, after, self.descending), AND)
+        return queryset
+
+    def get_objects(self, after=None):
+        """
+        :param after: the key of the last object of the previous page
+        :return: the objects of the page and the key of the last one, None if there is no next page
+        """
+        objects = list(self.get_queryset(after)[:self.per_page + 1])
+        if len(objects) <= self.per_page:
+            return objects, None
+        objects = objects[:self.per_page]
+        return objects, self.get_key(objects[-1])
+
+    def page(self, cursor=None):
+        """
+        :param cursor: the next_cursor of the previous page, None (or "") for the first one
+        :rtype: KeysetPage
+        """
+        after = decode_cursor(cursor, self.fields) if cursor else None
+        objects, key = self.get_objects(after)
+        return KeysetPage(objects, None if key is None else encode_cursor(key))
+
+    def iterator(self, cursor=None):
+        """
+        iterate over all the objects from the cursor, one query per page
+        """
+        after = decode_cursor(cursor, self.fields) if cursor else None
+        while True:
+            objects, after = self.get_objects(after)
+            for obj in objects:
+                yield obj
+            if after is None:
+                return
+
+
+def keyset_iterator(queryset, keys, chunk_size=2000, descending=False):
+    """
+    iterate over the queryset in the order of the key, by chunks of chunk_size objects read by keyset pagination
+    """
+    return KeysetPaginator(queryset, keys, chunk_size, descending=descending).iterator()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+split a table on its composite key into contiguous ranges of the same size, and process them in a pool of worker
+processes, each with its own connection : a nightly job over Customer or Contact use all the cores.
+
+    def count_phonenumbers(queryset):
+        return sum(customer.phonenumbers.count() for customer in queryset)
+
+    total = run_key_ranges(count_phonenumbers, Customer.objects.all(), ["company", "customer_id"], aggregate=sum)
+
+the function given to the workers must be picklable (ie: a function of a module), and so must be its results.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import multiprocessing
+from collections import namedtuple
+
+import django
+from django.apps import apps
+from django.db import connections
+from django.db.models.sql.where import AND
+
+from compositefk.pagination import KeysetCondition, get_key_fields
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# a range of keys, from start (included) to end (excluded). None is the start or the end of the table
+KeyRange = namedtuple("KeyRange", ["start", "end"])
+
+
+def split_key_ranges(queryset, keys, count):
+    """
+    split the rows of the queryset into count ranges of its key of the same size (or less, if there are not
+    enough rows). the bounds are the quantiles of the key, read by count - 1 queries of one row in the index, each
+    starting from the previous bound (a keyset, see pagination) : the walk skip each row of the index once, so the
+    cost is the one of a scan of the index (plus the count), not count scans as an OFFSET from the start.
+    :param keys: the names of the fields of the key, or a CompositeForeignKey pointing to the model of the queryset
+        (see pagination.get_key_fields)
+    :rtype: list[KeyRange]
+    """
+    fields = get_key_fields(queryset.model, keys)
+    queryset = queryset.order_by(*[f.name for f in fields])
+    total = queryset.count()
+    bounds = []
+    previous = 0
+    for i in range(1, count):
+        offset = total * i // count
+        if offset == previous or offset == total:
+            continue
+        rows = queryset if not bounds else filter_key_range(queryset, keys, KeyRange(bounds[-1], None))
+        bounds.append(tuple(rows.values_list(*[f.attname for f in fields])[offset - previous]))
+        previous = offset
+    bounds = [None] + bounds + [None]
+    return [KeyRange(start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def filter_key_range(queryset, keys, key_range):
+    """
+    :return: the rows of the queryset in the range of keys
+    :rtype: QuerySet
+    """
+    fields = get_key_fields(queryset.model, keys)
+    queryset = queryset.all()
+    alias = queryset.query.get_initial_alias()
+    cols = [field.get_col(alias) for field in fields]
+    if key_range.start is not None:
+        queryset.query.where.add(KeysetCondition(cols, key_range.start, inclusive=True), AND)
+    if key_range.end is not None:
+        queryset.query.where.add(KeysetCondition(cols, key_range.end, descending=True), AND)
+    return queryset
+
+
+def can_use_processes(connection):
+    """
+    the worker processes can't see the writes of a transaction not committed, nor a database in memory
+    """
+    if connection.in_atomic_block:
+        return False
+    return not (connection.vendor == "sqlite" and connection.is_in_memory_db())
+
+
+def get_queryset_state(queryset):
+    """
+    the picklable state of the queryset : pickling a queryset evaluate it
+    """
+    return (
+        type(queryset), queryset.model, queryset.query, queryset.db,
+        queryset._prefetch_related_lookups, queryset._iterable_class, queryset._fields,
+    )
+
+
+def from_queryset_state(state):
+    queryset_class, model, query, using, lookups, iterable_class, fields = state
+    queryset = queryset_class(model=model, query=query, using=using)
+    queryset._prefetch_related_lookups = lookups
+    queryset._iterable_class = iterable_class
+    queryset._fields = fields
+    return queryset
+
+
+def init_worker():
+    # the processes started by spawn (the default on windows and macos) import nothing of the parent
+    if not apps.ready:
+        django.setup()
+
+
+def run_worker(args):
+    func, state = args
+    try:
+        return func(from_queryset_state(state))
+    finally:
+        for conn in connections.all():
+            conn.close()
+
+
+def run_key_ranges(func, queryset, keys, workers=None, ranges=None, aggregate=list):
+    """
+    call func with the rows of the queryset in each range of keys, in a pool of workers processes (one per core
+    by default), and aggregate their results in the order of the ranges.
+    the ranges are run in the current process if there is only one worker, or if the database is in a transaction
+    or in memory.
+    :param ranges: the ranges of keys, split_key_ranges(queryset, keys, workers) by default
+    :param aggregate: the function building the result from the list of the results of func (ie: sum)
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if ranges is None:
+        ranges = split_key_ranges(queryset, keys, workers)
+    querysets = [filter_key_range(queryset, keys, key_range) for key_range in ranges]
+    if workers == 1 or len(querysets) == 1 or not can_use_processes(connections[queryset.db]):
+        return aggregate([func(range_queryset) for range_queryset in querysets])
+
+    # the forked processes must open their own connections, not share the ones of this process
+    for conn in connections.all():
+        conn.close()
+    pool = multiprocessing.Pool(min(workers, len(querysets)), initializer=init_worker)
+    try:
+        results = pool.map(run_worker, [(func, get_queryset_state(range_queryset)) for range_queryset in querysets])
+    finally:
+        pool.close()
+        pool.join()
+    return aggregate(results)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+run the independent prefetch_related lookups of a queryset in parallel : one thread per relation of the model,
+each with its own connections, so the prefetch take as long as its slowest query instead of the sum of them.
+
+    Customer.objects.prefetch_related("address", "representant", "contacts__phonenumbers").parallel_prefetch()
+
+the lookups which follow the same relation ("contacts" and "contacts__phonenumbers") are run by the same thread,
+in their order.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from django.db import connections
+from django.db.models import Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import prefetch_related_objects
+from django.utils import translation
+
+from compositefk import routing
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+DEFAULT_WORKERS = 4
+
+
+def group_lookups(lookups):
+    """
+    group the lookups by the first relation they follow, in their order
+    :rtype: list[list]
+    """
+    groups = OrderedDict()
+    for lookup in lookups:
+        path = lookup.prefetch_through if isinstance(lookup, Prefetch) else lookup
+        groups.setdefault(path.split(LOOKUP_SEP)[0], []).append(lookup)
+    return list(groups.values())
+
+
+def prepare_instances(instances):
+    """
+    create the caches of the instances before the threads fill them : two threads creating the same
+    cache would lose the values of one of them
+    """
+    for instance in instances:
+        if not hasattr(instance, "_prefetched_objects_cache"):
+            instance._prefetched_objects_cache = {}
+        # a lazy dict on django >= 2.0
+        getattr(instance._state, "fields_cache", None)
+
+
+def can_use_threads(connection):
+    """
+    the connections of the other threads don't see the writes of a transaction not committed, nor a sqlite
+    database in memory, unless it is in a shared cache (as the test database on python 3)
+    """
+    if connection.in_atomic_block:
+        return False
+    return not (
+        connection.vendor == "sqlite" and connection.is_in_memory_db() and
+        "cache=shared" not in connection.settings_dict["NAME"]
+    )
+
+
+def parallel_prefetch_related_objects(instances, *lookups, **kwargs):
+    """
+    like prefetch_related_objects, but the groups of lookups (see group_lookups) are run in a pool of
+    workers threads (DEFAULT_WORKERS by default).
+    the lookups are run in the current thread if there is only one group, or if the other threads can't see the
+    database (see can_use_threads).
+    """
+    workers = kwargs.pop("workers", None) or DEFAULT_WORKERS
+    instances = list(instances)
+    groups = group_lookups(lookups)
+    if not instances or not groups:
+        return
+    using = instances[0]._state.db
+    if len(groups) == 1 or workers == 1 or (using is not None and not can_use_threads(connections[using])):
+        prefetch_related_objects(instances, *lookups)
+        return
+
+    prepare_instances(instances)
+    # the state of this thread used by the prefetch queries
+    routing_state = routing.get_state()
+    language = translation.get_language()
+
+    def prefetch(group):
+        routing.set_state(routing_state)
+        try:
+            with translation.override(language):
+                prefetch_related_objects(instances, *group)
+        finally:
+            # the connections opened by this thread
+            for conn in connections.all():
+                conn.close()
+
+    pool = ThreadPool(min(workers, len(groups)))
+    try:
+        pool.map(prefetch, groups)
+    finally:
+        pool.close()
+        pool.join()
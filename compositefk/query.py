@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+from collections import namedtuple
+from itertools import islice
+
+import django
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import F, OrderBy
+from django.db.models.query import (
+    BaseIterable,
+    FlatValuesListIterable,
+    ModelIterable,
+    QuerySet,
+    ValuesIterable,
+    ValuesListIterable,
+    prefetch_related_objects,
+)
+from django.db.models.sql.where import WhereNode, AND, OR
+from django.utils import six
+
+from compositefk import siblings
+from compositefk.compat import get_results_iter
+from compositefk.prefetch import DEFAULT_WORKERS, parallel_prefetch_related_objects
+
+try:
+    from django.db.models.query import NamedValuesListIterable
+except ImportError:  # django < 2.0
+    NamedValuesListIterable = None
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+def get_keys_condition(fields, keys, alias):
+    """
+    build the condition which match any of the given composite keys.
+    the OR are nested as a balanced tree : the flat OR made by django for a multi column __in
+    is too deep for sqlite (maximum depth of 1000) with a batch of keys of that size.
+    :param list[Field] fields: the fields matched by each value of the keys
+    :param list[tuple] keys: the keys to match
+    :param str alias: the alias of the table of the fields
+    :rtype: WhereNode
+    """
+    nodes = [
+        WhereNode([
+            field.get_lookup("exact")(field.get_col(alias), value)
+            for field, value in zip(fields, key)
+        ], connector=AND)
+        for key in keys
+    ]
+    while len(nodes) > 1:
+        nodes = [
+            WhereNode(nodes[i:i + 2], connector=OR) if i + 1 < len(nodes) else nodes[i]
+            for i in range(0, len(nodes), 2)
+        ]
+    return nodes[0]
+
+
+def filter_by_keys(queryset, fields, keys):
+    """
+    filter the queryset on the given composite keys, with one condition per distinct key and no join.
+    the keys with a None value are ignored, since they can't match anything.
+    :param QuerySet queryset: the queryset to filter
+    :param list[Field] fields: the fields of the queryset model matched by each value of the keys
+    :param keys: the keys to match
+    :rtype: QuerySet
+    """
+    keys = [key for key in set(keys) if None not in key]
+    if not keys:
+        return queryset.none()
+    queryset = queryset.all()
+    queryset.query.where.add(get_keys_condition(fields, keys, queryset.query.get_initial_alias()), AND)
+    return queryset
+
+
+def chunked_iterator(queryset, chunk_size=2000):
+    """
+    iterate over the queryset like QuerySet.iterator(), but apply its prefetch_related lookups on each
+    chunk of chunk_size instances: one query per chunk and per lookup. only the current chunk and its
+    related objects are referenced by the iterator.
+    """
+    lookups = queryset._prefetch_related_lookups
+    prefetch = getattr(queryset, "_prefetch_instances", None)
+    remember_siblings = siblings.has_auto_prefetch(queryset.model)
+    queryset = queryset.prefetch_related(None)
+    if django.VERSION < (2, 0):
+        iterator = queryset.iterator()
+    else:
+        iterator = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        if remember_siblings:
+            siblings.remember(chunk)
+        if lookups and prefetch is not None:
+            prefetch(chunk, lookups)
+        elif lookups:
+            prefetch_related_objects(chunk, *lookups)
+        for obj in chunk:
+            yield obj
+
+
+def get_values_field(model, name):
+    """
+    return the CompositeForeignKey at the end of the given values() lookup, or None if it is not one
+    """
+    from compositefk.fields import CompositeForeignKey  # fields import this module via the descriptors
+
+    field = None
+    for part in name.split(LOOKUP_SEP):
+        if field is not None:
+            if not field.is_relation:
+                return None
+            model = field.related_model
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+    return field if isinstance(field, CompositeForeignKey) else None
+
+
+def expand_composite_name(model, name):
+    """
+    expand an order_by() or distinct() name (or F expression, or F().asc()/desc()) ending by a CompositeForeignKey
+    into the ones of its local columns, in the order of its to_fields : the rows are ordered by the local columns
+    (and can use their index), without join nor the ordering of the related model.
+    :return: the names or expressions which replace it, [name] if it isn't a CompositeForeignKey
+    :rtype: list
+    """
+    ordering = None
+    expression = name
+    if isinstance(name, OrderBy):
+        ordering, expression = name, name.expression
+    if isinstance(expression, F):
+        lookup = expression.name
+    elif isinstance(expression, six.string_types):
+        lookup = expression.lstrip("-")
+    else:
+        return [name]
+    field = get_values_field(model, lookup)
+    if field is None:
+        return [name]
+    prefix = lookup[:-len(field.name)]
+    columns = [prefix + f.attname for f in field.local_related_fields]
+    if ordering is not None:
+        return [
+            OrderBy(F(column), descending=ordering.descending, nulls_first=ordering.nulls_first,
+                    nulls_last=ordering.nulls_last)
+            for column in columns
+        ]
+    if isinstance(expression, F):
+        return [F(column) for column in columns]
+    sign = expression[:-len(lookup)]
+    return [sign + column for column in columns]
+
+
+def get_key_factory(field):
+    """
+    return the function which build the value of a CompositeForeignKey from its local columns : a CompositeKey,
+    or None if the relation point to nothing (a None or a null_if_equal value)
+    """
+    from compositefk.fields import CompositeKey
+
+    positions = dict((f.name, i) for i, f in enumerate(field.local_related_fields))
+    positions.update((f.attname, i) for i, f in enumerate(field.local_related_fields))
+    exceptions = [
+        (positions[field_name], value) for field_name, value in field.null_if_equal if field_name in positions
+    ]
+
+    def factory(values):
+        if None in values or any(values[i] == value for i, value in exceptions):
+            return None
+        return CompositeKey(values)
+    return factory
+
+
+class CompositeValuesIterableMixin(object):
+    """
+    mixin for the iterables of values() and values_list() which group the local columns of each CompositeForeignKey
+    into one value.
+    """
+
+    def get_names(self):
+        query = self.queryset.query
+        # extra(select=...) cols are always at the start of the row.
+        return list(query.extra_select) + list(query.values_select) + list(query.annotation_select)
+
+    def iter_rows(self):
+        queryset = self.queryset
+        query = queryset.query
+        model = queryset.model
+        slices = []
+        position = 0
+        for name in self.get_names():
+            field = get_values_field(model, name) if name in query.values_select else None
+            if field is None:
+                slices.append((position, None, None))
+                position += 1
+            else:
+                width = len(field.local_related_fields)
+                slices.append((position, position + width, get_key_factory(field)))
+                position += width
+        compiler = query.get_compiler(queryset.db)
+        for row in get_results_iter(compiler, self):
+            yield [
+                row[start] if factory is None else factory(tuple(row[start:end]))
+                for start, end, factory in slices
+            ]
+
+
+class CompositeValuesIterable(CompositeValuesIterableMixin, BaseIterable):
+    def __iter__(self):
+        names = self.get_names()
+        for row in self.iter_rows():
+            yield dict(zip(names, row))
+
+
+class CompositeValuesListIterable(CompositeValuesIterableMixin, BaseIterable):
+    def get_fields(self):
+        names = self.get_names()
+        fields = self.queryset._fields
+        if not fields:
+            return names
+        annotation_names = list(self.queryset.query.annotation_select)
+        return list(fields) + [f for f in annotation_names if f not in fields]
+
+    def __iter__(self):
+        index_map = {name: i for i, name in enumerate(self.get_names())}
+        indexes = [index_map[f] for f in self.get_fields()]
+        for row in self.iter_rows():
+            yield tuple(row[i] for i in indexes)
+
+
+class CompositeNamedValuesListIterable(CompositeValuesListIterable):
+    def __iter__(self):
+        tuple_class = namedtuple('Row', self.get_fields())
+        new = tuple.__new__
+        for row in super(CompositeNamedValuesListIterable, self).__iter__():
+            yield new(tuple_class, row)
+
+
+class CompositeFlatValuesListIterable(CompositeValuesIterableMixin, BaseIterable):
+    def get_names(self):
+        # the flat values_list has no extra nor annotations columns before its field
+        return list(self.queryset.query.values_select)
+
+    def __iter__(self):
+        for row in self.iter_rows():
+            yield row[0]
+
+
+COMPOSITE_ITERABLES = {
+    ValuesIterable: CompositeValuesIterable,
+    ValuesListIterable: CompositeValuesListIterable,
+    FlatValuesListIterable: CompositeFlatValuesListIterable,
+}
+if NamedValuesListIterable is not None:
+    COMPOSITE_ITERABLES[NamedValuesListIterable] = CompositeNamedValuesListIterable
+
+
+class CompositeQuerySet(QuerySet):
+    """
+    QuerySet which support the composite relations where django don't.
+
+    - iterator() apply the prefetch_related lookups by chunk, instead of ignoring them.
+    - parallel_prefetch() run the independent prefetch_related lookups in threads.
+    - the instances of an evaluation know each other, for the CompositeForeignKey(auto_prefetch=True).
+    - update() refresh the mirrored columns of the CompositeForeignKey impacted (see mirror_fields), and give the
+      new keys to the dependents of the CompositeForeignKey(on_update=CASCADE) (see compositefk.cascade).
+    - values() and values_list() accept a CompositeForeignKey (or a lookup ending by one) : its value is the
+      CompositeKey of the local columns, selected without join.
+    - order_by() and distinct() expand a CompositeForeignKey (or F() of one) into its local columns.
+    """
+
+    # the number of threads running the prefetch lookups, see parallel_prefetch()
+    _prefetch_workers = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(CompositeQuerySet, self)._clone(*args, **kwargs)
+        clone._prefetch_workers = self._prefetch_workers
+        return clone
+
+    def parallel_prefetch(self, workers=None):
+        """
+        run the prefetch_related lookups which follow different relations in a pool of threads, with
+        their own connections (see compositefk.prefetch). workers=1 run them one after another again.
+        """
+        clone = self._clone()
+        clone._prefetch_workers = workers or DEFAULT_WORKERS
+        return clone
+
+    def _prefetch_instances(self, instances, lookups):
+        if self._prefetch_workers is None:
+            prefetch_related_objects(instances, *lookups)
+        else:
+            parallel_prefetch_related_objects(instances, *lookups, workers=self._prefetch_workers)
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super(CompositeQuerySet, self)._fetch_all()
+        if fetched and issubclass(self._iterable_class, ModelIterable) and siblings.has_auto_prefetch(self.model):
+            siblings.remember(self._result_cache)
+
+    def _prefetch_related_objects(self):
+        self._prefetch_instances(self._result_cache, self._prefetch_related_lookups)
+        self._prefetch_done = True
+
+    def _use_composite_iterable(self, fields):
+        if any(get_values_field(self.model, name) is not None for name in fields):
+            self._iterable_class = COMPOSITE_ITERABLES.get(self._iterable_class, self._iterable_class)
+        return self
+
+    def values(self, *fields, **expressions):
+        clone = super(CompositeQuerySet, self).values(*fields, **expressions)
+        return clone._use_composite_iterable(fields)
+
+    def values_list(self, *fields, **kwargs):
+        clone = super(CompositeQuerySet, self).values_list(*fields, **kwargs)
+        return clone._use_composite_iterable(fields)
+
+    def order_by(self, *field_names):
+        return super(CompositeQuerySet, self).order_by(*[
+            expanded for name in field_names for expanded in expand_composite_name(self.model, name)
+        ])
+
+    def distinct(self, *field_names):
+        return super(CompositeQuerySet, self).distinct(*[
+            expanded for name in field_names for expanded in expand_composite_name(self.model, name)
+        ])
+
+    def iterator(self, chunk_size=2000):
+        if self._prefetch_related_lookups:
+            return chunked_iterator(self, chunk_size)
+        if django.VERSION < (2, 0):
+            return super(CompositeQuerySet, self).iterator()
+        return super(CompositeQuerySet, self).iterator(chunk_size=chunk_size)
+
+    def update(self, **kwargs):
+        from compositefk import cascade, mirroring  # they use this module
+
+        fields = mirroring.get_update_fields(self.model, set(kwargs))
+        cascading_fields = cascade.get_update_fields(self.model, set(kwargs))
+        if not fields and not cascading_fields:
+            return super(CompositeQuerySet, self).update(**kwargs)
+        # the rows and keys read before the update must be the ones it changes, and the dependents follow it or not
+        with transaction.atomic(using=self.db, savepoint=False):
+            # the rows must be known before the update, which may change the columns of the filter,
+            # and so the keys of the related objects, whose old dependents must be refreshed too
+            if cascading_fields:
+                cascade_keys = cascade.read_keys(cascading_fields, self)
+                pks = list(cascade_keys)
+            else:
+                pks = list(self.order_by().values_list("pk", flat=True))
+            old_keys = {
+                field: mirroring.get_remote_keys(field, pks, using=self.db)
+                for field in fields if field.model is not self.model
+            }
+            rows = super(CompositeQuerySet, self).update(**kwargs)
+            if cascading_fields:
+                # before the refresh of the mirrored columns of the dependents, which follow the new keys
+                cascade.propagate_update(cascading_fields, cascade_keys, self.model, using=self.db)
+            for field in fields:
+                mirroring.refresh_by_pks(field, self.model, pks, using=self.db, old_keys=old_keys.get(field, ()))
+        return rows
@@ -4,22 +4,166 @@
 
 from __future__ import unicode_literals, print_function, absolute_import
 import logging
+from timeit import default_timer
 
-from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.fields.related_descriptors import (
+    ForwardManyToOneDescriptor,
+    ReverseManyToOneDescriptor,
+    ReverseOneToOneDescriptor,
+    create_reverse_many_to_one_manager,
+)
+from django.db import connections, router, transaction
+from django.db.models.query import QuerySet, prefetch_related_objects
+from django.db.models.sql.where import AND
+from django.utils.functional import SimpleLazyObject, cached_property, empty
 
+from compositefk import dirty, routing, siblings, singleflight, stats
 from compositefk.compat import (
     set_cached_value_by_descriptor,
     set_cached_value_by_field,
     get_cached_value,
+    get_prefetch_result,
+    get_reverse_many_cache_name,
 )
+from compositefk.query import CompositeQuerySet, filter_by_keys
 
 
 logger = logging.getLogger(__name__)
 __author__ = 'darius.bernard'
 
 
+class CompositeKeyProxy(SimpleLazyObject):
+    """
+    the related object of a CompositeForeignKey(key_proxy=True), not loaded yet : the attributes of the remote key
+    (local values and RawFieldValue) are answered without query, any other access load it.
+    the proxy don't know if the related object exists : a missing one raise DoesNotExist (or give None) at load.
+    """
+
+    def __init__(self, func, key_values=None):
+        # set in __dict__, since LazyObject.__setattr__ load the object
+        self.__dict__["_key_values"] = key_values or {}
+        super(CompositeKeyProxy, self).__init__(func)
+
+    def __getattr__(self, name):
+        if self._wrapped is empty and name in self._key_values:
+            return self._key_values[name]
+        return super(CompositeKeyProxy, self).__getattr__(name)
+
+    def __repr__(self):
+        if self._wrapped is empty:
+            return "<%s: %r>" % (type(self).__name__, self._key_values)
+        return repr(self._wrapped)
+
+
+def get_key_values(field, instance):
+    """
+    :return: the values of the remote fields in the key of the related object of the instance, by name and
+        attname, or None if the instance point to nothing
+    :rtype: dict
+    """
+    local_values = field.get_local_related_value(instance)
+    if None in local_values:
+        return None
+    local_values = iter(local_values)
+    remote_fields = field.resolved_fields.remote
+    key_values = {}
+    for remote, part in field._raw_fields.items():
+        value = next(local_values) if part.is_local_field else part.value
+        remote_field = remote_fields[remote]
+        key_values[remote_field.attname] = value
+        if not remote_field.is_relation:
+            key_values[remote_field.name] = value
+    return key_values
+
+
 class CompositeForwardManyToOneDescriptor(ForwardManyToOneDescriptor):
+    def __get__(self, instance, cls=None):
+        if instance is not None and self.field.key_proxy and not self.is_cached(instance):
+            key_values = get_key_values(self.field, instance)
+            if key_values is not None:
+                return CompositeKeyProxy(lambda: self.get_related(instance), key_values)
+        return self.get_related(instance, cls)
+
+    def get_related(self, instance, cls=None):
+        """
+        the related object of the instance, loaded if needed (never a CompositeKeyProxy)
+        """
+        if stats.enabled and instance is not None:
+            stats.record_access(self.field, self.is_cached(instance))
+        return super(CompositeForwardManyToOneDescriptor, self).__get__(instance, cls)
+
+    def get_queryset(self, **hints):
+        queryset = super(CompositeForwardManyToOneDescriptor, self).get_queryset(**hints)
+        return routing.route_queryset(queryset, self.field)
+
+    def get_object(self, instance):
+        if self.field.auto_prefetch:
+            others = siblings.get_siblings(instance, self)
+            if others:
+                # load the relation of the whole evaluation, as prefetch_related would have
+                prefetch_related_objects([instance] + others, self.field.name)
+                return get_cached_value(instance, self, None)
+        if not self.field.thread_safe:
+            return self._get_object(instance)
+        # the threads loading the same related object share one query, and the same object. the cache of the
+        # instance is set once by __get__ : a single assignment, which can't be seen half done by another thread
+        key = (
+            self.field,
+            instance._state.db,
+            routing.get_read_database(self.field),
+            self.field.get_local_related_value(instance),
+            tuple(sorted(self.field.get_extra_descriptor_filter(instance).items())),
+        )
+        return singleflight.group.do(key, self._get_object, instance)
+
+    def _get_object(self, instance):
+        if not stats.enabled:
+            return routing.attach(super(CompositeForwardManyToOneDescriptor, self).get_object(instance), instance)
+        start = default_timer()
+        rows = 0
+        try:
+            rel_obj = super(CompositeForwardManyToOneDescriptor, self).get_object(instance)
+            rows = 1
+            return routing.attach(rel_obj, instance)
+        finally:
+            stats.record_fetch(self.field, "get", rows, default_timer() - start)
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        if queryset is None:
+            queryset = self.get_queryset()
+        queryset._add_hints(instance=instances[0])
+        queryset = routing.route_queryset(queryset, self.field)
+
+        rel_obj_attr = self.field.get_foreign_related_value
+        instance_attr = self.field.get_local_related_value
+        instances_dict = {instance_attr(inst): inst for inst in instances}
+        # one condition per distinct key instead of the join on the local table made by
+        # django, which return the related object once per instance
+        queryset = filter_by_keys(
+            queryset.filter(**self.field.get_extra_descriptor_filter(instances[0])),
+            self.field.foreign_related_fields,
+            instances_dict,
+        )
+        if stats.enabled:
+            stats.time_prefetch(queryset, self.field, len(instances))
+
+        # Since we're going to assign directly in the cache,
+        # we must manage the reverse relation cache manually.
+        if not self.field.remote_field.multiple:
+            for rel_obj in queryset:
+                instance = instances_dict[rel_obj_attr(rel_obj)]
+                set_cached_value_by_field(rel_obj, self.field.remote_field, instance)
+        if queryset._db is not None and queryset._db != instances[0]._state.db:
+            for rel_obj in queryset:
+                routing.attach(rel_obj, instances[0])
+        return get_prefetch_result(queryset, rel_obj_attr, instance_attr, True, self.field.get_cache_name())
+
     def __set__(self, instance, value):
+        previous_values = dirty.get_local_values(self.field, instance)
+        self._set(instance, value)
+        dirty.record_changes(self.field, instance, previous_values)
+
+    def _set(self, instance, value):
         if value is not None or not self.field.nullable_fields:
             super(CompositeForwardManyToOneDescriptor, self).__set__(instance, value)
         else:
@@ -48,3 +192,252 @@ class CompositeForwardManyToOneDescriptor(ForwardManyToOneDescriptor):
             # Set the related instance cache used by __get__ to avoid a SQL query
             # when accessing the attribute we just set.
             set_cached_value_by_descriptor(instance, self, None)
+
+
+def get_reverse_instance_attr(field):
+    """
+    return the function giving the remote key of an instance which can be the target of the composite field.
+    an instance whose values don't match the RawFieldValue of the field (ie: the address of a supplier for
+    Customer.address) has no related object : its key is None.
+    """
+    remote_fields = field.resolved_fields.remote
+    raw_values = [
+        (remote_fields[name].attname, value)
+        for name, value in field.get_extra_descriptor_filter(None).items()
+    ]
+    get_foreign_related_value = field.get_foreign_related_value
+
+    def instance_attr(instance):
+        if all(getattr(instance, attname) == value for attname, value in raw_values):
+            return get_foreign_related_value(instance)
+        return None
+    return instance_attr
+
+
+def get_reverse_instances_dict(instance_attr, instances):
+    instances_dict = {instance_attr(inst): inst for inst in instances}
+    instances_dict.pop(None, None)
+    return instances_dict
+
+
+def create_composite_reverse_many_to_one_manager(superclass, rel):
+    manager_cls = create_reverse_many_to_one_manager(superclass, rel)
+
+    class CompositeRelatedManager(manager_cls):
+        def _apply_rel_filters(self, queryset):
+            if get_reverse_instance_attr(self.field)(self.instance) is None:
+                return queryset.none()
+            return super(CompositeRelatedManager, self)._apply_rel_filters(queryset)
+
+        def get_prefetch_queryset(self, instances, queryset=None):
+            if queryset is None:
+                queryset = super(manager_cls, self).get_queryset()
+
+            queryset._add_hints(instance=instances[0])
+            queryset = routing.route_queryset(queryset, self.field)
+            queryset = queryset.using(queryset._db or self._db)
+
+            rel_obj_attr = self.field.get_local_related_value
+            instance_attr = get_reverse_instance_attr(self.field)
+            instances_dict = get_reverse_instances_dict(instance_attr, instances)
+            queryset = filter_by_keys(queryset, self.field.local_related_fields, instances_dict)
+            if self.field.partial_index and self.field.null_if_equal:
+                # the predicate of the partial index : the rows in null_if_equal are not related to anything
+                queryset.query.where.add(
+                    self.field.get_null_exclusion(queryset.query.get_initial_alias()), AND,
+                )
+            if stats.enabled:
+                stats.time_prefetch(queryset, self.field, len(instances))
+
+            # Since we just bypassed this class' get_queryset(), we must manage
+            # the reverse relation manually.
+            for rel_obj in queryset:
+                # a related object with a null_if_equal value is not related to anything
+                instance = instances_dict.get(rel_obj_attr(rel_obj))
+                if instance is not None:
+                    routing.attach(rel_obj, instance)
+                    setattr(rel_obj, self.field.name, instance)
+            cache_name = get_reverse_many_cache_name(self.field)
+            return get_prefetch_result(queryset, rel_obj_attr, instance_attr, False, cache_name)
+
+        # add(), remove(), clear() and set() run one UPDATE of the local columns of the related objects
+        # (see get_target_values and get_null_values), whatever their number, unless bulk=False
+
+        def get_target_values(self):
+            """
+            :return: the values of the local columns of the objects related to the instance, by attname
+            """
+            if get_reverse_instance_attr(self.field)(self.instance) is None:
+                raise ValueError("%r can't be the target of %s" % (self.instance, self.field))
+            return {
+                local.attname: getattr(self.instance, remote.attname) for local, remote in self.field.related_fields
+            }
+
+        def get_null_values(self):
+            """
+            :return: the values of the local columns of the objects related to nothing : the nullable_fields of
+                the field, else None for all of them
+            """
+            if self.field.nullable_fields:
+                return {
+                    self.model._meta.get_field(name).attname: value
+                    for name, value in self.field.nullable_fields.items()
+                }
+            return {local.attname: None for local in self.field.local_related_fields}
+
+        def get_update_queryset(self):
+            # a CompositeQuerySet refresh the mirrored columns of the updated rows
+            db = router.db_for_write(self.model, instance=self.instance)
+            return CompositeQuerySet(model=self.model, using=db)
+
+        def get_related_queryset(self):
+            """
+            :return: the objects related to the instance, to update
+            """
+            queryset = self.get_update_queryset().filter(**self.get_target_values())
+            for field_name, exception_value in self.field.null_if_equal:
+                queryset = queryset.exclude(**{field_name: exception_value})
+            return queryset
+
+        def check_objs(self, objs):
+            db = router.db_for_write(self.model, instance=self.instance)
+            for obj in objs:
+                if not isinstance(obj, self.model):
+                    raise TypeError("'%s' instance expected, got %r" % (self.model._meta.object_name, obj))
+                if obj._state.adding or obj._state.db != db:
+                    raise ValueError(
+                        "%r instance isn't saved. Use bulk=False or save the object first." % obj
+                    )
+
+        def get_pks(self, objs):
+            """
+            :return: the pks of the objects, or a subquery giving them if objs is a queryset
+            """
+            if not isinstance(objs, QuerySet):
+                return [obj.pk for obj in objs]
+            pks = objs.values("pk")
+            db = router.db_for_write(self.model, instance=self.instance)
+            if not connections[db].features.update_can_self_select:
+                pks = list(pks.values_list("pk", flat=True))
+            return pks
+
+        def update_objects(self, objs, values):
+            """
+            give the values to the objects (a list or a queryset) with one UPDATE setting all the local columns. the
+            diff is done by the database, on the composite tuple : the rows already having the values are not
+            updated, whatever the instances in memory hold.
+            """
+            self.get_update_queryset().filter(pk__in=self.get_pks(objs)).exclude(**values).update(**values)
+
+        def update_instances(self, objs, value, values):
+            # the objects in memory get the values written in the database
+            if isinstance(objs, QuerySet):
+                return
+            for obj in objs:
+                setattr(obj, self.field.name, value)
+                dirty.forget_changes(obj, values)
+
+        def add(self, *objs, **kwargs):
+            bulk = kwargs.pop("bulk", True)
+            if not bulk:
+                return super(CompositeRelatedManager, self).add(*objs, bulk=False)
+            self._remove_prefetched_objects()
+            self.check_objs(objs)
+            values = self.get_target_values()
+            self.update_objects(objs, values)
+            self.update_instances(objs, self.instance, values)
+        add.alters_data = True
+
+        def _set_objects(self, objs):
+            """
+            relate the objects to the instance, and only them
+            """
+            if not isinstance(objs, QuerySet):
+                self.check_objs(objs)
+            values = self.get_target_values()
+            if self.field.null:
+                self.get_related_queryset().exclude(pk__in=self.get_pks(objs)).update(**self.get_null_values())
+            self.update_objects(objs, values)
+            self.update_instances(objs, self.instance, values)
+
+        def set(self, objs, bulk=True, clear=False):
+            if not bulk:
+                return super(CompositeRelatedManager, self).set(objs, bulk=False, clear=clear)
+            self._remove_prefetched_objects()
+            if not isinstance(objs, QuerySet):
+                objs = tuple(objs)
+            elif clear:
+                # the queryset may be changed by clear()
+                objs = tuple(objs)
+            db = router.db_for_write(self.model, instance=self.instance)
+            with transaction.atomic(using=db, savepoint=False):
+                if clear and self.field.null:
+                    self.clear()
+                    self.add(*objs)
+                else:
+                    self._set_objects(objs)
+        set.alters_data = True
+
+        if rel.field.null:
+            def remove(self, *objs, **kwargs):
+                bulk = kwargs.pop("bulk", True)
+                if not bulk:
+                    return super(CompositeRelatedManager, self).remove(*objs, bulk=False)
+                self._remove_prefetched_objects()
+                key = self.field.get_foreign_related_value(self.instance)
+                for obj in objs:
+                    if self.field.get_local_related_value(obj) != key:
+                        raise self.field.remote_field.model.DoesNotExist(
+                            "%r is not related to %r." % (obj, self.instance)
+                        )
+                self.check_objs(objs)
+                values = self.get_null_values()
+                self.update_objects(objs, values)
+                self.update_instances(objs, None, values)
+            remove.alters_data = True
+
+            def clear(self, **kwargs):
+                bulk = kwargs.pop("bulk", True)
+                if not bulk:
+                    return super(CompositeRelatedManager, self).clear(bulk=False)
+                self._remove_prefetched_objects()
+                self.get_related_queryset().update(**self.get_null_values())
+            clear.alters_data = True
+
+    return CompositeRelatedManager
+
+
+class CompositeReverseManyToOneDescriptor(ReverseManyToOneDescriptor):
+    @cached_property
+    def related_manager_cls(self):
+        related_model = self.rel.related_model
+
+        return create_composite_reverse_many_to_one_manager(
+            related_model._default_manager.__class__,
+            self.rel,
+        )
+
+
+class CompositeReverseOneToOneDescriptor(ReverseOneToOneDescriptor):
+    def get_prefetch_queryset(self, instances, queryset=None):
+        if queryset is None:
+            queryset = self.get_queryset()
+        queryset._add_hints(instance=instances[0])
+
+        field = self.related.field
+        queryset = routing.route_queryset(queryset, field)
+        rel_obj_attr = field.get_local_related_value
+        instance_attr = get_reverse_instance_attr(field)
+        instances_dict = get_reverse_instances_dict(instance_attr, instances)
+        queryset = filter_by_keys(queryset, field.local_related_fields, instances_dict)
+        if stats.enabled:
+            stats.time_prefetch(queryset, field, len(instances))
+
+        # Since we're going to assign directly in the cache,
+        # we must manage the reverse relation cache manually.
+        for rel_obj in queryset:
+            instance = instances_dict.get(rel_obj_attr(rel_obj))
+            if instance is not None:
+                set_cached_value_by_field(rel_obj, field, instance)
+                routing.attach(rel_obj, instance)
+        return get_prefetch_result(queryset, rel_obj_attr, instance_attr, True, self.related.get_cache_name())
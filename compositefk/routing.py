@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+send the lazy loads and the prefetches of the composite relations to a read replica.
+
+the database is given per field (its label, see stats.get_label) or for all fields ("*") by the setting
+COMPOSITEFK_READ_DATABASES, and can be overridden for a block of code by read_from(). after a save or a delete
+of a model in the current thread, its reads stay on the database of the instance for COMPOSITEFK_STICKY_SECONDS
+(5 by default), so the replication lag don't hide the last writes. the window ends with the request.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.apps import apps
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db.models.signals import class_prepared, post_delete, post_save
+
+from compositefk.stats import get_label
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+_local = threading.local()
+_unset = object()
+# the concrete models read by the composite relations, whose writes are recorded
+_models = set()
+
+
+def register(model):
+    """
+    record the writes of model, read by a composite relation
+    """
+    if model._meta.apps is not apps:
+        # the models rendered by the migrations
+        return
+    _models.add(model._meta.concrete_model)
+    post_save.connect(record_write, sender=model, dispatch_uid="compositefk.routing.record_write.save")
+    post_delete.connect(record_write, sender=model, dispatch_uid="compositefk.routing.record_write.delete")
+
+
+def register_subclass(sender, **kwargs):
+    """
+    the proxies and the children of a registered model send their own signals
+    """
+    if any(model in _models for model in get_written_models(sender)):
+        register(sender)
+
+
+def get_written_models(model):
+    """
+    :return: the concrete models whose table is written by a save of model
+    """
+    return [model._meta.concrete_model] + list(model._meta.get_parent_list())
+
+
+def get_read_database(field, model=None):
+    """
+    :param model: the model read, the related model of the field by default
+    :return: the alias of the database to read the objects of the field from, or None to use the one
+        choosen by django (the database of the instance)
+    """
+    alias = getattr(_local, "alias", _unset)
+    if alias is not _unset:
+        return alias
+    if is_sticky(model or field.related_model):
+        return None
+    databases = getattr(settings, "COMPOSITEFK_READ_DATABASES", None)
+    if not databases:
+        return None
+    return databases.get(get_label(field), databases.get("*"))
+
+
+def route_queryset(queryset, field):
+    """
+    send the queryset of the related objects of the field to its read database, unless it already has one
+    """
+    if queryset._db is None:
+        alias = get_read_database(field, queryset.model)
+        if alias is not None:
+            return queryset.using(alias)
+    return queryset
+
+
+def attach(rel_obj, instance):
+    """
+    attach the related object read on a replica to the database of the instance, so it is saved there
+    """
+    if rel_obj is not None and instance._state.db is not None:
+        rel_obj._state.db = instance._state.db
+    return rel_obj
+
+
+@contextmanager
+def read_from(alias):
+    """
+    read the composite relations from the given database in this block of code, or from the database of the
+    instance if alias is None.
+    """
+    previous = getattr(_local, "alias", _unset)
+    _local.alias = alias
+    try:
+        yield
+    finally:
+        if previous is _unset:
+            del _local.alias
+        else:
+            _local.alias = previous
+
+
+def get_last_writes():
+    last_writes = getattr(_local, "last_writes", None)
+    if last_writes is None:
+        last_writes = _local.last_writes = {}
+    return last_writes
+
+
+def record_write(sender, **kwargs):
+    """
+    start the window during which the current thread read the model sender from the database of the instances.
+    connected to post_save and post_delete, it should be called after a write which send no signal
+    (ie: QuerySet.update).
+    """
+    now = default_timer()
+    last_writes = get_last_writes()
+    for model in get_written_models(sender):
+        last_writes[model] = now
+
+
+def is_sticky(model):
+    last_write = get_last_writes().get(model._meta.concrete_model)
+    if last_write is None:
+        return False
+    return default_timer() - last_write < getattr(settings, "COMPOSITEFK_STICKY_SECONDS", 5)
+
+
+def get_state():
+    """
+    :return: the routing state of the current thread (read_from and last writes), to give to another thread
+        working for it with set_state
+    """
+    return getattr(_local, "alias", _unset), dict(get_last_writes())
+
+
+def set_state(state):
+    alias, last_writes = state
+    _local.last_writes = dict(last_writes)
+    if alias is _unset:
+        _local.__dict__.pop("alias", None)
+    else:
+        _local.alias = alias
+
+
+def reset(**kwargs):
+    """
+    forget the last writes of the current thread. connected to request_finished.
+    """
+    _local.last_writes = {}
+
+
+class_prepared.connect(register_subclass, dispatch_uid="compositefk.routing.register_subclass")
+request_finished.connect(reset, dispatch_uid="compositefk.routing.reset")
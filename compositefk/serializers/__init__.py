@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+serializers which write the CompositeForeignKey as the natural key of the related object (the list of its values
+in the order of to_fields), computed from the local values without any query, and which read it back into the
+local fields.
+
+register them in the settings to use them with dumpdata and loaddata:
+
+    SERIALIZATION_MODULES = {
+        "json": "compositefk.serializers.json",
+        "python": "compositefk.serializers.python",
+    }
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.python import _get_model
+
+from compositefk.fields import CompositeForeignKey, RawFieldValue
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class CompositeSerializerMixin(object):
+    """
+    mixin for the serializers based on the python one : the CompositeForeignKey give the remote key
+    instead of fetching the related object.
+    """
+
+    def handle_fk_field(self, obj, field):
+        if isinstance(field, CompositeForeignKey):
+            key = field.get_remote_key(obj)
+            self._current[field.name] = None if key is None else list(key)
+        else:
+            super(CompositeSerializerMixin, self).handle_fk_field(obj, field)
+
+
+def expand_composite_value(field, key, data):
+    """
+    update the serialized fields of an object with the local values given by the key of a CompositeForeignKey.
+    :param CompositeForeignKey field: the composite field
+    :param list key: the remote key, in the order of to_fields, or None if the relation point to nothing
+    :param dict data: the serialized fields of the object
+    """
+    if key is None:
+        for field_name, value in field.nullable_fields.items():
+            data.setdefault(field_name, value)
+        return
+    if len(key) != len(field._raw_fields):
+        raise DeserializationError(
+            "%s.%s expect a key of %d values, got %r" % (
+                field.model._meta.label, field.name, len(field._raw_fields), key
+            )
+        )
+    local_fields = field.resolved_fields.local
+    for (remote, part), value in zip(field._raw_fields.items(), key):
+        if part.is_local_field:
+            data[local_fields[part.value].name] = value
+        elif isinstance(part, RawFieldValue) and value != part.value:
+            raise DeserializationError(
+                "%s.%s can't point to %s=%r, only to %r" % (
+                    field.model._meta.label, field.name, remote, value, part.value
+                )
+            )
+
+
+def expand_composite_keys(object_list, ignorenonexistent=False):
+    """
+    replace the keys of the CompositeForeignKey by their local values in the serialized objects, which can then be
+    given to the python Deserializer of django.
+    """
+    for d in object_list:
+        try:
+            model = _get_model(d["model"])
+        except (DeserializationError, KeyError):
+            if not ignorenonexistent:
+                raise
+            yield d
+            continue
+        fields = d.get("fields", {})
+        for field in model._meta.fields:
+            if isinstance(field, CompositeForeignKey) and field.name in fields:
+                fields = dict(fields)
+                expand_composite_value(field, fields.pop(field.name), fields)
+        if fields is not d.get("fields"):
+            d = dict(d, fields=fields)
+        yield d
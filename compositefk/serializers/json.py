@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import json
+import logging
+import sys
+
+from django.core.serializers import json as django_json
+from django.core.serializers.base import DeserializationError
+from django.utils import six
+
+from compositefk.serializers import CompositeSerializerMixin
+from compositefk.serializers.python import Deserializer as PythonDeserializer
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class Serializer(CompositeSerializerMixin, django_json.Serializer):
+    pass
+
+
+def Deserializer(stream_or_string, **options):
+    """
+    Deserialize a stream or string of JSON data.
+    """
+    if not isinstance(stream_or_string, (bytes, six.string_types)):
+        stream_or_string = stream_or_string.read()
+    if isinstance(stream_or_string, bytes):
+        stream_or_string = stream_or_string.decode('utf-8')
+    try:
+        objects = json.loads(stream_or_string)
+        for obj in PythonDeserializer(objects, **options):
+            yield obj
+    except GeneratorExit:
+        raise
+    except DeserializationError:
+        raise
+    except Exception as e:
+        # Map to deserializer error
+        six.reraise(DeserializationError, DeserializationError(e), sys.exc_info()[2])
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.core.serializers import python
+
+from compositefk.serializers import CompositeSerializerMixin, expand_composite_keys
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class Serializer(CompositeSerializerMixin, python.Serializer):
+    pass
+
+
+def Deserializer(object_list, **options):
+    return python.Deserializer(
+        expand_composite_keys(object_list, options.get("ignorenonexistent", False)),
+        **options
+    )
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+the instances given by the same evaluation of a CompositeQuerySet remember each other (their siblings), with
+weak references : the first lazy load of a CompositeForeignKey(auto_prefetch=True) on one of them load the
+relation of all its siblings still alive with one query, as prefetch_related would have.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import weakref
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# the attribute of the instances holding their Siblings
+SIBLINGS_ATTR = "_compositefk_siblings"
+
+
+class Siblings(object):
+    """
+    the weak references to the instances of one evaluation
+    """
+
+    def __init__(self, instances):
+        self._refs = [weakref.ref(instance) for instance in instances]
+
+    def __reduce__(self):
+        # a pickled instance (ie: in a cache) come back alone
+        return self.__class__, ([],)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def alive(self):
+        """
+        :return: the instances not collected yet
+        :rtype: list
+        """
+        return [instance for instance in (ref() for ref in self._refs) if instance is not None]
+
+
+def remember(instances):
+    """
+    make each instance remember the others
+    """
+    if len(instances) < 2:
+        return
+    siblings = Siblings(instances)
+    for instance in instances:
+        setattr(instance, SIBLINGS_ATTR, siblings)
+
+
+def get_siblings(instance, descriptor):
+    """
+    :return: the siblings of the instance (not itself) still alive, of the same model and database, whose
+        relation of the descriptor is not loaded yet
+    :rtype: list
+    """
+    siblings = getattr(instance, SIBLINGS_ATTR, None)
+    if siblings is None:
+        return []
+    return [
+        sibling for sibling in siblings.alive()
+        if sibling is not instance and type(sibling) is type(instance)
+        and sibling._state.db == instance._state.db and not descriptor.is_cached(sibling)
+    ]
+
+
+def has_auto_prefetch(model):
+    """
+    :return: True if the instances of the model need to know their siblings
+    """
+    from compositefk.fields import CompositeForeignKey  # fields import this module via the descriptors
+
+    return any(isinstance(field, CompositeForeignKey) and field.auto_prefetch for field in model._meta.fields)
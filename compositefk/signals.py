@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.dispatch import Signal
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+# sent each time a composite relation is read from the database, only if the stats are enabled.
+# the sender is the model of the CompositeForeignKey, kind is "get" for a lazy load or "prefetch",
+# batch_size is the number of instances the query was made for.
+relation_fetched = Signal(providing_args=["field", "kind", "rows", "duration", "batch_size"])
+
+# sent on each access to a composite relation, only if the stats are enabled.
+# hit is True if the related object was served from the instance cache.
+relation_accessed = Signal(providing_args=["field", "hit"])
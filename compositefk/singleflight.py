@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+collapse the concurrent calls of a function for the same key into one : the first thread run it, the others
+wait for its result. nothing is kept once the call is done, it's not a cache.
+
+used by the CompositeForeignKey(thread_safe=True) so the threads sharing some instances load a related object
+with one query, instead of one per thread.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    def __init__(self):
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        call fn(*args, **kwargs), or wait for the call already running for key in another thread, and return
+        its result (or raise its exception)
+        """
+        call = Call()
+        # dict.setdefault is atomic : only one thread get its own call back, without lock
+        running = self._calls.setdefault(key, call)
+        if running is not call:
+            running.done.wait()
+            if running.error is not None:
+                raise running.error
+            return running.result
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        """
+        :return: the number of calls running
+        """
+        return len(self._calls)
+
+
+group = Group()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.db.models.query import ModelIterable
+
+from compositefk import signals
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+enabled = False
+
+_lock = threading.Lock()
+_stats = {}
+# the field and the number of instances of a prefetch queryset, see time_prefetch
+TIMING_ATTR = "_compositefk_timing"
+
+
+class FieldStats(object):
+    """
+    the statistics of one CompositeForeignKey
+    """
+    ordering_keys = ("queries", "rows", "duration", "cache_hits", "cache_misses", "prefetch_batches")
+
+    def __init__(self, label):
+        self.label = label
+        self.queries = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.prefetch_batches = 0
+        self.prefetch_instances = 0
+        self.max_prefetch_batch = 0
+
+    @property
+    def mean_prefetch_batch(self):
+        if not self.prefetch_batches:
+            return 0.0
+        return float(self.prefetch_instances) / self.prefetch_batches
+
+    def as_dict(self):
+        return {
+            "label": self.label,
+            "queries": self.queries,
+            "rows": self.rows,
+            "duration": self.duration,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "prefetch_batches": self.prefetch_batches,
+            "prefetch_instances": self.prefetch_instances,
+            "max_prefetch_batch": self.max_prefetch_batch,
+        }
+
+    def __repr__(self):
+        return "<FieldStats %s: %d queries, %d rows, %.6fs>" % (self.label, self.queries, self.rows, self.duration)
+
+
+def get_label(field):
+    return "%s.%s" % (field.model._meta.label, field.name)
+
+
+def _get_field_stats(field):
+    label = get_label(field)
+    if label not in _stats:
+        _stats[label] = FieldStats(label)
+    return _stats[label]
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+@contextmanager
+def recording(clear=True):
+    """
+    enable the statistics for the duration of the block
+    :param bool clear: reset the previous statistics before
+    """
+    global enabled
+    previous = enabled
+    if clear:
+        reset()
+    enabled = True
+    try:
+        yield
+    finally:
+        enabled = previous
+
+
+def get_stats(order_by="queries"):
+    """
+    return the statistics of each field which was used, the most expensive first
+    :param str order_by: one of FieldStats.ordering_keys
+    :rtype: list[FieldStats]
+    """
+    if order_by not in FieldStats.ordering_keys:
+        raise ValueError(
+            "can't order the stats by %s. choices are %s" % (order_by, ", ".join(FieldStats.ordering_keys))
+        )
+    with _lock:
+        stats = list(_stats.values())
+    return sorted(stats, key=lambda s: (getattr(s, order_by), s.label), reverse=True)
+
+
+def get_field_stats(field):
+    """
+    return the statistics of the given CompositeForeignKey, or None if it was not used
+    :rtype: FieldStats
+    """
+    return _stats.get(get_label(field))
+
+
+def record_access(field, hit):
+    with _lock:
+        field_stats = _get_field_stats(field)
+        if hit:
+            field_stats.cache_hits += 1
+        else:
+            field_stats.cache_misses += 1
+    signals.relation_accessed.send(sender=field.model, field=field, hit=hit)
+
+
+def record_fetch(field, kind, rows, duration, batch_size=1):
+    with _lock:
+        field_stats = _get_field_stats(field)
+        field_stats.queries += 1
+        field_stats.rows += rows
+        field_stats.duration += duration
+        if kind == "prefetch":
+            field_stats.prefetch_batches += 1
+            field_stats.prefetch_instances += batch_size
+            field_stats.max_prefetch_batch = max(field_stats.max_prefetch_batch, batch_size)
+    signals.relation_fetched.send(
+        sender=field.model, field=field, kind=kind, rows=rows, duration=duration, batch_size=batch_size,
+    )
+
+
+class TimedModelIterable(ModelIterable):
+    """
+    the iterable of a prefetch queryset which record its fetch once it is read (see time_prefetch)
+    """
+
+    def __iter__(self):
+        timing = getattr(self.queryset, TIMING_ATTR, None)
+        if timing is None:
+            # a clone of the prefetch queryset
+            for obj in super(TimedModelIterable, self).__iter__():
+                yield obj
+            return
+        field, batch_size = timing
+        start = default_timer()
+        rows = 0
+        try:
+            for obj in super(TimedModelIterable, self).__iter__():
+                rows += 1
+                yield obj
+        finally:
+            record_fetch(field, "prefetch", rows, default_timer() - start, batch_size=batch_size)
+
+
+def time_prefetch(queryset, field, batch_size):
+    """
+    record the fetch of the queryset returned by a get_prefetch_queryset when it is evaluated, wherever it is : its
+    own prefetch lookups are run after, and are not counted in its duration
+    :param batch_size: the number of instances whose related objects are prefetched
+    """
+    if queryset._iterable_class is ModelIterable:
+        queryset._iterable_class = TimedModelIterable
+        setattr(queryset, TIMING_ATTR, (field, batch_size))
+    return queryset
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+validate the composite relations of many instances at once : full_clean() load the related object of each
+CompositeForeignKey of each instance, with one query per relation (and raise DoesNotExist if it is missing).
+here, the keys of all the instances are checked with one query per field and per chunk of 1000 distinct keys.
+
+    errors = bulk_full_clean(contacts)  # {position of the contact: ValidationError}
+    for i, error in errors.items():
+        print(contacts[i], error.message_dict)
+
+the keys made None by null_if_equal are not checked, and the RawFieldValue parts filter the related objects.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import router
+
+from compositefk.fields import CompositeForeignKey
+from compositefk.loading import find_missing_keys
+
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+def get_composite_fields(model, exclude=None):
+    """
+    :return: the CompositeForeignKey of the model validated by full_clean (not excluded)
+    :rtype: list[CompositeForeignKey]
+    """
+    return [
+        field for field in model._meta.fields
+        if isinstance(field, CompositeForeignKey) and field.name not in (exclude or ())
+    ]
+
+
+def get_invalid_error(field, instance):
+    key = field.get_remote_key(instance)
+    return ValidationError(field.error_messages["invalid"], code="invalid", params={
+        "model": field.related_model._meta.verbose_name,
+        "field": ", ".join(field._raw_fields),
+        "value": tuple(key),
+    })
+
+
+def validate_relations(instances, exclude=None, using=None, batch_size=1000):
+    """
+    check that the related object of each CompositeForeignKey of the instances (all of the same model) exists,
+    with one query per field and per batch of batch_size distinct keys.
+    :param exclude: the names of the fields not to check
+    :param using: the database of the related objects, the one of the router by default
+    :return: the errors of the invalid instances, by position in instances then by field name
+    :rtype: dict[int, dict[str, list[ValidationError]]]
+    """
+    instances = list(instances)
+    errors = {}
+    if not instances:
+        return errors
+    for field in get_composite_fields(type(instances[0]), exclude):
+        keys = [field.get_local_related_value(instance) for instance in instances]
+        database = using or router.db_for_read(field.related_model, instance=instances[0])
+        missing = find_missing_keys(field, keys, using=database, batch_size=batch_size)
+        if not missing:
+            continue
+        for i, (instance, key) in enumerate(zip(instances, keys)):
+            if key in missing:
+                errors.setdefault(i, {}).setdefault(field.name, []).append(get_invalid_error(field, instance))
+    return errors
+
+
+def bulk_full_clean(instances, exclude=None, validate_unique=True, using=None, batch_size=1000):
+    """
+    full_clean() the instances (all of the same model), whose composite relations are checked by
+    validate_relations instead of one query per instance.
+    :return: the errors of the invalid instances, by position in instances
+    :rtype: dict[int, ValidationError]
+    """
+    instances = list(instances)
+    if not instances:
+        return {}
+    exclude = list(exclude or ())
+    fields = get_composite_fields(type(instances[0]), exclude)
+    errors = validate_relations(instances, exclude, using=using, batch_size=batch_size)
+    skipped = exclude + [field.name for field in fields]
+    for i, instance in enumerate(instances):
+        try:
+            instance.full_clean(exclude=skipped, validate_unique=validate_unique)
+        except ValidationError as e:
+            for name, field_errors in e.update_error_dict({}).items():
+                errors.setdefault(i, {}).setdefault(name, []).extend(field_errors)
+    return {i: ValidationError(instance_errors) for i, instance_errors in errors.items()}
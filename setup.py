@@ -34,6 +34,9 @@ setup(
     url='https://github.com/onysos/django-composite-foreignkey',
     packages=[
         'compositefk',
+        'compositefk.management',
+        'compositefk.management.commands',
+        'compositefk.serializers',
     ],
     include_package_data=True,
     install_requires=[
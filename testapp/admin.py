@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import logging
+
+from django.contrib import admin
+
+from compositefk.admin import CompositeForeignKeyAdminMixin
+from testapp.models import Address, Customer, Contact
+
+logger = logging.getLogger(__name__)
+__author__ = 'darius.bernard'
+
+
+@admin.register(Address)
+class AddressAdmin(admin.ModelAdmin):
+    search_fields = ["city", "postcode"]
+
+
+@admin.register(Customer)
+class CustomerAdmin(CompositeForeignKeyAdminMixin, admin.ModelAdmin):
+    list_display = ("name", "address", "representant")
+    search_fields = ["name"]
+
+
+@admin.register(Contact)
+class ContactAdmin(CompositeForeignKeyAdminMixin, admin.ModelAdmin):
+    list_display = ("surname", "customer")
+    list_composite_related = ("customer__address", "customer__extra")
+    composite_raw_id_fields = ("customer",)
@@ -12,6 +12,7 @@ from django.db.models.deletion import CASCADE, DO_NOTHING
 from django.conf import global_settings
 from django.utils.translation import get_language
 
+from compositefk import cascade
 from compositefk.fields import (
     CompositeForeignKey,
     RawFieldValue,
@@ -19,6 +20,8 @@ from compositefk.fields import (
     CompositeOneToOneField,
     FunctionBasedFieldValue,
 )
+from compositefk.mirroring import MirrorFieldsMixin
+from compositefk.query import CompositeQuerySet
 
 logger = logging.getLogger(__name__)
 __author__ = 'darius.bernard'
@@ -31,6 +34,8 @@ class Address(models.Model):
     city = models.CharField(max_length=255)
     postcode = models.CharField(max_length=32)
 
+    objects = CompositeQuerySet.as_manager()
+
     class Meta(object):
         unique_together = [
             ("company", "tiers_id", "type_tiers"),
@@ -88,6 +93,8 @@ class Customer(models.Model):
        ]
     )
 
+    objects = CompositeQuerySet.as_manager()
+
     class Meta(object):
         unique_together = [
             ("company", "customer_id"),
@@ -120,6 +127,8 @@ class Contact(models.Model):
         ("customer_id", "customer_code"),
     ]))
 
+    objects = CompositeQuerySet.as_manager()
+
 
 class PhoneNumber(models.Model):
     num = models.CharField(max_length=32)
@@ -183,3 +192,91 @@ active_translations = CompositeForeignKey(
 
 
 active_translations.contribute_to_class(MultiLangSupplier, 'active_translations')
+
+
+# the models of the opt-in options of CompositeForeignKey, so the ones above keep the default behaviour
+
+class MirroredCustomer(MirrorFieldsMixin, models.Model):
+    """
+    a customer which hold a copy of the columns of its address (see mirror_fields)
+    """
+    company = models.IntegerField()
+    customer_id = models.IntegerField()
+    name = models.CharField(max_length=255)
+    address_city = models.CharField(max_length=255, null=True, blank=True)
+    address_postcode = models.CharField(max_length=32, null=True, blank=True)
+
+    address = CompositeForeignKey(Address, on_delete=CASCADE, null=True, to_fields=OrderedDict([
+        ("company", LocalFieldValue("company")),
+        ("tiers_id", "customer_id"),
+        ("type_tiers", RawFieldValue("C"))
+    ]), null_if_equal=[
+        ("company", -1),
+        ("customer_id", -1)
+    ], mirror_fields={
+        "address_city": "city",
+        "address_postcode": "postcode",
+    })
+
+    objects = CompositeQuerySet.as_manager()
+
+
+class IndexedCustomer(models.Model):
+    """
+    a customer whose key is indexed without the null_if_equal values (see partial_index)
+    """
+    company = models.IntegerField()
+    customer_id = models.IntegerField()
+    name = models.CharField(max_length=255)
+
+    address = CompositeForeignKey(Address, on_delete=CASCADE, null=True, related_name="indexed_customers",
+                                  to_fields=OrderedDict([
+                                      ("company", LocalFieldValue("company")),
+                                      ("tiers_id", "customer_id"),
+                                      ("type_tiers", RawFieldValue("C"))
+                                  ]), null_if_equal=[
+                                      ("company", -1),
+                                      ("customer_id", -1)
+                                  ], partial_index=True)
+
+    objects = CompositeQuerySet.as_manager()
+
+
+class Account(models.Model):
+    """
+    the target of relations which follow the changes of its key (see on_update)
+    """
+    company = models.IntegerField()
+    account_id = models.IntegerField()
+    name = models.CharField(max_length=255)
+
+    objects = CompositeQuerySet.as_manager()
+
+    class Meta(object):
+        unique_together = [
+            ("company", "account_id"),
+        ]
+
+
+class AccountContact(models.Model):
+    company_code = models.IntegerField()
+    account_code = models.IntegerField()
+    surname = models.CharField(max_length=255)
+    account = CompositeForeignKey(Account, on_delete=CASCADE, related_name='contacts', to_fields=OrderedDict([
+        ("company", "company_code"),
+        ("account_id", "account_code"),
+    ]), on_update=cascade.CASCADE)
+
+    objects = CompositeQuerySet.as_manager()
+
+
+class AccountExtra(models.Model):
+    company = models.IntegerField()
+    account_id = models.IntegerField()
+    sales_revenue = models.FloatField()
+    account = CompositeOneToOneField(
+        Account,
+        on_delete=CASCADE,
+        related_name='extra',
+        to_fields=["company", "account_id"],
+        on_update=cascade.CASCADE)
@@ -4,7 +4,16 @@
 
 from __future__ import unicode_literals, print_function, absolute_import
 
+import copy
+import gc
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
 from random import random
+from unittest import skipIf
 
 from django.utils import translation
 
@@ -17,21 +26,57 @@ try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
+
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from compositefk.dataloader import CompositeLoader
+except ImportError:  # python 2
+    asyncio = None
 import logging
 
 from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import DatabaseError, close_old_connections, connection, transaction
 from django.db.migrations.autodetector import MigrationAutodetector
 from django.db.migrations.loader import MigrationLoader
 from django.db.migrations.questioner import NonInteractiveMigrationQuestioner
-from django.core import checks
+from django.core import checks, serializers
+from django.core.exceptions import FieldError
+from django.core.paginator import InvalidPage
+from django.core.serializers.base import DeserializationError
+from django.core.signals import request_finished
 from django.db.migrations.state import ProjectState
 from django.db.migrations.writer import MigrationWriter
+from django.db.models import CASCADE, Count, F, Prefetch, Q
+from django.db.models.expressions import OrderBy
 from django.db.models.fields.reverse_related import ForeignObjectRel
-from django.test.testcases import TestCase
-from compositefk.fields import CompositeForeignKey, RawFieldValue, FunctionBasedFieldValue
+from django.db.models.signals import post_save, pre_save
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.test.testcases import TestCase, TransactionTestCase
+from compositefk import cascade, dirty, mirroring, routing, siblings, signals, singleflight, stats
+from compositefk.admin import split_composite_lookups
+from compositefk.aggregates import CompositeCount, CompositeSum
+from compositefk.indexes import CompositePartialIndex, check_partial_indexes, get_field_index
+from compositefk.loading import find_missing_references, sort_models
+from compositefk.pagination import KeysetPaginator, keyset_iterator
+from compositefk.partition import KeyRange, filter_key_range, run_key_ranges, split_key_ranges
+from compositefk.prefetch import can_use_threads, group_lookups, parallel_prefetch_related_objects
+from compositefk.query import expand_composite_name
+from compositefk.validation import bulk_full_clean, validate_relations
+from compositefk.related_descriptors import CompositeForwardManyToOneDescriptor
+from compositefk.fields import (
+    CompositeForeignKey,
+    CompositeKey,
+    RawFieldValue,
+    FunctionBasedFieldValue,
+    LocalFieldValue,
+)
 from testapp.models import (
     Customer,
     Contact,
@@ -42,12 +87,33 @@ from testapp.models import (
     PhoneNumber,
     Representant,
     MultiLangSupplier,
+    Supplier,
+    Account,
+    AccountContact,
+    AccountExtra,
+    IndexedCustomer,
+    MirroredCustomer,
 )
 
 logger = logging.getLogger(__name__)
 __author__ = 'darius.bernard'
 
 
+def replay_workload():
+    for contact in Contact.objects.all():
+        contact.customer.name
+        contact.customer.name
+    list(Customer.objects.prefetch_related("address"))
+
+
+def count_rows(queryset):
+    return queryset.count()
+
+
+def describe_range(queryset):
+    return os.getpid(), str(queryset.query)
+
+
 class TestGetterSetter(TestCase):
     fixtures = ["all_fixtures.json"]
 
@@ -113,6 +179,20 @@ class TestForeignKeyStruct(TestCase):
 
         self.assertIsNone(field.db_type(None))
 
+    def test_resolved_fields(self):
+        field = Customer._meta.get_field("address")
+        resolved = field.resolved_fields
+        self.assertIs(resolved, field.resolved_fields)
+        self.assertEqual(list(resolved.local.items()), [
+            ("company", Customer._meta.get_field("company")),
+            ("customer_id", Customer._meta.get_field("customer_id")),
+        ])
+        self.assertEqual(list(resolved.remote.values()), [
+            Address._meta.get_field("company"),
+            Address._meta.get_field("tiers_id"),
+            Address._meta.get_field("type_tiers"),
+        ])
+
 
 class TestLookupQuery(TestCase):
     fixtures = ["all_fixtures.json"]
@@ -151,6 +231,15 @@ class TestLookupQuery(TestCase):
         address = Address.objects.get(pk=1)
         PhoneNumber.objects.filter(contact__customer__address=address)
 
+    def test_forward_prefetch_null_if_equal(self):
+        address = Address.objects.get(pk=1)
+        with self.assertNumQueries(2):
+            customers = {c.pk: c for c in Customer.objects.prefetch_related("address")}
+            self.assertEqual(customers[1].address, address)
+            # company is -1, the address with company -1 must not be attached
+            self.assertIsNone(customers[5].address)
+            self.assertIsNone(customers[4].address)
+
     def test_very_deep_optimized_backward(self):
         # this query is optimized by django
         phonenumber = PhoneNumber.objects.get(pk=1)
@@ -195,6 +284,65 @@ class TestCompositePart(TestCase):
         self.assertNotEqual(field1, field2)
         self.assertNotEqual(field2, field1)
 
+    def test_hash(self):
+        parts = {
+            RawFieldValue('C'), RawFieldValue('C'), LocalFieldValue('C'),
+            FunctionBasedFieldValue(self._f1), FunctionBasedFieldValue(self._f1),
+        }
+        self.assertEqual(len(parts), 3)
+        self.assertIn(RawFieldValue('C'), parts)
+
+    def test_immutable(self):
+        field = RawFieldValue('C')
+        with self.assertRaises(AttributeError):
+            field.value = 'S'
+        with self.assertRaises(AttributeError):
+            field.other = 'S'
+        with self.assertRaises(AttributeError):
+            field._value = 'S'
+        with self.assertRaises(AttributeError):
+            del field._value
+        self.assertEqual(field.value, 'C')
+        self.assertFalse(hasattr(field, "__dict__"))
+        self.assertEqual(copy.deepcopy(field), field)
+        self.assertEqual(pickle.loads(pickle.dumps(field)), field)
+        self.assertEqual(copy.copy(FunctionBasedFieldValue(self._f2)).value, 1)
+
+
+class TestCompositeKey(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_tuple_compatible(self):
+        key = CompositeKey((1, 10, 'C'))
+        self.assertEqual(key, (1, 10, 'C'))
+        self.assertEqual(hash(key), hash((1, 10, 'C')))
+        self.assertEqual({(1, 10, 'C'): 1}[key], 1)
+        self.assertEqual(repr(key), "CompositeKey%r" % ((1, 10, 'C'),))
+        self.assertFalse(hasattr(key, "__dict__"))
+
+    def test_intern(self):
+        key = CompositeKey.intern((1, 10, 'C'))
+        self.assertIs(CompositeKey.intern([1, 10, 'C']), key)
+        self.assertIs(CompositeKey.intern(CompositeKey((1, 10, 'C'))), key)
+
+    def test_field_keys(self):
+        field = Customer._meta.get_field("address")
+        customer = Customer.objects.get(pk=1)
+        self.assertIsInstance(field.get_local_related_value(customer), CompositeKey)
+        self.assertEqual(field.get_local_related_value(customer), (1, 10))
+        self.assertEqual(field.get_remote_key(customer), CompositeKey((1, 10, 'C')))
+        self.assertIs(
+            field.get_remote_key(customer, intern=True),
+            field.get_remote_key(Customer.objects.get(pk=1), intern=True),
+        )
+        self.assertEqual(field.get_remote_key(customer), field.get_foreign_related_value(customer.address) + ('C',))
+        # null_if_equal
+        self.assertIsNone(field.get_remote_key(Customer.objects.get(pk=5)))
+        field = MultiLangSupplier._meta.get_field("active_translations")
+        with translation.override('ru'):
+            key = field.get_remote_key(MultiLangSupplier.objects.get(pk=1))
+        self.assertEqual(dict(zip(field._raw_fields, key)), {"master_id": 1, "language_code": "ru"})
+
 
 class TestExtraFilterRawValue(TestCase):
     fixtures = ["all_fixtures.json"]
@@ -244,6 +392,16 @@ class TestNullIfEqual(TestCase):
         self.assertIsNone(customer.address)
 
 
+def copy_customers(model):
+    """
+    insert the customers of the fixtures in a model having the same columns, without the signals
+    """
+    model.objects.bulk_create([
+        model(pk=customer.pk, company=customer.company, customer_id=customer.customer_id, name=customer.name)
+        for customer in Customer.objects.order_by("pk")
+    ])
+
+
 class TestDeconstuct(TestCase):
     def test_deconstruct(self):
         name, path, args, kwargs = Contact._meta.get_field("customer").deconstruct()
@@ -255,6 +413,12 @@ class TestDeconstuct(TestCase):
         name, path, args, kwargs = Contact._meta.get_field("customer").deconstruct()
         CompositeForeignKey(*args, **kwargs)
 
+    @mock.patch.object(Contact._meta.get_field("customer"), "thread_safe", True)
+    def test_reconstruct_thread_safe(self):
+        name, path, args, kwargs = Contact._meta.get_field("customer").deconstruct()
+        self.assertTrue(kwargs["thread_safe"])
+        self.assertTrue(CompositeForeignKey(*args, **kwargs).thread_safe)
+
     def test_models_check(self):
         self.maxDiff = None
         app_configs = [apps.get_app_config("testapp")]
@@ -277,6 +441,7 @@ class TestDeconstuct(TestCase):
             self.assertListEqual([issue.id for issue in all_issues], [
                 'compositefk.E001', 'compositefk.E002', 'compositefk.E003',
                 'compositefk.E003', 'compositefk.E004', 'compositefk.E006', 'compositefk.E005',
+                'compositefk.E007', 'compositefk.E007', 'compositefk.E008',
             ])
 
     def test_total_deconstruct(self):
@@ -304,6 +469,10 @@ class TestDeconstuct(TestCase):
 
                 migration_string = writer.as_string()
                 self.assertNotEqual(migration_string, "")
+        self.assertTrue(any(
+            "compositefk.indexes.CompositePartialIndex" in MigrationWriter(migration).as_string()
+            for migration in changes["testapp"]
+        ))
 
 
 class TestOneToOne(TestCase):
@@ -327,6 +496,34 @@ class TestOneToOne(TestCase):
 
         self.assertEqual(Extra.objects.get(customer__name=customer.name), extra)
 
+    def test_reverse_select_related(self):
+        customer = Customer.objects.get(pk=1)
+        extra = Extra.objects.create(sales_revenue=17.35, customer=customer)
+
+        with self.assertNumQueries(1):
+            customers = {c.pk: c for c in Customer.objects.select_related("extra")}
+            # the reverse cache is filled for both existing and missing extra
+            self.assertEqual(customers[1].extra, extra)
+            self.assertEqual(customers[1].extra.sales_revenue, 17.35)
+            self.assertIs(customers[1].extra.customer, customers[1])
+            with self.assertRaises(Extra.DoesNotExist):
+                customers[2].extra
+
+    def test_reverse_select_related_chained(self):
+        customer = Customer.objects.get(pk=1)
+        extra = Extra.objects.create(sales_revenue=17.35, customer=customer)
+
+        with self.assertNumQueries(1):
+            phonenumber = PhoneNumber.objects.select_related("contact__customer__extra").get(pk=1)
+            self.assertEqual(phonenumber.contact.customer, customer)
+            self.assertEqual(phonenumber.contact.customer.extra, extra)
+
+        with self.assertNumQueries(1):
+            contacts = {c.pk: c for c in Contact.objects.select_related("customer__extra")}
+            self.assertEqual(contacts[2].customer.extra, extra)
+            with self.assertRaises(Extra.DoesNotExist):
+                contacts[1].customer.extra
+
 
 class TestDeletion(TestCase):
     fixtures = ["all_fixtures.json"]
@@ -440,3 +637,1593 @@ class TestToNone(TestCase):
     def test_inital_value_to_nullable(self):
         customer = Customer.objects.create(representant=None, name="test", customer_id=34, company=1)
         self.assertEqual("", customer.cod_rep)
+
+
+class TestAdmin(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        self.request = RequestFactory().get("/")
+        self.request.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+
+    def test_split_lookups(self):
+        self.assertEqual(
+            split_composite_lookups(Customer, ["name", "address", "representant", "extra", "contacts", "plop"]),
+            (["extra"], ["address", "representant", "contacts"]),
+        )
+        self.assertEqual(
+            split_composite_lookups(PhoneNumber, ["contact", "contact__customer", "contact__customer__address"]),
+            (["contact__customer"], ["contact__customer__address"]),
+        )
+
+    def test_changelist_queryset(self):
+        model_admin = admin.site._registry[Customer]
+        queryset = model_admin.apply_composite_related(Customer.objects.all(), model_admin.list_display)
+        with self.assertNumQueries(3):
+            rows = [(c.name, c.address, c.representant) for c in queryset]
+        self.assertEqual(len(rows), 5)
+
+        model_admin = admin.site._registry[Contact]
+        queryset = model_admin.apply_composite_related(Contact.objects.all(), model_admin.list_display)
+        with self.assertNumQueries(2):
+            rows = [(c.surname, c.customer, c.customer.address) for c in queryset]
+        self.assertEqual(rows[0][1], Customer.objects.get(pk=3))
+
+    def test_raw_id_form(self):
+        model_admin = admin.site._registry[Contact]
+        form_class = model_admin.get_form(self.request, Contact.objects.get(pk=1))
+        self.assertEqual(list(form_class.base_fields), ["surname", "customer"])
+
+        form = form_class(instance=Contact.objects.get(pk=1))
+        self.assertEqual(form.initial["customer"], (2, 10))
+
+        form = form_class(
+            {"surname": "rand", "customer_0": "1", "customer_1": "20"},
+            instance=Contact.objects.get(pk=1),
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        contact = form.save()
+        self.assertEqual((contact.company_code, contact.customer_code), (1, 20))
+        self.assertEqual(contact.customer, Customer.objects.get(pk=2))
+
+        form = form_class({"surname": "rand", "customer_0": "1", "customer_1": "99"})
+        self.assertFalse(form.is_valid())
+        self.assertIn("customer", form.errors)
+
+    def test_autocomplete(self):
+        model_admin = admin.site._registry[Contact]
+        response = model_admin.composite_autocomplete_view(self.request, "customer")
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([r["key"] for r in data["results"]], [[-1, 10], [1, 10], [1, 20], [2, -1], [2, 10]])
+        self.assertFalse(data["pagination"]["more"])
+
+        model_admin.composite_autocomplete_page_size = 1
+        try:
+            request = RequestFactory().get("/", {"term": "moiraine", "page": "2"})
+            request.user = self.request.user
+            with self.assertNumQueries(1):
+                response = model_admin.composite_autocomplete_view(request, "customer")
+        finally:
+            del model_admin.composite_autocomplete_page_size
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([r["key"] for r in data["results"]], [[2, 10]])
+        self.assertFalse(data["pagination"]["more"])
+
+
+class TestStats(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_disabled(self):
+        stats.reset()
+        replay_workload()
+        self.assertEqual(stats.get_stats(), [])
+
+    def test_recording(self):
+        with stats.recording():
+            replay_workload()
+        customer_stats = stats.get_field_stats(Contact._meta.get_field("customer"))
+        self.assertEqual(customer_stats.queries, 2)
+        self.assertEqual(customer_stats.rows, 2)
+        self.assertEqual(customer_stats.cache_misses, 2)
+        self.assertEqual(customer_stats.cache_hits, 2)
+        self.assertGreater(customer_stats.duration, 0)
+
+        address_stats = stats.get_field_stats(Customer._meta.get_field("address"))
+        self.assertEqual(address_stats.queries, 1)
+        self.assertEqual(address_stats.prefetch_batches, 1)
+        self.assertEqual(address_stats.max_prefetch_batch, 5)
+        self.assertEqual(
+            [s.label for s in stats.get_stats(order_by="cache_hits")],
+            ["testapp.Contact.customer", "testapp.Customer.address"],
+        )
+        self.assertFalse(stats.enabled)
+
+    def test_prefetch(self):
+        contact_field = Contact._meta.get_field("customer")
+        with stats.recording():
+            list(Customer.objects.prefetch_related("contacts", "extra"))
+        # the reverse relations are recorded on the field pointing to Customer
+        customer_stats = stats.get_field_stats(contact_field)
+        self.assertEqual((customer_stats.queries, customer_stats.rows, customer_stats.max_prefetch_batch), (1, 2, 5))
+        extra_stats = stats.get_field_stats(Extra._meta.get_field("customer"))
+        self.assertEqual((extra_stats.queries, extra_stats.prefetch_batches), (1, 1))
+        # a queryset with its own lookups is timed too, which are run once, and recorded apart
+        queryset = Customer.objects.prefetch_related("address")
+        with stats.recording(), self.assertNumQueries(3):
+            list(Contact.objects.prefetch_related(Prefetch("customer", queryset=queryset)))
+        self.assertEqual(stats.get_field_stats(contact_field).rows, 2)
+        self.assertEqual(stats.get_field_stats(Customer._meta.get_field("address")).max_prefetch_batch, 2)
+
+    def test_signals(self):
+        fetched, accessed = [], []
+
+        def on_fetched(sender, field, kind, rows, **kwargs):
+            fetched.append((sender, field.name, kind, rows))
+
+        def on_accessed(sender, field, hit, **kwargs):
+            accessed.append((sender, field.name, hit))
+
+        signals.relation_fetched.connect(on_fetched)
+        signals.relation_accessed.connect(on_accessed)
+        try:
+            contact = Contact.objects.get(pk=1)
+            contact.customer
+            with stats.recording():
+                contact = Contact.objects.get(pk=1)
+                contact.customer
+                contact.customer
+        finally:
+            signals.relation_fetched.disconnect(on_fetched)
+            signals.relation_accessed.disconnect(on_accessed)
+        self.assertEqual(fetched, [(Contact, "customer", "get", 1)])
+        self.assertEqual(accessed, [(Contact, "customer", False), (Contact, "customer", True)])
+
+    def test_command(self):
+        out = StringIO()
+        call_command("compositefk_stats", "testapp.tests.replay_workload", "--order-by", "queries", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split()[:3], ["field", "queries", "rows"])
+        self.assertEqual(lines[1].split()[:3], ["testapp.Contact.customer", "2", "2"])
+        self.assertEqual(lines[2].split()[:2], ["testapp.Customer.address", "1"])
+        self.assertRaises(CommandError, call_command, "compositefk_stats", "testapp.tests.doesnotexists")
+
+
+class TestChunkedIterator(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_iterator_prefetch_by_chunk(self):
+        with self.assertNumQueries(3):
+            contacts = list(Contact.objects.order_by("pk").prefetch_related("customer__address").iterator())
+        with self.assertNumQueries(0):
+            self.assertEqual(contacts[0].customer.pk, 3)
+            self.assertIsNone(contacts[0].customer.address)
+            self.assertEqual(contacts[1].customer.pk, 1)
+            self.assertEqual(contacts[1].customer.address.pk, 1)
+        # 2 contacts : one query for the contacts, and 2 for each chunk
+        with self.assertNumQueries(5):
+            queryset = Contact.objects.order_by("pk").prefetch_related("customer__address")
+            contacts = list(queryset.iterator(chunk_size=1))
+        with self.assertNumQueries(0):
+            self.assertEqual([c.customer.pk for c in contacts], [3, 1])
+
+    def test_iterator_without_prefetch(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(Contact.objects.iterator())), 2)
+
+    def test_forward_prefetch_without_join(self):
+        with CaptureQueriesContext(connection) as ctx:
+            list(Contact.objects.prefetch_related("customer"))
+        self.assertNotIn("JOIN", ctx.captured_queries[1]["sql"])
+
+    def test_reverse_prefetch_raw_value(self):
+        with self.assertNumQueries(2):
+            addresses = {a.pk: a for a in Address.objects.prefetch_related("customer_set")}
+            self.assertEqual([c.pk for c in addresses[1].customer_set.all()], [1])
+            # the address of the supplier 10 has the same company and tiers_id
+            self.assertEqual(list(addresses[2].customer_set.all()), [])
+        address = Address.objects.get(pk=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(address.customer_set.all()), [])
+
+    def test_reverse_prefetch_one_to_one(self):
+        extra_keys = set((e.company, e.customer_id) for e in Extra.objects.all())
+        customers = {c.pk: c for c in Customer.objects.prefetch_related("extra")}
+        with self.assertNumQueries(0):
+            for customer in customers.values():
+                try:
+                    extra = customer.extra
+                except Extra.DoesNotExist:
+                    self.assertNotIn((customer.company, customer.customer_id), extra_keys)
+                else:
+                    self.assertEqual(extra.customer_id, customer.customer_id)
+                    self.assertIs(extra.customer, customer)
+
+    def test_reverse_prefetch_many_keys(self):
+        Customer.objects.bulk_create([
+            Customer(company=9, customer_id=i, name="c%d" % i) for i in range(1500)
+        ])
+        with self.assertNumQueries(2):
+            customers = list(Customer.objects.prefetch_related("contacts"))
+        self.assertEqual(sum(len(c.contacts.all()) for c in customers), 2)
+
+
+class TestSerialization(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_serialize_composite_key(self):
+        with self.assertNumQueries(1):
+            data = json.loads(serializers.serialize("json", Customer.objects.order_by("pk")))
+        fields = {d["pk"]: d["fields"] for d in data}
+        self.assertEqual(fields[1]["address"], [1, 10, "C"])
+        self.assertEqual(fields[1]["local_address"], [1, 10, "C"])
+        self.assertEqual(fields[1]["representant"], [1, "DB"])
+        # null_if_equal
+        self.assertIsNone(fields[4]["address"])
+        self.assertIsNone(fields[2]["representant"])
+
+    def test_deserialize_composite_key(self):
+        data = json.dumps([
+            {"model": "testapp.contact", "pk": 10, "fields": {"surname": "new", "customer": [1, 20]}},
+        ])
+        contact = next(serializers.deserialize("json", data)).object
+        self.assertEqual((contact.company_code, contact.customer_code), (1, 20))
+        self.assertEqual(contact.customer.pk, 2)
+
+    def test_deserialize_bad_raw_value(self):
+        data = json.dumps([
+            {"model": "testapp.customer", "pk": 10, "fields": {
+                "company": 1, "customer_id": 10, "name": "bad", "address": [1, 10, "S"],
+            }},
+        ])
+        with self.assertRaises(DeserializationError):
+            list(serializers.deserialize("json", data))
+
+    def test_round_trip(self):
+        data = serializers.serialize("json", Contact.objects.order_by("pk"))
+        Contact.objects.all().delete()
+        for obj in serializers.deserialize("json", data):
+            obj.save()
+        self.assertEqual(
+            [(c.pk, c.customer.pk) for c in Contact.objects.order_by("pk")],
+            [(1, 3), (2, 1)],
+        )
+
+    def test_sort_models(self):
+        self.assertEqual(sort_models([Contact, Customer, Address]), [Address, Customer, Contact])
+
+    def test_bulk_loaddata(self):
+        models = [Address, Representant, Customer, Contact]
+        data = serializers.serialize("json", [obj for model in models for obj in model.objects.order_by("pk")])
+        PhoneNumber.objects.all().delete()
+        Contact.objects.all().delete()
+        Customer.objects.all().delete()
+        Address.objects.all().delete()
+        # the contacts first, to be sorted by the loader
+        data = json.dumps(sorted(json.loads(data), key=lambda d: d["model"] != "testapp.contact"))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fixture = os.path.join(tmpdir, "composite_fixture.json")
+            with open(fixture, "w") as f:
+                f.write(data)
+            err = StringIO()
+            with CaptureQueriesContext(connection) as ctx:
+                call_command("compositefk_loaddata", fixture, verbosity=0)
+            call_command("compositefk_loaddata", fixture, "--check-references", verbosity=0, stderr=err)
+        finally:
+            shutil.rmtree(tmpdir)
+        statements = [q["sql"].split()[0] for q in ctx.captured_queries]
+        # one insert per model, the representants already exists and are updated
+        self.assertEqual(statements.count("INSERT"), 3)
+        self.assertEqual(statements.count("UPDATE"), 2)
+        self.assertEqual(Customer.objects.count(), 5)
+        self.assertEqual(Contact.objects.get(pk=2).customer.address.pk, 1)
+        self.assertIn("testapp.Customer.address: 2 key(s) point to nothing: (1, 20), (2, 10)", err.getvalue())
+
+
+class TestValues(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_values(self):
+        with CaptureQueriesContext(connection) as ctx:
+            values = list(Contact.objects.order_by("pk").values("customer", "surname"))
+        self.assertNotIn("JOIN", ctx.captured_queries[0]["sql"])
+        self.assertEqual(values, [
+            {"customer": (2, 10), "surname": "moiraine the witch"},
+            {"customer": (1, 10), "surname": "M. plop"},
+        ])
+        self.assertIsInstance(values[0]["customer"], CompositeKey)
+
+    def test_values_list(self):
+        self.assertEqual(
+            list(Customer.objects.order_by("pk").values_list("pk", "address", "representant")),
+            [
+                (1, (1, 10), (1, "DB")),
+                (2, (1, 20), None),  # cod_rep is None
+                (3, (2, 10), (2, "DB")),
+                (4, None, None),  # null_if_equal
+                (5, None, (-1, "DB")),
+            ]
+        )
+        self.assertEqual(list(Contact.objects.order_by("pk").values_list("customer", flat=True)), [(2, 10), (1, 10)])
+
+    def test_values_annotate(self):
+        values = Contact.objects.values("customer").annotate(n=Count("pk")).order_by("customer_code", "company_code")
+        self.assertEqual(list(values), [{"customer": (1, 10), "n": 1}, {"customer": (2, 10), "n": 1}])
+        self.assertEqual(
+            list(Contact.objects.annotate(n=Count("pk")).order_by("pk").values_list("n", "customer")),
+            [(1, (2, 10)), (1, (1, 10))],
+        )
+
+    def test_values_through_relation(self):
+        with CaptureQueriesContext(connection) as ctx:
+            values = list(Contact.objects.order_by("pk").values_list("customer__representant", "customer__name"))
+        self.assertEqual(ctx.captured_queries[0]["sql"].count("JOIN"), 1)
+        self.assertEqual(values, [((2, "DB"), "moiraine & cie"), ((1, "DB"), "plop SARL")])
+
+
+class TestCompositeAggregate(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_count_raw_value_and_null_if_equal(self):
+        self.assertEqual(
+            list(Address.objects.annotate(
+                customers=CompositeCount("customer"),
+                local_customers=CompositeCount("customer_local"),
+            ).order_by("pk").values_list("pk", "customers", "local_customers")),
+            # 2 is the address of a supplier, 3 has company=-1 which is a null_if_equal of the customers
+            [(1, 1, 1), (2, 0, 0), (3, 0, 0)],
+        )
+
+    def test_no_row_duplication(self):
+        Contact.objects.create(company_code=1, customer_code=10, surname="second contact")
+        Extra.objects.create(company=1, customer_id=10, sales_revenue=3.5)
+        with CaptureQueriesContext(connection) as ctx:
+            values = list(Customer.objects.annotate(
+                CompositeCount("contacts"),
+                revenue=CompositeSum("extra__sales_revenue"),
+                phone_types=CompositeSum("contacts__phonenumbers__type_number"),
+            ).filter(address__city="tear").values_list("pk", "contacts__count", "revenue", "phone_types"))
+        self.assertEqual(values, [(1, 2, 3.5, 1)])
+        self.assertNotIn("GROUP BY", ctx.captured_queries[0]["sql"].rsplit(")", 1)[-1])
+
+    def test_filter(self):
+        counts = Customer.objects.annotate(
+            n=CompositeCount("contacts", filter=Q(surname__startswith="M."))
+        ).order_by("pk").values_list("pk", "n")
+        self.assertEqual(list(counts), [(1, 1), (2, 0), (3, 0), (4, 0), (5, 0)])
+
+    def test_not_composite(self):
+        with self.assertRaises(FieldError):
+            Contact.objects.annotate(n=CompositeCount("phonenumbers"))
+        with self.assertRaises(FieldError):
+            Customer.objects.annotate(n=CompositeSum("contacts"))
+
+
+@override_settings(COMPOSITEFK_READ_DATABASES={"testapp.Customer.address": "replica"}, COMPOSITEFK_STICKY_SECONDS=60)
+class TestReadReplica(TestCase):
+    fixtures = ["all_fixtures.json"]
+    multi_db = True
+
+    def setUp(self):
+        Address.objects.using("replica").filter(pk=1).update(city="replica")
+        routing.reset()
+
+    def tearDown(self):
+        routing.reset()
+
+    def test_lazy_load(self):
+        customer = Customer.objects.get(pk=1)
+        with self.assertNumQueries(1, using="replica"), self.assertNumQueries(0):
+            self.assertEqual(customer.address.city, "replica")
+        # still saved on the database of the customer
+        self.assertEqual(customer.address._state.db, "default")
+        # the other fields are not routed
+        contact = Contact.objects.get(pk=2)
+        with self.assertNumQueries(0, using="replica"):
+            self.assertEqual(contact.customer.pk, 1)
+
+    def test_prefetch(self):
+        with self.assertNumQueries(1, using="replica"):
+            customers = {c.pk: c for c in Customer.objects.prefetch_related("address")}
+        self.assertEqual(customers[1].address.city, "replica")
+        with self.assertNumQueries(1, using="replica"):
+            addresses = {a.pk: a for a in Address.objects.prefetch_related("customer_set")}
+        self.assertEqual([c.pk for c in addresses[1].customer_set.all()], [1])
+
+    def test_read_from(self):
+        with routing.read_from(None):
+            self.assertEqual(Customer.objects.get(pk=1).address.city, "tear")
+        with routing.read_from("replica"):
+            self.assertEqual(Contact.objects.get(pk=2).customer.address.city, "replica")
+        self.assertEqual(Customer.objects.get(pk=1).address.city, "replica")
+        # read_from win over a recent write
+        Address.objects.get(pk=2).save()
+        with routing.read_from("replica"):
+            self.assertEqual(Customer.objects.get(pk=1).address.city, "replica")
+
+    def test_stick_to_primary_after_write(self):
+        # the write of another model don't change where the addresses are read
+        Representant.objects.create(company=3, cod_rep="XX")
+        self.assertEqual(Customer.objects.get(pk=1).address.city, "replica")
+        Address.objects.create(company=3, tiers_id=30, type_tiers="C", city="ebou dar", postcode="3")
+        self.assertEqual(Customer.objects.get(pk=1).address.city, "tear")
+        with override_settings(COMPOSITEFK_STICKY_SECONDS=0):
+            self.assertEqual(Customer.objects.get(pk=1).address.city, "replica")
+
+    def test_stick_reverse(self):
+        Customer.objects.get(pk=2).save()
+        with self.assertNumQueries(0, using="replica"):
+            addresses = {a.pk: a for a in Address.objects.prefetch_related("customer_set")}
+        self.assertEqual([c.pk for c in addresses[1].customer_set.all()], [1])
+
+    def test_end_of_request(self):
+        Address.objects.get(pk=2).delete()
+        self.assertEqual(Customer.objects.get(pk=1).address.city, "tear")
+        # as the test client, without closing the connections of the test
+        request_finished.disconnect(close_old_connections)
+        try:
+            request_finished.send(sender=self.__class__)
+        finally:
+            request_finished.connect(close_old_connections)
+        self.assertEqual(Customer.objects.get(pk=1).address.city, "replica")
+
+    def test_tracked_models(self):
+        self.assertIn(routing.record_write, post_save._live_receivers(Address))
+        self.assertNotIn(routing.record_write, post_save._live_receivers(User))
+
+
+class TestMirrorFields(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        # inserted raw, without the signals
+        copy_customers(MirroredCustomer)
+        mirroring.resync(MirroredCustomer._meta.get_field("address"))
+
+    def get_mirrors(self):
+        return list(MirroredCustomer.objects.order_by("pk").values_list("pk", "address_city", "address_postcode"))
+
+    def test_resync(self):
+        # customer 5 has company=-1 : no address, even if the address -1/10/C exists
+        self.assertEqual(self.get_mirrors(), [
+            (1, "tear", "00111"), (2, None, None), (3, None, None), (4, None, None), (5, None, None),
+        ])
+
+    def test_save_local(self):
+        customer = MirroredCustomer.objects.get(pk=2)
+        customer.name = "renamed"
+        # the key is the one loaded with the mirrored columns : the address is not read
+        with self.assertNumQueries(1):
+            customer.save()
+        Address.objects.create(company=1, tiers_id=30, type_tiers="C", city="cairhien", postcode="3")
+        customer = MirroredCustomer.objects.get(pk=1)
+        customer.address  # cached
+        customer.customer_id = 30
+        customer.save()
+        self.assertEqual(MirroredCustomer.objects.get(pk=1).address_city, "cairhien")
+        with self.assertNumQueries(1):
+            customer.save()
+        customer = MirroredCustomer.objects.create(company=1, customer_id=10, name="new")
+        self.assertEqual(MirroredCustomer.objects.get(pk=customer.pk).address_city, "tear")
+
+    def test_save_key_only(self):
+        Address.objects.create(company=1, tiers_id=77, type_tiers="C", city="caemlyn", postcode="02441")
+        customer = MirroredCustomer.objects.get(pk=1)
+        customer.customer_id = 77
+        with CaptureQueriesContext(connection) as queries:
+            customer.save(update_fields=["customer_id"])
+        # added by MirrorFieldsMixin.save
+        self.assertIn('"address_city" = ', queries[-1]["sql"])
+        self.assertNotIn("save_base", MirroredCustomer.__dict__)
+        self.assertEqual(self.get_mirrors()[0], (1, "caemlyn", "02441"))
+        # a deferred mirrored column is read from the address
+        customer = MirroredCustomer.objects.defer("address_city").get(pk=1)
+        customer.save()
+        self.assertEqual(self.get_mirrors()[0], (1, "caemlyn", "02441"))
+
+    def test_save_remote(self):
+        address = Address.objects.get(pk=1)
+        address.city = "tar valon"
+        with self.assertNumQueries(2):  # the address and the customers
+            address.save()
+        self.assertEqual(self.get_mirrors()[0], (1, "tar valon", "00111"))
+        # the address of the supplier 10 don't change the customer 10
+        Address.objects.filter(pk=2).update(city="nowhere")
+        self.assertEqual(self.get_mirrors()[0], (1, "tar valon", "00111"))
+
+    def test_queryset_update(self):
+        Address.objects.filter(city="tear").update(city="tar valon", postcode="9")
+        self.assertEqual(self.get_mirrors()[0], (1, "tar valon", "9"))
+        # the address is no more the one of the customer 1
+        Address.objects.filter(pk=1).update(tiers_id=30)
+        self.assertEqual(self.get_mirrors()[0], (1, None, None))
+        # the customer 1 take it back
+        MirroredCustomer.objects.filter(pk=1).update(customer_id=30)
+        self.assertEqual(self.get_mirrors()[0], (1, "tar valon", "9"))
+
+    def test_delete_remote(self):
+        Address.objects.get(pk=1).delete()
+        self.assertFalse(MirroredCustomer.objects.filter(pk=1).exists())  # on_delete=CASCADE
+        address = Address.objects.create(company=1, tiers_id=20, type_tiers="C", city="caemlyn", postcode="02441")
+        self.assertEqual(self.get_mirrors()[0], (2, "caemlyn", "02441"))
+        address.delete()
+        self.assertFalse(MirroredCustomer.objects.filter(pk=2).exists())
+
+    def test_command(self):
+        MirroredCustomer.objects.all().update(address_city="stale")
+        out = StringIO()
+        call_command("compositefk_resync_mirrors", "testapp.MirroredCustomer", "--chunk-size", "2", stdout=out)
+        self.assertEqual(out.getvalue(), "testapp.MirroredCustomer.address: 5 row(s) updated\n")
+        self.assertEqual(self.get_mirrors()[0], (1, "tear", "00111"))
+        self.assertEqual(self.get_mirrors()[1], (2, None, None))
+        self.assertRaises(CommandError, call_command, "compositefk_resync_mirrors", "testapp.Customer")
+        self.assertRaises(CommandError, call_command, "compositefk_resync_mirrors", "testapp.Customer.contact")
+
+    def test_not_mirrored(self):
+        self.assertEqual(mirroring.get_mirrored_fields(Customer), [])
+        self.assertNotIn("mirror_fields", Customer._meta.get_field("address").deconstruct()[3])
+
+
+class CountedEvent(object):
+    """
+    a threading.Event which know how many threads wait for it
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.condition = threading.Condition()
+        self.waiting = 0
+
+    def wait(self, timeout=None):
+        with self.condition:
+            self.waiting += 1
+            self.condition.notify_all()
+        return self.event.wait(timeout)
+
+    def set(self):
+        self.event.set()
+
+    def wait_for_waiting(self, count):
+        with self.condition:
+            while self.waiting < count:
+                self.condition.wait()
+
+
+class CountedCall(singleflight.Call):
+    def __init__(self):
+        super(CountedCall, self).__init__()
+        self.done = CountedEvent()
+
+
+@mock.patch.object(Contact._meta.get_field("customer"), "thread_safe", True)
+@mock.patch.object(singleflight, "Call", CountedCall)
+class TestSingleFlight(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def run_threads(self, target, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda i=i: results.append(target(i))) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_for_followers(self, group, count):
+        """
+        wait, in the call running, for the count other threads to wait for its result
+        """
+        call, = group._calls.values()
+        call.done.wait_for_waiting(count)
+
+    def test_group(self):
+        group = singleflight.Group()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def load():
+            calls.append(1)
+            started.set()
+            self.wait_for_followers(group, 4)
+            release.wait()
+            return object()
+
+        threads, results = self.run_threads(lambda i: group.do("key", load))
+        started.wait()
+        self.assertEqual(group.in_flight(), 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(id(result) for result in results)), 1)
+        self.assertEqual(group.in_flight(), 0)
+        # done : the next call run again
+        group.do("key", calls.append, 2)
+        self.assertEqual(calls, [1, 2])
+
+    def test_group_error(self):
+        group = singleflight.Group()
+
+        def fail():
+            raise ValueError("boom")
+
+        self.assertRaises(ValueError, group.do, "key", fail)
+        self.assertEqual(group.in_flight(), 0)
+
+    def test_shared_instances(self):
+        # two contacts of the same customer, shared by the threads
+        Contact.objects.create(company_code=2, customer_code=10, surname="twin")
+        contacts = list(Contact.objects.filter(company_code=2, customer_code=10))
+        customer = Customer.objects.get(pk=3)
+        loads = []
+
+        def get_object(descriptor, instance):
+            loads.append(instance.pk)
+            self.wait_for_followers(singleflight.group, 3)
+            return customer
+
+        with mock.patch.object(CompositeForwardManyToOneDescriptor, "_get_object", get_object):
+            threads, results = self.run_threads(lambda i: contacts[i % 2].customer, count=4)
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, [customer] * 4)
+        for contact in contacts:
+            self.assertIs(contact.customer, customer)
+
+    def test_lazy_load(self):
+        contact = Contact.objects.get(pk=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(contact.customer.pk, 3)
+            self.assertEqual(contact.customer.pk, 3)
+        contact = Contact(company_code=9, customer_code=9)
+        self.assertRaises(Customer.DoesNotExist, getattr, contact, "customer")
+        self.assertEqual(singleflight.group.in_flight(), 0)
+
+
+class TestParallelPrefetch(TransactionTestCase):
+    # the threads use their own connections : the fixtures must be committed
+    fixtures = ["all_fixtures.json"]
+    lookups = ("address", "local_address", "representant", "contacts__phonenumbers", "contacts")
+
+    def get_related(self, customers):
+        return [
+            (c.pk, c.address, c.local_address, c.representant, [
+                (contact.pk, list(contact.phonenumbers.all())) for contact in c.contacts.all()
+            ])
+            for c in customers
+        ]
+
+    def test_group_lookups(self):
+        self.assertEqual(group_lookups(self.lookups), [
+            ["address"], ["local_address"], ["representant"], ["contacts__phonenumbers", "contacts"],
+        ])
+        prefetch = Prefetch("contacts", queryset=Contact.objects.all(), to_attr="contact_list")
+        self.assertEqual(group_lookups(["address", prefetch]), [["address"], [prefetch]])
+
+    def test_parallel(self):
+        if not can_use_threads(connection):
+            self.skipTest("the threads can't see this database in memory (see COMPOSITEFK_TEST_FILE_DB)")
+        expected = self.get_related(Customer.objects.prefetch_related(*self.lookups).order_by("pk"))
+        queryset = Customer.objects.prefetch_related(*self.lookups).order_by("pk").parallel_prefetch(workers=3)
+        # the prefetch queries are made by the connections of the threads
+        with self.assertNumQueries(1):
+            customers = list(queryset)
+            self.assertEqual(self.get_related(customers), expected)
+        with self.assertNumQueries(1):
+            customers = list(queryset.filter(pk__lte=3).iterator(chunk_size=2))
+            self.assertEqual(self.get_related(customers), expected[:3])
+        # back to the normal prefetch
+        with self.assertNumQueries(6):
+            list(queryset.parallel_prefetch(workers=1))
+
+    def test_in_transaction(self):
+        with transaction.atomic():
+            Contact.objects.create(company_code=1, customer_code=10, surname="new")
+            with self.assertNumQueries(6):
+                customers = list(Customer.objects.prefetch_related(*self.lookups).parallel_prefetch())
+            self.assertEqual(len(customers[0].contacts.all()), 2)
+
+    def test_memory_db(self):
+        # a database in memory not shared (as the test database on python 2) is only seen by its connection
+        connection.ensure_connection()
+        with mock.patch.dict(connection.settings_dict, NAME=":memory:"):
+            self.assertFalse(can_use_threads(connection))
+            with self.assertNumQueries(6):
+                customers = list(Customer.objects.prefetch_related(*self.lookups).parallel_prefetch())
+        self.assertEqual(len(customers), 5)
+
+    def test_thread_state(self):
+        suppliers = list(MultiLangSupplier.objects.all())
+        with translation.override("ru"):
+            parallel_prefetch_related_objects(suppliers, "active_translations", "translations")
+        with self.assertNumQueries(0):
+            self.assertEqual(suppliers[0].active_translations.name, "ru_name")
+            self.assertEqual(len(suppliers[0].translations.all()), 2)
+
+
+class TestDeletePruning(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def get_tables(self, queries):
+        # the tables queried by the collector
+        return [
+            query["sql"].split(" FROM ")[1].split()[0].strip('"')
+            for query in queries if query["sql"].startswith("SELECT")
+        ]
+
+    def test_raw_value_mismatch(self):
+        supplier = Supplier.objects.create(company=1, supplier_id=10, name="supplier")
+        # a customer address : no query for the suppliers, which need a type S
+        address = Address.objects.get(pk=1)
+        with CaptureQueriesContext(connection) as context:
+            address.delete()
+        self.assertNotIn("testapp_supplier", self.get_tables(context.captured_queries))
+        self.assertTrue(Supplier.objects.filter(pk=supplier.pk).exists())
+        # a supplier address : the customers aren't queried
+        address = Address.objects.get(pk=2)
+        with CaptureQueriesContext(connection) as context:
+            address.delete()
+        self.assertEqual(self.get_tables(context.captured_queries), ["testapp_supplier"])
+        self.assertFalse(Supplier.objects.filter(pk=supplier.pk).exists())
+        self.assertEqual(Customer.objects.count(), 4)
+
+    def test_filter_in(self):
+        supplier = Supplier.objects.create(company=1, supplier_id=10, name="supplier")
+        customer_address, supplier_address = Address.objects.get(pk=1), Address.objects.get(pk=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Supplier.objects.filter(address__in=[customer_address])), [])
+        self.assertEqual(list(Supplier.objects.exclude(address__in=[customer_address])), [supplier])
+        self.assertEqual(list(Supplier.objects.filter(address__in=[supplier_address, customer_address])), [supplier])
+        # each key once
+        customer = Customer.objects.get(pk=3)
+        same_key = Customer(company=2, customer_id=10)
+        query = str(Contact.objects.filter(customer__in=[customer, customer, same_key]).query)
+        self.assertEqual(query.count("customer_code"), 2)  # selected and filtered once
+        self.assertEqual(list(Contact.objects.filter(customer__in=[customer]).values_list("pk", flat=True)), [1])
+
+
+class TestPartialIndex(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        copy_customers(IndexedCustomer)
+
+    def get_index(self):
+        field = IndexedCustomer._meta.get_field("address")
+        return [index for index in IndexedCustomer._meta.indexes if get_field_index(field).is_same(index)][0]
+
+    def test_index(self):
+        index = self.get_index()
+        self.assertEqual(sorted(index.fields), ["company", "customer_id"])
+        self.assertEqual(index.exclude, [("company", -1), ("customer_id", -1)])
+        self.assertTrue(index.name.endswith("_pix"))
+        self.assertEqual(index.clone(), index)
+        self.assertIsInstance(index.clone(), CompositePartialIndex)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s", [index.name])
+            sql = cursor.fetchone()[0]
+        self.assertIn('WHERE "company" <> -1 AND "customer_id" <> -1', sql)
+        self.assertEqual([i for i in Customer._meta.indexes if isinstance(i, CompositePartialIndex)], [])
+
+    def test_join(self):
+        # the customer 5 has company=-1 : it has no address, even by a join
+        self.assertEqual(list(IndexedCustomer.objects.filter(address__city="neverworld")), [])
+        self.assertEqual(list(Address.objects.filter(indexed_customers__pk=5)), [])
+        self.assertEqual(list(Address.objects.filter(indexed_customers__pk=1).values_list("pk", flat=True)), [1])
+        self.assertIn(
+            '"testapp_indexedcustomer"."company" <> -1 AND "testapp_indexedcustomer"."customer_id" <> -1',
+            str(Address.objects.filter(indexed_customers__name="x").query),
+        )
+        address = Address.objects.get(pk=3)
+        query = str(IndexedCustomer.objects.filter(address__in=[address]).query)
+        self.assertIn('"testapp_indexedcustomer"."customer_id" <> -1', query)
+        self.assertEqual(list(IndexedCustomer.objects.filter(address__in=[address])), [])
+        addresses = list(Address.objects.prefetch_related("indexed_customers").order_by("pk"))
+        self.assertEqual(
+            [[c.pk for c in a.indexed_customers.all()] for a in addresses], [[1], [], []],
+        )
+        # without partial_index, the sentinels are only excluded by null_if_equal
+        self.assertNotIn("NOT", str(Address.objects.filter(customer__name="x").query))
+
+    def test_query_plan(self):
+        address = Address.objects.get(pk=1)
+        sql, params = IndexedCustomer.objects.filter(address__in=[address]).query.sql_with_params()
+        self.assertIn('"testapp_indexedcustomer"."customer_id" <> %s', sql)
+        # the planner use the partial index if it see the values of its condition in the query, as psycopg2 send it
+        sql %= tuple(connection.schema_editor().quote_value(param) for param in params)
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN %s" % sql)
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("USING INDEX %s" % self.get_index().name, plan)
+
+    def test_check(self):
+        self.assertEqual(check_partial_indexes(), [])
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX "%s"' % self.get_index().name)
+        self.assertEqual([error.id for error in check_partial_indexes()], ["compositefk.W001"])
+
+
+@mock.patch.object(Customer._meta.get_field("representant"), "auto_prefetch", True)
+class TestAutoPrefetch(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_loop(self):
+        representants = {r.company: r for r in Representant.objects.all()}
+        with self.assertNumQueries(2):
+            rows = [(c.pk, c.representant) for c in Customer.objects.order_by("pk")]
+        self.assertEqual(rows, [(1, representants[1]), (2, None), (3, representants[2]), (4, None), (5, None)])
+
+    def test_single_instance(self):
+        customer = Customer.objects.get(pk=1)
+        self.assertFalse(hasattr(customer, siblings.SIBLINGS_ATTR))
+        with self.assertNumQueries(1):
+            self.assertEqual(customer.representant.company, 1)
+
+    def test_weak_references(self):
+        customers = list(Customer.objects.order_by("pk"))
+        customer = customers[2]
+        del customers
+        gc.collect()
+        self.assertEqual(getattr(customer, siblings.SIBLINGS_ATTR).alive(), [customer])
+        with self.assertNumQueries(1):
+            self.assertEqual(customer.representant.company, 2)
+
+    def test_pickle(self):
+        customers = list(Customer.objects.order_by("pk"))
+        customer = pickle.loads(pickle.dumps(customers[0]))
+        self.assertEqual(len(getattr(customer, siblings.SIBLINGS_ATTR)), 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(customer.representant.company, 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(customers[2].representant.company, 2)
+            self.assertEqual(customers[0].representant.company, 1)
+
+
+@mock.patch.object(Supplier._meta.get_field("address"), "key_proxy", True)
+class TestKeyProxy(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        self.supplier = Supplier.objects.create(company=1, supplier_id=10, name="sup")
+        self.supplier = Supplier.objects.get(pk=self.supplier.pk)
+
+    def test_key_without_query(self):
+        with self.assertNumQueries(0):
+            address = self.supplier.address
+            self.assertEqual(address.company, 1)
+            self.assertEqual(address.tiers_id, 10)
+            self.assertEqual(address.type_tiers, "S")
+            self.assertIn("'tiers_id': 10", repr(address))
+
+    def test_load(self):
+        address = self.supplier.address
+        with self.assertNumQueries(1):
+            self.assertEqual(address.pk, 2)
+            self.assertEqual(address.city, "caemlyn")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.supplier.address.pk, 2)
+            self.assertIs(type(self.supplier.address), Address)
+
+    def test_get_related(self):
+        with self.assertNumQueries(1):
+            address = Supplier.address.get_related(self.supplier)
+        self.assertIs(type(address), Address)
+        self.assertEqual(address.pk, 2)
+
+    def test_missing(self):
+        supplier = Supplier.objects.create(company=2, supplier_id=10, name="nowhere")
+        address = Supplier.objects.get(pk=supplier.pk).address
+        self.assertEqual(address.company, 2)
+        with self.assertRaises(Address.DoesNotExist):
+            address.city
+
+    def test_prefetch(self):
+        supplier = Supplier.objects.prefetch_related("address").get(pk=self.supplier.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(type(supplier.address), Address)
+
+    def test_deconstruct(self):
+        self.assertTrue(Supplier._meta.get_field("address").deconstruct()[3]["key_proxy"])
+        self.assertNotIn("key_proxy", Customer._meta.get_field("address").deconstruct()[3])
+
+
+class TestKeysetPagination(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        for company in (1, 2):
+            for tiers_id in range(20, 24):
+                Address.objects.create(company=company, tiers_id=tiers_id, type_tiers="C", city="c%s" % tiers_id)
+        self.expected = list(Address.objects.order_by("company", "tiers_id", "type_tiers"))
+        self.field = Customer._meta.get_field("address")
+
+    def get_all(self, paginator):
+        objects = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page = paginator.page(cursor)
+            objects.extend(page)
+            if not page.has_next():
+                return objects
+            self.assertEqual(len(page), paginator.per_page)
+            cursor = page.next_cursor
+
+    def test_pages(self):
+        self.assertEqual(self.get_all(KeysetPaginator(Address.objects.all(), self.field, per_page=3)), self.expected)
+
+    def test_expanded_condition(self):
+        paginator = KeysetPaginator(Address.objects.all(), self.field, per_page=3)
+        with CaptureQueriesContext(connection) as queries:
+            list(paginator.iterator())
+        self.assertEqual(len(queries), 4)
+        sql = queries[1]["sql"]
+        self.assertIn('"company" >= 1 AND', sql)
+        self.assertNotIn("OFFSET", sql)
+
+    def test_row_values(self):
+        paginator = KeysetPaginator(Address.objects.all(), self.field, per_page=3)
+        with mock.patch("compositefk.pagination.ROW_VALUE_VENDORS", ("sqlite",)):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(list(paginator.iterator()), self.expected)
+        self.assertIn('"type_tiers") > (1, ', queries[1]["sql"])
+
+    def test_descending(self):
+        paginator = KeysetPaginator(Address.objects.all(), ["company", "tiers_id", "type_tiers"], 4, descending=True)
+        self.assertEqual(self.get_all(paginator), self.expected[::-1])
+
+    def test_not_unique(self):
+        paginator = KeysetPaginator(Address.objects.filter(company=1), ["tiers_id"], per_page=2)
+        self.assertEqual([f.name for f in paginator.fields], ["tiers_id", "id"])
+        self.assertEqual(
+            [a.pk for a in paginator.iterator()],
+            list(Address.objects.filter(company=1).order_by("tiers_id", "pk").values_list("pk", flat=True)),
+        )
+
+    def test_cursor(self):
+        paginator = KeysetPaginator(Address.objects.all(), self.field, per_page=3)
+        cursor = paginator.page().next_cursor
+        self.assertEqual(list(paginator.page(cursor)), self.expected[3:6])
+        self.assertEqual(list(paginator.iterator(cursor)), self.expected[3:])
+        for invalid in ("plop", cursor[:-4], KeysetPaginator(Address.objects.all(), ["city"], 3).page().next_cursor):
+            with self.assertRaises(InvalidPage):
+                paginator.page(invalid)
+
+    def test_keyset_iterator(self):
+        self.assertEqual(list(keyset_iterator(Address.objects.all(), self.field, chunk_size=2)), self.expected)
+        self.assertEqual(list(keyset_iterator(Address.objects.filter(company=3), self.field)), [])
+
+
+class TestKeyRanges(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        for customer_id in range(100, 110):
+            Contact.objects.create(company_code=1, customer_code=customer_id, surname="c%s" % customer_id)
+            Contact.objects.create(company_code=2, customer_code=customer_id, surname="c%s" % customer_id)
+        self.keys = ["company_code", "customer_code"]
+
+    def get_ranges_pks(self, ranges):
+        return [
+            list(filter_key_range(Contact.objects.order_by("pk"), self.keys, key_range).values_list("pk", flat=True))
+            for key_range in ranges
+        ]
+
+    def test_split(self):
+        with self.assertNumQueries(4):
+            ranges = split_key_ranges(Contact.objects.all(), self.keys, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertIsNone(ranges[0].start)
+        self.assertIsNone(ranges[-1].end)
+        # the key of contact is not unique : the pk is a part of the bounds
+        self.assertEqual(len(ranges[1].start), 3)
+        self.assertEqual([r.end for r in ranges[:-1]], [r.start for r in ranges[1:]])
+        pks = self.get_ranges_pks(ranges)
+        self.assertEqual([len(p) for p in pks], [5, 6, 5, 6])
+        self.assertEqual(sorted(sum(pks, [])), list(Contact.objects.order_by("pk").values_list("pk", flat=True)))
+
+    def test_split_small(self):
+        self.assertEqual(split_key_ranges(Customer.objects.filter(pk__in=[1, 2]), ["company", "customer_id"], 4), [
+            KeyRange(None, (1, 20)),
+            KeyRange((1, 20), None),
+        ])
+        self.assertEqual(split_key_ranges(Customer.objects.none(), ["company", "customer_id"], 4), [
+            KeyRange(None, None),
+        ])
+
+    def test_foreign_key(self):
+        ranges = split_key_ranges(Customer.objects.all(), Contact._meta.get_field("customer"), 2)
+        self.assertEqual(ranges, [KeyRange(None, (1, 20)), KeyRange((1, 20), None)])
+
+    def test_run_in_transaction(self):
+        # the test transaction keep the ranges in this process
+        self.assertEqual(run_key_ranges(count_rows, Contact.objects.all(), self.keys, workers=3, aggregate=sum), 22)
+        self.assertEqual(run_key_ranges(count_rows, Contact.objects.all(), self.keys, workers=3), [7, 7, 8])
+
+    def test_split_walk(self):
+        # each bound is read from the previous one, not from the start of the table
+        with CaptureQueriesContext(connection) as queries:
+            ranges = split_key_ranges(Contact.objects.all(), self.keys, 4)
+        self.assertIn("OFFSET 5", queries[1]["sql"])
+        self.assertIn("OFFSET 6", queries[2]["sql"])
+        self.assertIn('"testapp_contact"."company_code" >= %s' % ranges[1].start[0], queries[2]["sql"])
+        self.assertIn("OFFSET 5", queries[3]["sql"])
+
+
+class TestKeyRangesProcesses(TransactionTestCase):
+    # the workers see the committed rows of a database file only (see COMPOSITEFK_TEST_FILE_DB in testsettings)
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("the worker processes can't see a database in memory")
+
+    def test_run_in_processes(self):
+        ranges = [KeyRange(None, (2, 10, 0)), KeyRange((2, 10, 0), None)]
+        results = run_key_ranges(
+            describe_range, Contact.objects.all(), ["company_code", "customer_code"], workers=2, ranges=ranges,
+        )
+        self.assertEqual(len(results), 2)
+        self.assertNotIn(os.getpid(), [pid for pid, sql in results])
+        self.assertIn('"company_code" < 2', results[0][1])
+        self.assertIn('"company_code" >= 2', results[1][1])
+        self.assertEqual(run_key_ranges(count_rows, Contact.objects.all(), ranges=ranges, keys=[
+            "company_code", "customer_code",
+        ], workers=2), [1, 1])
+
+
+class TestChangedFields(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_changed_fields(self):
+        contact = Contact.objects.get(pk=2)
+        self.assertEqual(dirty.get_changed_fields(contact), [])
+        contact.customer = Customer.objects.get(pk=3)
+        self.assertEqual(dirty.get_changed_fields(contact), ["company_code"])
+        contact.surname = "renamed"
+        self.assertEqual(dirty.get_changed_fields(contact), ["company_code", "surname"])
+        with CaptureQueriesContext(connection) as queries:
+            dirty.save_changed(contact)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('"company_code" = 2', queries[0]["sql"])
+        self.assertNotIn('"customer_code"', queries[0]["sql"].split(" WHERE ")[0])
+        self.assertEqual(dirty.get_changed_fields(contact), [])
+        contact = Contact.objects.get(pk=2)
+        self.assertEqual(contact.customer.pk, 3)
+        self.assertEqual(contact.surname, "renamed")
+
+    def test_tracked_models(self):
+        # only the models having a CompositeForeignKey keep the values of their columns
+        self.assertIn(dirty.clear_changes, post_save._live_receivers(Contact))
+        self.assertNotIn(dirty.clear_changes, post_save._live_receivers(Address))
+        self.assertNotIn(dirty.LOADED_ATTR, Address.objects.get(pk=1).__dict__)
+        # its CompositeForeignKey is added once the model is prepared
+        supplier = MultiLangSupplier.objects.get(pk=1)
+        supplier.supplier_id = 99
+        self.assertEqual(dirty.get_changed_fields(supplier), ["supplier_id"])
+
+    def test_save_other_fields(self):
+        contact = Contact.objects.get(pk=2)
+        contact.customer = Customer.objects.get(pk=3)
+        contact.surname = "renamed"
+        contact.save(update_fields=["surname"])
+        self.assertEqual(dirty.get_changed_fields(contact), ["company_code"])
+        with CaptureQueriesContext(connection) as queries:
+            dirty.save_changed(contact)
+        self.assertIn('SET "company_code" = 2 WHERE', queries[0]["sql"])
+        self.assertEqual(Contact.objects.get(pk=2).customer.pk, 3)
+        contact.customer = Customer.objects.get(pk=1)
+        contact.save(update_fields=["company_code"])
+        self.assertEqual(dirty.get_changed_fields(contact), [])
+
+    def test_assigned_back(self):
+        contact = Contact.objects.get(pk=2)
+        customer = contact.customer
+        contact.customer = Customer.objects.get(pk=3)
+        contact.customer = customer
+        self.assertEqual(dirty.get_changed_fields(contact), [])
+        with self.assertNumQueries(0):
+            dirty.save_changed(contact)
+
+    def test_set_none(self):
+        customer = Customer.objects.get(pk=1)
+        customer.representant = None
+        self.assertEqual(dirty.get_changed_fields(customer), ["cod_rep"])
+        customer.save()
+        self.assertEqual(dirty.get_changed_fields(customer), [])
+        self.assertEqual(Customer.objects.get(pk=1).cod_rep, "")
+
+    def test_new_instance(self):
+        contact = Contact(customer=Customer.objects.get(pk=1), surname="new")
+        dirty.save_changed(contact)
+        self.assertEqual(Contact.objects.get(pk=contact.pk).customer.pk, 1)
+
+    def test_deferred(self):
+        contact = Contact.objects.only("pk").get(pk=2)
+        with self.assertNumQueries(1):
+            contact.customer = Customer.objects.get(pk=3)
+        self.assertEqual(dirty.get_changed_fields(contact), ["company_code", "customer_code"])
+
+    def test_mirror_fields(self):
+        address = Address.objects.create(company=3, tiers_id=30, type_tiers="C", city="ebou dar", postcode="3")
+        copy_customers(MirroredCustomer)
+        customer = MirroredCustomer.objects.get(pk=2)
+        customer.address = address
+        self.assertEqual(
+            dirty.get_update_fields(customer), ["address_city", "address_postcode", "company", "customer_id"],
+        )
+        dirty.save_changed(customer)
+        self.assertEqual(MirroredCustomer.objects.get(pk=2).address_city, "ebou dar")
+        # without mirror_fields, only the columns of the key
+        customer = Customer.objects.get(pk=2)
+        customer.address = address
+        self.assertEqual(dirty.get_update_fields(customer), ["company", "customer_id"])
+
+    def test_bulk_update(self):
+        customers = {c.pk: c for c in Customer.objects.all()}
+        contacts = list(Contact.objects.order_by("pk"))
+        for customer_id in (20, 21, 22):
+            contacts.append(Contact.objects.create(company_code=1, customer_code=customer_id, surname="s"))
+        contacts[0].customer = customers[1]
+        contacts[1].customer = customers[3]
+        # unchanged
+        contacts[2].customer = customers[2]
+        contacts[3].customer = customers[3]
+        contacts[4].surname = "renamed"
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(dirty.bulk_update_changed(contacts, batch_size=2), 4)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('"company_code" = CASE WHEN', queries[0]["sql"])
+        self.assertNotIn('"customer_code"', queries[0]["sql"].split("WHERE")[0])
+        self.assertIn('"customer_code" = CASE WHEN', queries[1]["sql"])
+        self.assertIn('"surname" = CASE WHEN', queries[1]["sql"])
+        self.assertEqual([c.customer.pk for c in Contact.objects.order_by("pk")[:4]], [1, 3, 2, 3])
+        self.assertEqual(Contact.objects.get(pk=contacts[4].pk).surname, "renamed")
+        self.assertEqual([dirty.get_changed_fields(c) for c in contacts], [[]] * 5)
+        self.assertEqual(dirty.bulk_update_changed(contacts), 0)
+
+
+class TestBulkRelatedManager(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        self.representant = Representant.objects.get(company=1)
+
+    def get_cod_reps(self):
+        return dict(Customer.objects.filter(company=1).values_list("pk", "cod_rep"))
+
+    def test_add(self):
+        customer = Customer.objects.get(pk=2)
+        contacts = list(Contact.objects.order_by("pk"))
+        with self.assertNumQueries(1):
+            customer.contacts.add(*contacts)
+        self.assertEqual([c.customer_code for c in contacts], [20, 20])
+        with self.assertNumQueries(0):
+            self.assertEqual(contacts[0].customer, customer)
+        self.assertEqual(dirty.get_changed_fields(contacts[0]), [])
+        self.assertEqual(list(customer.contacts.order_by("pk")), contacts)
+        # already related : the UPDATE match no row
+        with self.assertNumQueries(1):
+            customer.contacts.add(*contacts)
+
+    def test_add_stale(self):
+        customer = Customer.objects.get(pk=2)
+        contact = Contact.objects.get(pk=2)
+        # the instance already point to the customer, but not the row
+        contact.customer_code = 20
+        with CaptureQueriesContext(connection) as queries:
+            customer.contacts.add(contact)
+        self.assertEqual(len(queries), 1)
+        set_sql = queries[0]["sql"].split(" WHERE ")[0]
+        self.assertIn('"company_code" = 1', set_sql)
+        self.assertIn('"customer_code" = 20', set_sql)
+        self.assertEqual(Contact.objects.get(pk=2).customer, customer)
+
+    def test_add_unsaved(self):
+        with self.assertRaises(ValueError):
+            Customer.objects.get(pk=2).contacts.add(Contact(company_code=1, customer_code=10))
+        with self.assertRaises(TypeError):
+            Customer.objects.get(pk=2).contacts.add(Customer.objects.get(pk=1))
+
+    def test_set_not_null(self):
+        customer = Customer.objects.get(pk=2)
+        with self.assertNumQueries(1):
+            customer.contacts.set(Contact.objects.filter(pk=1))
+        self.assertEqual(list(customer.contacts.values_list("pk", flat=True)), [1])
+        # no remove() : the other contacts keep their customer
+        self.assertEqual(Contact.objects.get(pk=2).customer.pk, 1)
+
+    def test_remove(self):
+        customer = Customer.objects.get(pk=1)
+        with self.assertNumQueries(1):
+            self.representant.customer_set.remove(customer)
+        self.assertEqual(customer.cod_rep, "")
+        self.assertEqual(Customer.objects.get(pk=1).cod_rep, "")
+        self.assertEqual(Customer.objects.get(pk=1).company, 1)
+        with self.assertRaises(Representant.DoesNotExist):
+            self.representant.customer_set.remove(Customer.objects.get(pk=2))
+
+    def test_clear(self):
+        Customer.objects.bulk_create([
+            Customer(company=1, customer_id=100 + i, name="c%s" % i, cod_rep="DB") for i in range(300)
+        ])
+        with self.assertNumQueries(1):
+            self.representant.customer_set.clear()
+        self.assertEqual(set(self.get_cod_reps().values()), {"", None})
+        self.assertEqual(Customer.objects.get(pk=3).cod_rep, "DB")
+
+    def test_set(self):
+        customers = list(Customer.objects.filter(pk__in=[1, 2]).order_by("pk"))
+        with self.assertNumQueries(2):
+            self.representant.customer_set.set(customers[1:])
+        self.assertEqual(self.get_cod_reps(), {1: "", 2: "DB"})
+        self.assertEqual(customers[1].cod_rep, "DB")
+        with self.assertNumQueries(1):
+            self.representant.customer_set.set([], clear=True)
+        self.assertEqual(self.get_cod_reps(), {1: "", 2: ""})
+
+    def test_set_queryset(self):
+        Customer.objects.bulk_create([
+            Customer(company=1, customer_id=100 + i, name="c%s" % i, cod_rep="DB" if i % 2 else None)
+            for i in range(300)
+        ])
+        with self.assertNumQueries(2):
+            self.representant.customer_set.set(Customer.objects.filter(company=1, customer_id__gte=100))
+        cod_reps = self.get_cod_reps()
+        self.assertEqual(cod_reps.pop(1), "")
+        self.assertEqual(cod_reps.pop(2), None)
+        self.assertEqual(set(cod_reps.values()), {"DB"})
+
+    def test_not_bulk(self):
+        customer = Customer.objects.get(pk=2)
+        with self.assertNumQueries(1):
+            self.representant.customer_set.add(customer, bulk=False)
+        self.assertEqual(Customer.objects.get(pk=2).cod_rep, "DB")
+
+
+class TestOnUpdateCascade(TestCase):
+
+    def setUp(self):
+        self.accounts = Account.objects.bulk_create([
+            Account(pk=1, company=1, account_id=10, name="first"),
+            Account(pk=2, company=1, account_id=20, name="second"),
+            Account(pk=3, company=2, account_id=10, name="other company"),
+        ])
+        AccountContact.objects.bulk_create([
+            AccountContact(pk=1, company_code=2, account_code=10, surname="moiraine the witch"),
+            AccountContact(pk=2, company_code=1, account_code=10, surname="M. plop"),
+        ])
+        self.extra = AccountExtra.objects.create(company=1, account_id=10, sales_revenue=1.5)
+
+    def test_save(self):
+        account = Account.objects.get(pk=1)
+        account.account_id = 11
+        with CaptureQueriesContext(connection) as queries:
+            account.save()
+        updates = [q["sql"] for q in queries if q["sql"].startswith('UPDATE "testapp_accountcontact"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn(
+            'SET "account_code" = 11 WHERE ("testapp_accountcontact"."company_code" = 1 AND', updates[0],
+        )
+        self.assertEqual(AccountContact.objects.get(pk=2).account, account)
+        self.assertEqual(AccountExtra.objects.get(pk=self.extra.pk).account_id, 11)
+        # the other contact is untouched
+        self.assertEqual(AccountContact.objects.get(pk=1).account.pk, 3)
+
+    def test_save_without_key_change(self):
+        account = Account.objects.get(pk=1)
+        account.name = "renamed"
+        # the key is the one loaded : only the save
+        with self.assertNumQueries(1):
+            account.save()
+        with self.assertNumQueries(1):
+            account.save(update_fields=["name"])
+        account.account_id = 11
+        with CaptureQueriesContext(connection) as queries:
+            account.save(update_fields=["name"])
+        self.assertFalse(any(q["sql"].startswith("SELECT") for q in queries))
+        # the key saved is known afterwards
+        account.save()
+        with self.assertNumQueries(1):
+            account.save()
+        self.assertEqual(AccountContact.objects.get(pk=2).account_code, 11)
+
+    def test_deferred_key(self):
+        account = Account.objects.only("pk", "company").get(pk=1)
+        account.account_id = 11
+        account.save()
+        self.assertEqual(AccountContact.objects.get(pk=2).account_code, 11)
+
+    def test_queryset_update(self):
+        AccountContact.objects.create(company_code=1, account_code=20, surname="c2")
+        with CaptureQueriesContext(connection) as queries:
+            Account.objects.filter(company=1).update(account_id=F("account_id") + 100)
+        # the keys read before and after the UPDATE of the accounts, and one UPDATE by dependent relation
+        self.assertEqual(len(queries), 5)
+        self.assertIn('UPDATE "testapp_accountcontact" SET "account_code" = CASE WHEN', queries[3]["sql"])
+        self.assertIn('UPDATE "testapp_accountextra" SET "account_id" = CASE WHEN', queries[4]["sql"])
+        self.assertEqual(
+            sorted(AccountContact.objects.values_list("company_code", "account_code")),
+            [(1, 110), (1, 120), (2, 10)],
+        )
+        self.assertEqual(AccountExtra.objects.get(pk=self.extra.pk).account.pk, 1)
+
+    def test_swap_keys(self):
+        AccountContact.objects.create(company_code=1, account_code=20, surname="c2")
+        field = AccountContact._meta.get_field("account")
+        with self.assertNumQueries(1):
+            cascade.propagate(field, [((1, 10), (1, 20)), ((1, 20), (1, 10))])
+        self.assertEqual(
+            sorted(AccountContact.objects.values_list("surname", "company_code", "account_code")),
+            [("M. plop", 1, 20), ("c2", 1, 10), ("moiraine the witch", 2, 10)],
+        )
+
+    def test_not_cascading(self):
+        self.assertEqual(cascade.get_cascading_fields(Customer), [])
+        self.assertEqual(AccountContact._meta.get_field("account").deconstruct()[3]["on_update"], cascade.CASCADE)
+        self.assertNotIn("on_update", Contact._meta.get_field("customer").deconstruct()[3])
+        field = CompositeForeignKey(Customer, on_delete=CASCADE, to_fields=["company"], on_update="restrict")
+        field.name = "plop"
+        self.assertEqual([e.id for e in field._check_on_update()], ["compositefk.E009"])
+
+
+class TestOnUpdateCascadeTransaction(TransactionTestCase):
+    # the save and the update must be rolled back with their cascade, outside of the transaction of a TestCase
+
+    def setUp(self):
+        Account.objects.create(pk=1, company=1, account_id=10, name="first")
+        AccountContact.objects.create(pk=1, company_code=1, account_code=10, surname="M. plop")
+
+    def test_save(self):
+        account = Account.objects.get(pk=1)
+        account.account_id = 11
+        with mock.patch.object(cascade, "propagate", side_effect=DatabaseError("plop")):
+            with self.assertRaises(DatabaseError):
+                account.save()
+        self.assertFalse(connection.in_atomic_block)
+        self.assertEqual(Account.objects.get(pk=1).account_id, 10)
+        account.save()
+        self.assertEqual(AccountContact.objects.get(pk=1).account_code, 11)
+
+    def test_save_atomic(self):
+        # the block is opened by pre_save only for a key change
+        in_atomic = []
+
+        def record(**kwargs):
+            in_atomic.append(connection.in_atomic_block)
+        pre_save.connect(record, sender=Account)
+        try:
+            account = Account.objects.get(pk=1)
+            account.name = "second"
+            account.save()
+            account.account_id = 11
+            account.save()
+        finally:
+            pre_save.disconnect(record, sender=Account)
+        self.assertEqual(in_atomic, [False, True])
+        self.assertFalse(connection.in_atomic_block)
+        self.assertEqual(AccountContact.objects.get(pk=1).account_code, 11)
+
+    def test_failed_save(self):
+        account = Account.objects.get(pk=1)
+        account.account_id = 11
+        with mock.patch.object(Account, "_save_table", side_effect=DatabaseError("plop")):
+            with self.assertRaises(DatabaseError):
+                account.save()
+        # left open by the failed save, until the next one
+        self.assertTrue(connection.in_atomic_block)
+        account.save()
+        self.assertFalse(connection.in_atomic_block)
+        self.assertEqual(Account.objects.get(pk=1).account_id, 11)
+        self.assertEqual(AccountContact.objects.get(pk=1).account_code, 11)
+
+    def test_queryset_update(self):
+        with mock.patch.object(cascade, "propagate", side_effect=DatabaseError("plop")):
+            with self.assertRaises(DatabaseError):
+                Account.objects.filter(pk=1).update(account_id=11)
+        self.assertEqual(Account.objects.get(pk=1).account_id, 10)
+        self.assertEqual(AccountContact.objects.get(pk=1).account_code, 10)
+
+
+@skipIf(asyncio is None, "asyncio is not available")
+class TestCompositeLoader(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.loader = CompositeLoader(loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_loop(self, *futures):
+        return self.loop.run_until_complete(asyncio.gather(*futures))
+
+    def test_batch(self):
+        contacts = list(Contact.objects.order_by("pk"))
+        # the loads of the resolvers run in the same iteration of the loop
+        futures = []
+        for contact in contacts:
+            self.loop.call_soon(lambda contact=contact: futures.append(self.loader.load(contact, "customer")))
+        with self.assertNumQueries(1):
+            self.loop.run_until_complete(asyncio.sleep(0))
+            customers = self.run_loop(*futures)
+        self.assertEqual([c.pk for c in customers], [3, 1])
+        with self.assertNumQueries(0):
+            self.assertEqual(contacts[1].customer, customers[1])
+            self.assertEqual(self.run_loop(self.loader.load(contacts[0], "customer"))[0].pk, 3)
+
+    def test_deduplicate(self):
+        contacts = [Contact.objects.get(pk=2), Contact.objects.get(pk=2)]
+        with CaptureQueriesContext(connection) as queries:
+            first, second = self.run_loop(self.loader.load_many(contacts, "customer"))[0]
+        self.assertEqual(len(queries), 1)
+        self.assertIs(first, second)
+        self.assertEqual(queries[0]["sql"].count('"testapp_customer"."company" = 1'), 1)
+
+    def test_null(self):
+        customers = list(Customer.objects.order_by("pk"))
+        with self.assertNumQueries(1):
+            addresses = self.run_loop(self.loader.load_many(customers, "address"))[0]
+        self.assertEqual([a and a.pk for a in addresses], [1, None, None, None, None])
+        self.assertEqual(self.run_loop(self.loader.load_many([], "address")), [[]])
+
+    def test_missing(self):
+        contact = Contact.objects.create(company_code=9, customer_code=9, surname="nobody")
+        with self.assertRaises(Contact.customer.RelatedObjectDoesNotExist):
+            self.run_loop(self.loader.load(contact, "customer"))
+
+    def test_function_based_value(self):
+        suppliers = [MultiLangSupplier.objects.get(pk=1), MultiLangSupplier.objects.get(pk=1)]
+        with translation.override("en"):
+            english = self.loader.load(suppliers[0], "active_translations")
+        with translation.override("ru"):
+            russian = self.loader.load(suppliers[1], "active_translations")
+        # one query per value of the FunctionBasedFieldValue
+        with self.assertNumQueries(2):
+            translations = self.run_loop(english, russian)
+        self.assertEqual([t.name for t in translations], ["en_name", "ru_name"])
+
+    def test_executor_in_transaction(self):
+        # the test transaction is not visible from other threads : the query is run in the loop
+        contact = Contact.objects.get(pk=2)
+        with ThreadPoolExecutor(1) as executor, self.assertNumQueries(1):
+            loader = CompositeLoader(loop=self.loop, executor=executor)
+            customer = self.run_loop(loader.load(contact, "customer"))[0]
+        self.assertEqual(customer.pk, 1)
+
+
+@skipIf(asyncio is None, "asyncio is not available")
+class TestCompositeLoaderExecutor(TransactionTestCase):
+    # the threads use their own connections : the fixtures must be committed
+    fixtures = ["all_fixtures.json"]
+
+    def test_executor(self):
+        contacts = list(Contact.objects.order_by("pk"))
+        loop = asyncio.new_event_loop()
+        try:
+            with ThreadPoolExecutor(1) as executor, self.assertNumQueries(0):
+                loader = CompositeLoader(loop=loop, executor=executor)
+                customers = loop.run_until_complete(loader.load_many(contacts, "customer"))
+        finally:
+            loop.close()
+        self.assertEqual([c.pk for c in customers], [3, 1])
+
+
+class TestBulkValidation(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def test_validate_relations(self):
+        contacts = [
+            Contact(company_code=c, customer_code=i, surname="contact %d" % i)
+            for c, i in [(1, 10), (9, 9), (2, 10), (9, 9), (1, 99)]
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            errors = validate_relations(contacts)
+        # one query for the distinct keys
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(sorted(errors), [1, 3, 4])
+        self.assertEqual(list(errors[4]), ["customer"])
+        self.assertEqual(
+            errors[4]["customer"][0].messages, ["customer instance with company, customer_id (1, 99) does not exist."],
+        )
+        self.assertEqual(validate_relations(contacts, exclude=["customer"]), {})
+        self.assertEqual(validate_relations([]), {})
+        # by batch of distinct keys : 4 of them
+        with self.assertNumQueries(4):
+            self.assertEqual(sorted(validate_relations(contacts, batch_size=1)), [1, 3, 4])
+
+    def test_raw_and_null_values(self):
+        customers = [
+            Customer(company=1, customer_id=10, name="address 1", cod_rep="DB"),
+            # there is an address 1/20, but a supplier one
+            Customer(company=1, customer_id=20, name="no address"),
+            # no address, according to null_if_equal
+            Customer(company=-1, customer_id=10, name="null"),
+        ]
+        with mock.patch.object(Customer.local_address.field._raw_fields["type_tiers"], "_func") as type_tiers:
+            type_tiers.return_value = "C"
+            Address.objects.create(company=1, tiers_id=20, type_tiers="S", city="tar valon")
+            errors = validate_relations(customers)
+        self.assertEqual(sorted(errors), [1])
+        self.assertEqual(sorted(errors[1]), ["address", "local_address"])
+        self.assertEqual(
+            errors[1]["address"][0].messages,
+            ["address instance with company, tiers_id, type_tiers %r does not exist." % ((1, 20, "C"),)],
+        )
+        self.assertEqual(find_missing_references(Customer, customers[:1]), {})
+
+    def test_bulk_full_clean(self):
+        contacts = [
+            Contact(company_code=1, customer_code=10, surname="valid"),
+            Contact(company_code=9, customer_code=9, surname="x" * 300),
+            Contact(company_code=2, customer_code=10, surname=""),
+        ]
+        with self.assertNumQueries(1):
+            errors = bulk_full_clean(contacts)
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertEqual(sorted(errors[1].message_dict), ["customer", "surname"])
+        self.assertEqual(list(errors[2].message_dict), ["surname"])
+        self.assertEqual(bulk_full_clean(contacts, exclude=["surname", "customer"]), {})
+
+
+class TestCompositeOrdering(TestCase):
+    fixtures = ["all_fixtures.json"]
+
+    def setUp(self):
+        Contact.objects.create(company_code=1, customer_code=20, surname="c2")
+
+    def assertOrderedByColumns(self, queryset, order):
+        with CaptureQueriesContext(connection) as queries:
+            contacts = list(queryset)
+        self.assertNotIn("JOIN", queries[0]["sql"])
+        self.assertIn(
+            'ORDER BY "testapp_contact"."company_code" %s, "testapp_contact"."customer_code" %s' % (order, order),
+            queries[0]["sql"],
+        )
+        return [(c.company_code, c.customer_code) for c in contacts]
+
+    @mock.patch.object(Customer._meta, "ordering", ["name"])
+    def test_order_by(self):
+        # the ordering of the related model is not used
+        self.assertEqual(
+            self.assertOrderedByColumns(Contact.objects.order_by("customer"), "ASC"), [(1, 10), (1, 20), (2, 10)],
+        )
+        self.assertEqual(
+            self.assertOrderedByColumns(Contact.objects.order_by("-customer"), "DESC"), [(2, 10), (1, 20), (1, 10)],
+        )
+        self.assertEqual(
+            self.assertOrderedByColumns(Contact.objects.order_by(F("customer").desc()), "DESC"),
+            [(2, 10), (1, 20), (1, 10)],
+        )
+        self.assertEqual(self.assertOrderedByColumns(Contact.objects.order_by(F("customer")), "ASC")[0], (1, 10))
+
+    def test_expand(self):
+        self.assertEqual(expand_composite_name(Contact, "-customer"), ["-company_code", "-customer_code"])
+        self.assertEqual(expand_composite_name(Customer, "contacts__customer"), [
+            "contacts__company_code", "contacts__customer_code",
+        ])
+        # the RawFieldValue are not columns
+        self.assertEqual(expand_composite_name(Customer, "address"), ["company", "customer_id"])
+        self.assertEqual(expand_composite_name(Contact, "surname"), ["surname"])
+        self.assertEqual(expand_composite_name(Contact, "?"), ["?"])
+        expanded = expand_composite_name(Contact, F("customer").desc(nulls_last=True))
+        self.assertEqual([(o.expression.name, o.descending, o.nulls_last) for o in expanded], [
+            ("company_code", True, True), ("customer_code", True, True),
+        ])
+        self.assertIsInstance(expanded[0], OrderBy)
+
+    def test_distinct(self):
+        self.assertEqual(Contact.objects.distinct("customer").query.distinct_fields, ("company_code", "customer_code"))
+
+    def test_group_by(self):
+        Contact.objects.create(company_code=1, customer_code=20, surname="c3")
+        queryset = Contact.objects.values("customer").annotate(n=Count("id")).order_by("-customer")
+        with CaptureQueriesContext(connection) as queries:
+            rows = [(row["customer"], row["n"]) for row in queryset]
+        self.assertEqual(rows, [((2, 10), 1), ((1, 20), 2), ((1, 10), 1)])
+        self.assertNotIn("JOIN", queries[0]["sql"])
+        self.assertIn(
+            'GROUP BY "testapp_contact"."company_code", "testapp_contact"."customer_code"', queries[0]["sql"],
+        )
@@ -1,3 +1,5 @@
+import os
+
 import django.conf.global_settings as DEFAULT_SETTINGS
 
 
@@ -8,8 +10,19 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'db.sq3',
     },
+    # a second database to test the routing of the composite relations to a read replica
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'replica.sq3',
+    },
 }
 
+# COMPOSITEFK_TEST_FILE_DB=1 run the tests on sqlite files instead of memory : the worker processes (and the
+# threads, on python 2) can't see a database in memory, their tests are skipped without it
+if os.environ.get('COMPOSITEFK_TEST_FILE_DB'):
+    for alias, database in DATABASES.items():
+        database['TEST'] = {'NAME': 'test_%s.sq3' % alias}
+
 INSTALLED_APPS = (
     # Default Django apps
     'django.contrib.admin',
@@ -20,9 +33,15 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
 
     # We test this one
+    'compositefk',
     'testapp',
 )
 
+SERIALIZATION_MODULES = {
+    "json": "compositefk.serializers.json",
+    "python": "compositefk.serializers.python",
+}
+
 MIDDLEWARE_CLASSES = getattr(DEFAULT_SETTINGS, 'MIDDLEWARE_CLASSES', [])
 
 TEMPLATES = [